@@ -0,0 +1,264 @@
+# Copyright (c) 2023 Qureator, Inc. All rights reserved.
+"""Round-trip benchmark of the pack and unpack stages against the in-memory FakeGateway.
+
+Each stage reports wall time, server round trips by call, peak Python memory
+and, where it produces XML, the number of bytes. Results are written as JSON so
+that runs can be compared, e.g.
+
+    python benchmarks/bench_transfer.py --images 50 --planes 3,2,20 --rois 10 --latency 0.001 -o bench.json
+
+With ``--fixture`` the unpack stages run on a recorded OME-XML file instead of
+the export of synthetic images. With ``--trace`` the server calls and
+export/attach functions are traced, adding a per function summary to the
+results and writing a Chrome trace.
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import nullcontext
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import ome_types
+from ome_types import OME, from_xml, to_xml
+
+from omero_acquisition_transfer.testing import FakeGateway
+from omero_acquisition_transfer.transfer.archive import ArchiveWriter, MetadataArchive
+from omero_acquisition_transfer.testing.synthetic import build_image, populate, write_ome_tiff
+from omero_acquisition_transfer.transfer.pack import (
+    OMEXMLWriter,
+    export_image_metadata,
+    export_images_metadata,
+    merge_metadata_tiff,
+)
+from omero_acquisition_transfer.transfer.pack.pack_utils import read_image_description
+from omero_acquisition_transfer.transfer.tracing import Tracer, trace_connection
+from omero_acquisition_transfer.transfer.unpack import (
+    attach_image_metadata,
+    attach_images_metadata_streamed,
+    create_instruments,
+)
+
+
+def run_stage(
+    name: str,
+    conn: FakeGateway,
+    func: Callable[[], Optional[int]],
+    items: int,
+    memory: bool = True,
+) -> Dict[str, Any]:
+    """Run one stage. ``func`` may return the number of XML or archive bytes it produced."""
+    if memory:
+        tracemalloc.start()
+
+    with conn.calls.measure() as calls:
+        start = time.perf_counter()
+        xml_bytes = func()
+        seconds = time.perf_counter() - start
+
+    peak = None
+    if memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    result = {
+        "stage": name,
+        "items": items,
+        "seconds": seconds,
+        "seconds_per_item": seconds / items if items else None,
+        "round_trips": sum(calls.values()),
+        "calls": dict(sorted(calls.items())),
+        "peak_memory_bytes": peak,
+        "xml_bytes": xml_bytes,
+    }
+    print(
+        f"{name:<24} {seconds:9.3f} s {result['round_trips']:8d} calls "
+        f"{'' if peak is None else f'{peak / 2 ** 20:9.1f} MiB'} "
+        f"{'' if xml_bytes is None else f'{xml_bytes / 2 ** 10:9.1f} KiB XML'}"
+    )
+    return result
+
+
+def bench_pack(args: argparse.Namespace, source: FakeGateway, image_ids: List[int]) -> Tuple[List[Dict[str, Any]], OME]:
+    results = []
+    ome = OME()
+
+    def export_each() -> None:
+        for image_id in image_ids:
+            export_image_metadata(source.getObject("Image", image_id), source, ome, in_place=True)
+
+    results.append(run_stage("export_image_metadata", source, export_each, len(image_ids), args.memory))
+
+    def export_prefetched() -> None:
+        export_images_metadata(image_ids, source, OME(), plane_table=args.plane_table)
+
+    results.append(run_stage("export_images_metadata", source, export_prefetched, len(image_ids), args.memory))
+
+    results.append(run_stage("to_xml", source, lambda: len(to_xml(ome).encode()), len(image_ids), args.memory))
+
+    def export_streamed() -> int:
+        # Export and serialization together, memory bounded by a batch instead of the document
+        with tempfile.TemporaryFile("w+", encoding="utf-8") as fh:
+            with OMEXMLWriter(fh, plane_table=args.plane_table) as writer:
+                writer.add_images(image_ids, source)
+            fh.flush()
+            return os.fstat(fh.fileno()).st_size
+
+    results.append(run_stage("OMEXMLWriter", source, export_streamed, len(image_ids), args.memory))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        archive_path = os.path.join(tmp, "metadata.archive")
+
+        def export_archive() -> int:
+            with ArchiveWriter(archive_path, plane_table=args.plane_table) as writer:
+                writer.add_images(image_ids, source)
+            return sum(
+                os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(archive_path) for name in names
+            )
+
+        results.append(run_stage("ArchiveWriter", source, export_archive, len(image_ids), args.memory))
+
+        def read_archive() -> None:
+            MetadataArchive(archive_path).to_ome()
+
+        results.append(run_stage("MetadataArchive.to_ome", source, read_archive, len(image_ids), args.memory))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        size_z, size_c, size_t = args.planes
+        paths = {}
+        for image_id in image_ids:
+            paths[image_id] = os.path.join(tmp, f"{image_id}.ome.tiff")
+            write_ome_tiff(paths[image_id], size_c=size_c, size_z=size_z, size_t=size_t)
+
+        def merge_each() -> int:
+            for image_id, path in paths.items():
+                merge_metadata_tiff(source.getObject("Image", image_id), path, in_place=True)
+            return sum(len(read_image_description(path).encode()) for path in paths.values())
+
+        results.append(run_stage("merge_metadata_tiff", source, merge_each, len(image_ids), args.memory))
+
+    return results, ome
+
+
+def bench_unpack(args: argparse.Namespace, ome: OME) -> List[Dict[str, Any]]:
+    results = []
+    target = FakeGateway(latency=args.latency)
+    if args.trace:
+        trace_connection(target)
+
+    target_ids = build_targets(target, ome)
+    rois = {roi.id: roi for roi in ome.rois}
+
+    omero_id_to_object = {}
+
+    def create() -> None:
+        omero_id_to_object.update(create_instruments(ome.instruments, target, single_transaction=args.single_transaction))
+
+    results.append(run_stage("create_instruments", target, create, len(ome.instruments), args.memory))
+
+    def attach() -> None:
+        for image in ome.images:
+            attach_image_metadata(
+                image, target.getObject("Image", target_ids[image.id]), omero_id_to_object, target,
+                plane_chunk_size=args.plane_chunk_size, rois=rois,
+            )
+
+    results.append(run_stage("attach_image_metadata", target, attach, len(ome.images), args.memory))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "unpack.ome.xml")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(to_xml(ome))
+        streamed_ids = build_targets(target, ome)
+
+        def attach_streamed() -> None:
+            # Parsing included, instruments are created again
+            attach_images_metadata_streamed(path, streamed_ids, target, plane_chunk_size=args.plane_chunk_size)
+
+        results.append(run_stage("attach_images_metadata_streamed", target, attach_streamed, len(ome.images),
+                                 args.memory))
+
+    return results
+
+
+def build_targets(target: FakeGateway, ome: OME) -> Dict[str, int]:
+    # Empty target images like the ones created by importing the pixels, built outside the timed stages
+    return {
+        image.id: build_image(
+            target.store,
+            size_c=image.pixels.size_c,
+            size_z=image.pixels.size_z,
+            size_t=image.pixels.size_t,
+            planes=False,
+        ).getId().getValue()
+        for image in ome.images
+    }
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--images", type=int, default=20, help="number of synthetic images")
+    parser.add_argument("--instruments", type=int, default=1, help="number of instruments shared by the images")
+    parser.add_argument("--planes", type=lambda s: tuple(int(v) for v in s.split(",")), default=(3, 2, 5),
+                        help="size Z,C,T of each image, one plane per (z, c, t)")
+    parser.add_argument("--rois", type=int, default=5, help="ROIs per image")
+    parser.add_argument("--shapes", type=int, default=2, help="shapes per ROI")
+    parser.add_argument("--latency", type=float, default=0.0, help="simulated seconds per server call")
+    parser.add_argument("--plane-chunk-size", type=int, default=None, help="chunk size when attaching planes")
+    parser.add_argument("--plane-table", action="store_true", help="export planes as plane tables")
+    parser.add_argument("--single-transaction", action="store_true", help="create each instrument with one save")
+    parser.add_argument("--fixture", help="recorded OME-XML to unpack instead of the synthetic export")
+    parser.add_argument("--no-memory", dest="memory", action="store_false",
+                        help="skip tracemalloc, which slows the stages down")
+    parser.add_argument("--trace", help="Chrome trace file of the traced calls")
+    parser.add_argument("-o", "--output", default="bench_output.json", help="JSON results file")
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    args = parse_args(argv)
+    results = []
+    tracer = Tracer()
+
+    with tracer.activate() if args.trace else nullcontext():
+        if args.fixture:
+            with open(args.fixture, encoding="utf-8") as f:
+                ome = from_xml(f.read())
+        else:
+            source = FakeGateway(latency=args.latency)
+            size_z, size_c, size_t = args.planes
+            image_ids = populate(
+                source.store, images=args.images, instruments=args.instruments,
+                size_c=size_c, size_z=size_z, size_t=size_t, rois=args.rois, shapes_per_roi=args.shapes,
+            )
+            if args.trace:
+                trace_connection(source)
+            results, ome = bench_pack(args, source, image_ids)
+
+        results += bench_unpack(args, ome)
+
+    report = {
+        "benchmark": "transfer",
+        "config": {name: value for name, value in vars(args).items() if name != "output"},
+        "environment": {
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "ome_types": ome_types.__version__,
+        },
+        "stages": results,
+    }
+    if args.trace:
+        report["trace"] = tracer.summary()["functions"]
+        tracer.to_chrome_trace(args.trace)
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
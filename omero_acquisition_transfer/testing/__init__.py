@@ -0,0 +1,10 @@
+from .gateway import (
+    CallCounter,
+    FakeGateway,
+    FakeMetadataService,
+    FakeQueryService,
+    FakeRoiService,
+    FakeStore,
+    FakeTypesService,
+    FakeUpdateService,
+)
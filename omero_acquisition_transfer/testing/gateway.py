@@ -0,0 +1,710 @@
+# Copyright (c) 2023 Qureator, Inc. All rights reserved.
+
+import copy
+import re
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from types import SimpleNamespace
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence
+
+import omero
+import omero.model
+import omero.rtypes
+import omero.sys
+from omero.gateway import KNOWN_WRAPPERS, BlitzObjectWrapper
+from omero.gateway.utils import ServiceOptsDict
+from omero.model import IObject
+from omero.rtypes import rint, rlong, rstring, unwrap, wrap
+
+from ..transfer.pack.exports.prefetch import (
+    PREFETCH_CHANNELS_QUERY,
+    PREFETCH_IMAGES_QUERY,
+    PREFETCH_ROIS_QUERY,
+)
+
+# Concrete model classes stored for an abstract one
+SUBCLASSES = {
+    "LightSource": ("Laser", "Arc", "Filament", "LightEmittingDiode", "GenericExcitationSource"),
+    "Shape": ("Point", "Line", "Rectangle", "Ellipse", "Polygon", "Polyline", "Label", "Mask"),
+}
+# Collections filled when an instrument is loaded, as (collection, model class)
+INSTRUMENT_COLLECTIONS = (
+    ("detector", "Detector"),
+    ("objective", "Objective"),
+    ("filter", "Filter"),
+    ("dichroic", "Dichroic"),
+    ("lightSource", "LightSource"),
+)
+
+# select <columns> from <Model> as <alias> where <alias>.<path> in (:ids) | = :id [order by <columns>]
+SIMPLE_QUERY = re.compile(
+    r"^select (?P<columns>.+?) from (?P<model>\w+) as (?P<alias>\w+) "
+    r"where (?P=alias)\.(?P<key>[\w.]+) ?(?:in \(:(?P<list>\w+)\)|= ?:(?P<param>\w+))"
+    r"(?: order by (?P<order>.+))?$"
+)
+# Queries issued by the gateway wrappers themselves
+CHANNELS_QUERY = (
+    "select p from Pixels p join fetch p.channels as c join fetch c.logicalChannel as lc where p.id=:pid"
+)
+PLANE_INFO_QUERY = re.compile(
+    r"^select info from PlaneInfo as info join fetch info.deltaT as dt join fetch info.exposureTime as et "
+    r"where info.pixels.id=:pid(?P<filters>( and info.the[CZT]=:the[CZT])*) order by info.deltaT$"
+)
+IMAGE_PLANE_INFOS_QUERY = re.compile(
+    r"^from Image as i left outer join fetch i.pixels p left outer join fetch p.planeInfo where i.id = (?P<id>\d+)$"
+)
+# select <columns> from <Model> as <alias> [[left outer] join <alias>.<field> as <alias>]...
+# where <path> in (:ids) [group by <path>] [order by <paths>], with max() and count() columns
+JOIN_QUERY = re.compile(
+    r"^select (?P<columns>.+?) from (?P<model>\w+) as (?P<alias>\w+)"
+    r"(?P<joins>(?: (?:left outer )?join \w+\.\w+ as \w+)*) "
+    r"where (?P<key>\w+(?:\.\w+)+) in \(:(?P<list>\w+)\)"
+    r"(?: group by (?P<group>\w+(?:\.\w+)+))?"
+    r"(?: order by (?P<order>.+))?$"
+)
+JOIN = re.compile(r"(?P<outer>left outer )?join (?P<source>\w+)\.(?P<field>\w+) as (?P<alias>\w+)")
+AGGREGATE = re.compile(r"^(?P<function>max|count)\((?P<path>[\w.]+)\)$")
+
+
+def model_name(obj: IObject) -> str:
+    name = obj.__class__.__name__
+    return name[:-1] if name.endswith("I") else name
+
+
+def _field_attrs(obj: IObject) -> Iterator[str]:
+    for field in obj._field_info._fields:
+        if field == "details":
+            continue
+        for attr in (f"_{field}Seq", f"_{field}"):
+            if attr in obj.__dict__:
+                yield attr
+                break
+
+
+def _mutable(obj: IObject) -> bool:
+    # Versioned like omero.model.IMutable objects
+    return hasattr(obj, "setVersion")
+
+
+def _resolve(obj: Any, path: Sequence[str]) -> Any:
+    # Follow a HQL path such as ['pixels', 'id'] or ['deltaT', 'unit'] through getters
+    for name in path:
+        if obj is None:
+            return None
+        if name == "id":
+            obj = obj.getId()
+        elif name == "value":
+            obj = obj.getValue()
+        elif name == "unit":
+            obj = str(obj.getUnit())
+        else:
+            obj = getattr(obj, f"get{name[0].upper()}{name[1:]}")()
+    return obj
+
+
+def _fill(obj: IObject, collection: str, children: List[IObject]) -> IObject:
+    setattr(obj, f"_{collection}Seq", children)
+    setattr(obj, f"_{collection}Loaded", True)
+    return obj
+
+
+class FakeStore:
+    """In-memory server state of a :class:`FakeGateway`, as ``omero.model`` objects by class and ID.
+
+    Like a real server, saving copies the values of the saved graph into the
+    stored objects and never changes the caller's objects, which only get IDs
+    through the returned copies. The services return copies too, so changing
+    a loaded object has no effect until it is saved. Within the store,
+    references point to the stored objects, one instance per object.
+
+    :meth:`get`, :meth:`all` and :meth:`children` return the stored objects
+    themselves, for inspecting the state in tests.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._tables: Dict[str, Dict[int, IObject]] = defaultdict(dict)
+        self._enums: Dict[str, Dict[str, IObject]] = defaultdict(dict)
+        self._next_id = 1
+        # Children by parent ID per (model, parent field), rebuilt after writes
+        self._revision = 0
+        self._children: Dict[tuple, tuple] = {}
+
+    def save(self, obj: IObject) -> IObject:
+        """Save a graph of objects, assigning IDs to new ones. Returns a copy of the stored object."""
+        with self._lock:
+            self._revision += 1
+            return self.copy(self._save(obj, {}))
+
+    def copy(self, value: Any) -> Any:
+        """Copy of stored objects, or of a list of them, sharing one copy per object, as sent by a server."""
+        with self._lock:
+            return copy.deepcopy(value)
+
+    def _save(self, obj: IObject, saved: Dict[int, IObject]) -> IObject:
+        if id(obj) in saved:
+            return saved[id(obj)]
+
+        if not obj.isLoaded():
+            stored = self.get(model_name(obj), unwrap(obj.getId()))
+            return copy.deepcopy(obj) if stored is None else stored
+
+        name = model_name(obj)
+        obj_id = unwrap(obj.getId())
+        # Enumerations have neither a version nor update events
+        mutable = _mutable(obj)
+        stored = None if obj_id is None else self._tables[name].get(obj_id)
+        if stored is None:
+            if obj_id is None:
+                obj_id = self._next_id
+                self._next_id += 1
+            stored = obj.__class__()
+            stored.setId(rlong(obj_id))
+            if mutable:
+                stored.setVersion(rint(0))
+            self._tables[name][obj_id] = stored
+        elif stored is not obj and mutable:
+            stored.setVersion(rint(unwrap(stored.getVersion()) + 1))
+        saved[id(obj)] = stored
+
+        # One update event per save, as read by the version queries of the metadata cache
+        if mutable:
+            if stored.getDetails() is None:
+                stored._details = omero.model.DetailsI()
+            stored.getDetails().setUpdateEvent(omero.model.EventI(rlong(self._revision), False))
+
+        for attr in _field_attrs(obj):
+            value = getattr(obj, attr)
+            if isinstance(value, IObject):
+                value = self._save(value, saved)
+            elif isinstance(value, list):
+                value = [self._save(item, saved) if isinstance(item, IObject) else copy.deepcopy(item) for item in value]
+            elif attr.endswith("Seq") and value is None:
+                # Unloaded collection, keep the stored one
+                continue
+            elif stored is not obj:
+                # Values such as lengths are mutable
+                value = copy.deepcopy(value)
+            setattr(stored, attr, value)
+
+        return stored
+
+    def get(self, name: str, obj_id: Optional[int]) -> Optional[IObject]:
+        with self._lock:
+            for table in SUBCLASSES.get(name, (name,)):
+                obj = self._tables[table].get(obj_id)
+                if obj is not None:
+                    return obj
+        return None
+
+    def all(self, name: str) -> List[IObject]:
+        with self._lock:
+            objs = [obj for table in SUBCLASSES.get(name, (name,)) for obj in self._tables[table].values()]
+        return sorted(objs, key=lambda obj: obj.getId().getValue())
+
+    def count(self, name: str) -> int:
+        with self._lock:
+            return sum(len(self._tables[table]) for table in SUBCLASSES.get(name, (name,)))
+
+    def children(self, name: str, parent: str, parent_id: int) -> List[IObject]:
+        with self._lock:
+            revision, index = self._children.get((name, parent), (None, None))
+            if revision != self._revision:
+                index = defaultdict(list)
+                for obj in self.all(name):
+                    index[unwrap(_resolve(obj, (parent, "id")))].append(obj)
+                self._children[(name, parent)] = (self._revision, index)
+
+        return list(index.get(parent_id, []))
+
+    def delete(self, name: str, obj_ids: List[int]) -> None:
+        with self._lock:
+            self._revision += 1
+            for obj_id in obj_ids:
+                for table in SUBCLASSES.get(name, (name,)):
+                    self._tables[table].pop(obj_id, None)
+
+    def enumeration(self, class_name: str, value: str) -> IObject:
+        with self._lock:
+            enum_obj = self._enums[class_name].get(value)
+            if enum_obj is None:
+                enum_obj = getattr(omero.model, class_name)()
+                enum_obj.setValue(rstring(value))
+                self._revision += 1
+                enum_obj = self._enums[class_name][value] = self._save(enum_obj, {})
+        return enum_obj
+
+    def enumerations(self, class_name: str) -> List[IObject]:
+        with self._lock:
+            return list(self._enums[class_name].values())
+
+
+class CallCounter:
+    """Calls made through a :class:`FakeGateway` and the gateways joined to it, by name.
+
+    Names are ``getObject``, ``deleteObjects`` or ``<Service>.<method>``, e.g.
+    ``QueryService.findAllByQuery``.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts: Counter = Counter()
+
+    def add(self, name: str) -> None:
+        with self._lock:
+            self.counts[name] += 1
+
+    @property
+    def total(self) -> int:
+        with self._lock:
+            return sum(self.counts.values())
+
+    def __getitem__(self, name: str) -> int:
+        with self._lock:
+            return self.counts[name]
+
+    def reset(self) -> None:
+        with self._lock:
+            self.counts.clear()
+
+    @contextmanager
+    def measure(self) -> Iterator[Counter]:
+        """Count the calls made within the block.
+
+        Examples
+        --------
+        >>> with conn.calls.measure() as calls:
+        ...     export_image_metadata(image, conn, ome)
+        >>> assert sum(calls.values()) <= 10
+        """
+        with self._lock:
+            before = self.counts.copy()
+        calls: Counter = Counter()
+        try:
+            yield calls
+        finally:
+            with self._lock:
+                calls.update(self.counts - before)
+
+
+class _Service:
+    name = ""
+
+    def __init__(self, conn: "FakeGateway"):
+        self._conn = conn
+        self._store = conn.store
+
+    def _call(self, method: str) -> None:
+        self._conn._call(f"{self.name}.{method}")
+
+
+class FakeQueryService(_Service):
+    """Query service answering the HQL queries of this package and of the gateway wrappers.
+
+    Simple queries of the form ``select <columns> from <Model> as <alias> where
+    <alias>.<path> in (:ids) order by <columns>`` are evaluated directly, as are
+    projections with joins, ``max()``, ``count()`` and ``group by`` like the
+    version queries of the metadata cache. Queries with fetch joins have a
+    handler each, and more can be added with :meth:`register`. Other queries
+    raise ``NotImplementedError``.
+    """
+
+    name = "QueryService"
+
+    def __init__(self, conn: "FakeGateway"):
+        super().__init__(conn)
+        self._handlers: Dict[str, Callable[[FakeStore, Dict[str, Any]], List[Any]]] = {
+            _normalize(PREFETCH_IMAGES_QUERY): _images,
+            _normalize(PREFETCH_CHANNELS_QUERY): _pixels_channels,
+            _normalize(PREFETCH_ROIS_QUERY): _rois,
+            _normalize(CHANNELS_QUERY): _pixels_channels,
+        }
+
+    def register(self, query: str, handler: Callable[[FakeStore, Dict[str, Any]], List[Any]]) -> None:
+        self._handlers[_normalize(query)] = handler
+
+    def findAllByQuery(self, query: str, params, ctx=None) -> List[IObject]:
+        self._call("findAllByQuery")
+        return self._query(query, params)
+
+    def findByQuery(self, query: str, params, ctx=None) -> Optional[IObject]:
+        self._call("findByQuery")
+        results = self._query(query, params)
+        return results[0] if results else None
+
+    def projection(self, query: str, params, ctx=None) -> List[List[omero.RType]]:
+        self._call("projection")
+        return [[value if isinstance(value, omero.RType) else wrap(value) for value in row] for row in self._query(query, params)]
+
+    def find(self, name: str, obj_id: int, ctx=None) -> Optional[IObject]:
+        self._call("find")
+        return self._store.copy(self._store.get(name, obj_id))
+
+    def get(self, name: str, obj_id: int, ctx=None) -> IObject:
+        self._call("get")
+        obj = self._store.get(name, obj_id)
+        if obj is None:
+            raise omero.ValidationException("", "", f"No row with the given identifier exists: {name}:{obj_id}")
+        return self._store.copy(obj)
+
+    def _query(self, query: str, params) -> List[Any]:
+        query = _normalize(query)
+        args, offset, limit = _parse_params(params)
+
+        handler = self._handlers.get(query)
+        if handler is not None:
+            results = handler(self._store, args)
+        else:
+            results = self._query_pattern(query, args)
+
+        if limit is not None:
+            return self._store.copy(results[offset:offset + limit])
+        return self._store.copy(results[offset:])
+
+    def _query_pattern(self, query: str, args: Dict[str, Any]) -> List[Any]:
+        match = IMAGE_PLANE_INFOS_QUERY.match(query)
+        if match:
+            image = self._store.get("Image", int(match["id"]))
+            if image is None:
+                return []
+            for pixels in image.copyPixels():
+                _fill(pixels, "planeInfo", self._store.children("PlaneInfo", "pixels", pixels.getId().getValue()))
+            return [image]
+
+        match = PLANE_INFO_QUERY.match(query)
+        if match:
+            # Inner fetch joins drop planes without deltaT or exposure time
+            planes = [
+                plane for plane in self._store.children("PlaneInfo", "pixels", args["pid"])
+                if plane.getDeltaT() is not None and plane.getExposureTime() is not None
+                and all(unwrap(_resolve(plane, (name,))) == args[name] for name in ("theC", "theT", "theZ") if name in args)
+            ]
+            return sorted(planes, key=lambda plane: plane.getDeltaT().getValue())
+
+        match = SIMPLE_QUERY.match(query)
+        if match:
+            return _simple_query(self._store, match, args)
+
+        match = JOIN_QUERY.match(query)
+        if match:
+            return _join_query(self._store, match, args)
+
+        raise NotImplementedError(f"Query not supported by FakeGateway: {query}")
+
+
+class FakeUpdateService(_Service):
+    name = "UpdateService"
+
+    def saveObject(self, obj: IObject, ctx=None) -> None:
+        self._call("saveObject")
+        self._store.save(obj)
+
+    def saveAndReturnObject(self, obj: IObject, ctx=None) -> IObject:
+        self._call("saveAndReturnObject")
+        return self._store.save(obj)
+
+    def saveArray(self, objs: List[IObject], ctx=None) -> None:
+        self._call("saveArray")
+        for obj in objs:
+            self._store.save(obj)
+
+    def saveAndReturnArray(self, objs: List[IObject], ctx=None) -> List[IObject]:
+        self._call("saveAndReturnArray")
+        return [self._store.save(obj) for obj in objs]
+
+    def deleteObject(self, obj: IObject, ctx=None) -> None:
+        self._call("deleteObject")
+        self._store.delete(model_name(obj), [obj.getId().getValue()])
+
+
+class FakeTypesService(_Service):
+    name = "TypesService"
+
+    def allEnumerations(self, class_name: str, ctx=None) -> List[IObject]:
+        self._call("allEnumerations")
+        return self._store.copy(self._store.enumerations(class_name))
+
+    def getEnumeration(self, class_name: str, value: str, ctx=None) -> IObject:
+        # Any value is accepted and created on first use
+        self._call("getEnumeration")
+        return self._store.copy(self._store.enumeration(class_name, value))
+
+
+class FakeRoiService(_Service):
+    name = "RoiService"
+
+    def findByImage(self, image_id: int, options=None, ctx=None) -> SimpleNamespace:
+        self._call("findByImage")
+        rois = _rois(self._store, {"ids": [image_id]})
+
+        offset = 0 if options is None else unwrap(options.offset) or 0
+        limit = None if options is None else unwrap(options.limit)
+        rois = rois[offset:] if limit is None else rois[offset:offset + limit]
+
+        return SimpleNamespace(rois=self._store.copy(rois))
+
+
+class FakeMetadataService(_Service):
+    name = "MetadataService"
+
+    def loadInstrument(self, instrument_id: int, ctx=None) -> Optional[IObject]:
+        self._call("loadInstrument")
+        instrument = self._store.get("Instrument", instrument_id)
+        if instrument is None:
+            return None
+
+        for collection, name in INSTRUMENT_COLLECTIONS:
+            _fill(instrument, collection, self._store.children(name, "instrument", instrument_id))
+        return self._store.copy(instrument)
+
+    def loadChannelAcquisitionData(self, logical_channel_ids: List[int], ctx=None) -> List[IObject]:
+        self._call("loadChannelAcquisitionData")
+        objs = [self._store.get("LogicalChannel", lch_id) for lch_id in logical_channel_ids]
+        return self._store.copy([obj for obj in objs if obj is not None])
+
+
+class FakeClient:
+    def __init__(self, session_id: str):
+        self._session_id = session_id
+
+    def getProperty(self, name: str) -> str:
+        return {"omero.host": "fake", "omero.port": "4064"}.get(name, "")
+
+    def getSessionId(self) -> str:
+        return self._session_id
+
+
+class FakeGateway:
+    """In-memory stand-in for ``BlitzGateway`` with simulated latency and call counting.
+
+    Implements ``getObject``, ``deleteObjects`` and the query, update, types,
+    ROI and metadata services as far as this package uses them. Objects are
+    returned in the real ``omero.gateway`` wrappers, whose own server calls go
+    through the fake services. Every call is counted in :attr:`calls` and
+    delayed by its latency.
+
+    Parameters
+    ----------
+    store : FakeStore, optional
+        Server state, e.g. shared between a source and a target gateway's tests. A new store by default.
+    latency : float
+        Simulated seconds per call.
+    latencies : Dict[str, float], optional
+        Seconds by call name, overriding ``latency``, e.g. {"UpdateService.saveArray": 0.05}.
+
+    Examples
+    --------
+    >>> conn = FakeGateway(latency=0.002)
+    >>> image = conn.store.save(build_image())
+    >>> with conn.calls.measure() as calls:
+    ...     export_image_metadata(conn.getObject("Image", image.getId().getValue()), conn, OME())
+    >>> calls["MetadataService.loadInstrument"]
+    1
+    """
+
+    def __init__(
+        self,
+        store: Optional[FakeStore] = None,
+        latency: float = 0.0,
+        latencies: Optional[Dict[str, float]] = None,
+        calls: Optional[CallCounter] = None,
+    ):
+        self.store = store or FakeStore()
+        self.latency = latency
+        self.latencies = dict(latencies or {})
+        self.calls = calls or CallCounter()
+
+        self.SERVICE_OPTS = ServiceOptsDict()
+        self.c = FakeClient(str(id(self.store)))
+
+        self._query_service = FakeQueryService(self)
+        self._update_service = FakeUpdateService(self)
+        self._types_service = FakeTypesService(self)
+        self._roi_service = FakeRoiService(self)
+        self._metadata_service = FakeMetadataService(self)
+
+    def _call(self, name: str) -> None:
+        self.calls.add(name)
+        delay = self.latencies.get(name, self.latency)
+        if delay:
+            time.sleep(delay)
+
+    def getQueryService(self) -> FakeQueryService:
+        return self._query_service
+
+    def getUpdateService(self) -> FakeUpdateService:
+        return self._update_service
+
+    def getTypesService(self) -> FakeTypesService:
+        return self._types_service
+
+    def getRoiService(self) -> FakeRoiService:
+        return self._roi_service
+
+    def getMetadataService(self) -> FakeMetadataService:
+        return self._metadata_service
+
+    def getEventContext(self) -> "omero.sys.EventContext":
+        # Cached at login by BlitzGateway, so not counted as a call
+        return omero.sys.EventContext(sessionUuid=self.c.getSessionId(), groupId=0, userId=0)
+
+    def createRenderingEngine(self):
+        # ImageWrapper.getChannels loads channels with a query after a ConcurrencyException,
+        # as for images whose pyramid is being generated, but returns None after other errors
+        self._call("createRenderingEngine")
+        raise omero.ConcurrencyException("", "", "Rendering is not supported by FakeGateway")
+
+    def getObject(self, obj_type: str, oid: Optional[int] = None, **kwargs) -> Optional[BlitzObjectWrapper]:
+        self._call("getObject")
+        obj = self.store.get(obj_type, oid)
+        if obj is None:
+            return None
+        return KNOWN_WRAPPERS.get(obj_type.lower(), BlitzObjectWrapper)(self, self.store.copy(obj))
+
+    def deleteObjects(self, graph_spec: str, obj_ids: List[int], deleteAnns=False, deleteChildren=False,
+                      dryRun=False, wait=False) -> None:
+        self._call("deleteObjects")
+        if not dryRun:
+            self.store.delete(graph_spec.split("/")[-1], list(obj_ids))
+
+    def join(self) -> "FakeGateway":
+        """New gateway on the same store, counter and latencies, like a joined session.
+
+        Pass ``FakeGateway.join`` as the ``join`` of :class:`WorkerSessions` or
+        the parallel drivers to run them offline.
+        """
+        conn = FakeGateway(self.store, self.latency, self.latencies, self.calls)
+        conn.SERVICE_OPTS = self.SERVICE_OPTS.copy()
+        return conn
+
+    def close(self, hard: bool = True) -> None:
+        pass
+
+
+def _normalize(query: str) -> str:
+    return " ".join(query.split())
+
+
+def _parse_params(params) -> tuple:
+    if params is None:
+        return {}, 0, None
+
+    args = {name: unwrap(value) for name, value in (params.map or {}).items()}
+    page = getattr(params, "theFilter", None)
+    offset = 0 if page is None else unwrap(page.offset) or 0
+    limit = None if page is None else unwrap(page.limit)
+
+    return args, offset, limit
+
+
+def _simple_query(store: FakeStore, match, args: Dict[str, Any]) -> List[Any]:
+    alias = match["alias"]
+    key = match["key"].split(".")
+    values = args[match["list"]] if match["list"] else [args[match["param"]]]
+    values = set(values)
+
+    if len(key) == 2 and key[1] == "id":
+        objs = sorted(
+            (obj for value in values for obj in store.children(match["model"], key[0], value)),
+            key=lambda obj: obj.getId().getValue(),
+        )
+    else:
+        objs = [obj for obj in store.all(match["model"]) if unwrap(_resolve(obj, key)) in values]
+
+    if match["order"]:
+        for column in reversed(match["order"].split(", ")):
+            path = column.split()[0].split(".")[1:]
+            objs.sort(key=lambda obj: _sort_key(unwrap(_resolve(obj, path))))
+
+    columns = [column.strip() for column in match["columns"].split(",")]
+    if columns == [alias]:
+        return objs
+
+    return [[_resolve(obj, column.split(".")[1:]) for column in columns] for obj in objs]
+
+
+def _join_query(store: FakeStore, match, args: Dict[str, Any]) -> List[List[Any]]:
+    rows = [{match["alias"]: obj} for obj in store.all(match["model"])]
+    for join in JOIN.finditer(match["joins"]):
+        joined = []
+        for row in rows:
+            targets = _joined(store, row[join["source"]], join["field"])
+            if not targets and join["outer"]:
+                targets = [None]
+            joined.extend({**row, join["alias"]: target} for target in targets)
+        rows = joined
+
+    if match["order"]:
+        for column in reversed(match["order"].split(", ")):
+            rows.sort(key=lambda row: _sort_key(_path_value(row, column.split()[0])))
+
+    values = set(args[match["list"]])
+    groups = defaultdict(list)
+    for position, row in enumerate(rows):
+        if _path_value(row, match["key"]) in values:
+            groups[position if match["group"] is None else _path_value(row, match["group"])].append(row)
+
+    columns = [column.strip() for column in match["columns"].split(",")]
+    return [[_column_value(column, group) for column in columns] for group in groups.values()]
+
+
+def _joined(store: FakeStore, obj: Optional[IObject], field: str) -> List[IObject]:
+    # Objects referenced by a field or in a collection, without deleted ones
+    if obj is None:
+        return []
+    if f"_{field}Seq" in obj.__dict__:
+        targets = getattr(obj, f"_{field}Seq") or []
+    else:
+        targets = [_resolve(obj, (field,))]
+    return [
+        target for target in targets
+        if target is not None and store.get(model_name(target), unwrap(target.getId())) is not None
+    ]
+
+
+def _path_value(row: Dict[str, Optional[IObject]], path: str) -> Any:
+    alias, *names = path.split(".")
+    return unwrap(_resolve(row[alias], names))
+
+
+def _column_value(column: str, rows: List[Dict[str, Optional[IObject]]]) -> Any:
+    match = AGGREGATE.match(column)
+    if match is None:
+        return _path_value(rows[0], column)
+
+    values = [value for value in (_path_value(row, match["path"]) for row in rows) if value is not None]
+    if match["function"] == "count":
+        return len(values)
+    return max(values, default=None)
+
+
+def _sort_key(value: Any) -> tuple:
+    # Nulls last, like PostgreSQL
+    return value is None, value
+
+
+def _images(store: FakeStore, args: Dict[str, Any]) -> List[IObject]:
+    images = [store.get("Image", image_id) for image_id in args["ids"]]
+    return [
+        _fill(image, "pixels", store.children("Pixels", "image", image.getId().getValue()))
+        for image in images if image is not None
+    ]
+
+
+def _pixels_channels(store: FakeStore, args: Dict[str, Any]) -> List[IObject]:
+    pixels_ids = args["ids"] if "ids" in args else [args["pid"]]
+    pixels = [store.get("Pixels", pixels_id) for pixels_id in pixels_ids]
+    return [
+        _fill(pix, "channels", store.children("Channel", "pixels", pix.getId().getValue()))
+        for pix in pixels if pix is not None
+    ]
+
+
+def _rois(store: FakeStore, args: Dict[str, Any]) -> List[IObject]:
+    rois = sorted(
+        (roi for image_id in set(args["ids"]) for roi in store.children("Roi", "image", image_id)),
+        key=lambda roi: roi.getId().getValue(),
+    )
+    return [_fill(roi, "shapes", store.children("Shape", "roi", roi.getId().getValue())) for roi in rois]
@@ -0,0 +1,323 @@
+# Copyright (c) 2023 Qureator, Inc. All rights reserved.
+
+import struct
+from typing import List, Optional
+
+from omero.model import (
+    ChannelI,
+    DetectorI,
+    DetectorSettingsI,
+    EllipseI,
+    FilterI,
+    ImageI,
+    InstrumentI,
+    LaserI,
+    LengthI,
+    LightPathI,
+    LightSettingsI,
+    LineI,
+    LogicalChannelI,
+    MicroscopeI,
+    ObjectiveI,
+    ObjectiveSettingsI,
+    PixelsI,
+    PlaneInfoI,
+    PlateI,
+    PointI,
+    PolygonI,
+    RectangleI,
+    RoiI,
+    TimeI,
+    TransmittanceRangeI,
+    WellI,
+    WellSampleI,
+)
+from omero.model.enums import UnitsLength, UnitsTime
+from omero.rtypes import rdouble, rint, rstring
+
+from .gateway import FakeStore
+
+SHAPE_BUILDERS = ("Rectangle", "Ellipse", "Point", "Polygon", "Line")
+# RGBA of the channels, cycled through
+CHANNEL_COLORS = ((0, 255, 0, 255), (255, 0, 255, 255))
+
+
+def build_instrument(
+    store: FakeStore,
+    detectors: int = 1,
+    objectives: int = 1,
+    lasers: int = 1,
+    filters: int = 2,
+) -> InstrumentI:
+    """Save an instrument with the given number of components to ``store``."""
+    instrument = InstrumentI()
+
+    microscope = MicroscopeI()
+    microscope.setManufacturer(rstring("Synthetic"))
+    microscope.setModel(rstring("Microscope"))
+    microscope.setType(store.enumeration("MicroscopeTypeI", "Inverted"))
+    instrument.setMicroscope(microscope)
+
+    for i in range(detectors):
+        detector = DetectorI()
+        detector.setManufacturer(rstring("Synthetic"))
+        detector.setSerialNumber(rstring(f"D{i}"))
+        detector.setType(store.enumeration("DetectorTypeI", "CCD"))
+        detector.setGain(rdouble(1.0 + i))
+        instrument.addDetector(detector)
+
+    for i in range(objectives):
+        objective = ObjectiveI()
+        objective.setManufacturer(rstring("Synthetic"))
+        objective.setSerialNumber(rstring(f"O{i}"))
+        objective.setCorrection(store.enumeration("CorrectionI", "PlanApo"))
+        objective.setImmersion(store.enumeration("ImmersionI", "Oil"))
+        objective.setLensNA(rdouble(1.4))
+        objective.setNominalMagnification(rdouble(20.0 * (i + 1)))
+        instrument.addObjective(objective)
+
+    for i in range(lasers):
+        laser = LaserI()
+        laser.setManufacturer(rstring("Synthetic"))
+        laser.setSerialNumber(rstring(f"L{i}"))
+        laser.setType(store.enumeration("LaserTypeI", "SolidState"))
+        laser.setLaserMedium(store.enumeration("LaserMediumI", "Nd-YAG"))
+        laser.setWavelength(LengthI(405.0 + 100 * i, UnitsLength.NANOMETER))
+        instrument.addLightSource(laser)
+
+    for i in range(filters):
+        transmittance_range = TransmittanceRangeI()
+        transmittance_range.setCutIn(LengthI(400.0 + 50 * i, UnitsLength.NANOMETER))
+        transmittance_range.setCutOut(LengthI(440.0 + 50 * i, UnitsLength.NANOMETER))
+
+        filter_ = FilterI()
+        filter_.setManufacturer(rstring("Synthetic"))
+        filter_.setSerialNumber(rstring(f"F{i}"))
+        filter_.setType(store.enumeration("FilterTypeI", "BandPass"))
+        filter_.setTransmittanceRange(transmittance_range)
+        instrument.addFilter(filter_)
+
+    return store.save(instrument)
+
+
+def build_image(
+    store: FakeStore,
+    size_c: int = 2,
+    size_z: int = 3,
+    size_t: int = 2,
+    rois: int = 0,
+    shapes_per_roi: int = 1,
+    instrument: Optional[InstrumentI] = None,
+    planes: bool = True,
+) -> ImageI:
+    """Save an image with one plane per (z, c, t), ROIs cycling through the shape types and,
+    with ``instrument``, channel and objective settings referencing its components.
+    """
+    pixels = PixelsI()
+    pixels.setSizeX(rint(512))
+    pixels.setSizeY(rint(512))
+    pixels.setSizeC(rint(size_c))
+    pixels.setSizeZ(rint(size_z))
+    pixels.setSizeT(rint(size_t))
+    pixels.setPhysicalSizeX(LengthI(0.65, UnitsLength.MICROMETER))
+    pixels.setPhysicalSizeY(LengthI(0.65, UnitsLength.MICROMETER))
+    pixels.setPixelsType(store.enumeration("PixelsTypeI", "uint16"))
+    pixels.setDimensionOrder(store.enumeration("DimensionOrderI", "XYZCT"))
+
+    for c in range(size_c):
+        pixels.addChannel(build_channel(store, c, instrument))
+
+    if planes:
+        for t in range(size_t):
+            for c in range(size_c):
+                for z in range(size_z):
+                    plane = PlaneInfoI()
+                    plane.setTheC(rint(c))
+                    plane.setTheZ(rint(z))
+                    plane.setTheT(rint(t))
+                    plane.setDeltaT(TimeI(float(t), UnitsTime.SECOND))
+                    plane.setExposureTime(TimeI(0.1, UnitsTime.SECOND))
+                    plane.setPositionZ(LengthI(0.5 * z, UnitsLength.MICROMETER))
+                    pixels.addPlaneInfo(plane)
+
+    image = ImageI()
+    image.setName(rstring("synthetic"))
+    image.addPixels(pixels)
+
+    if instrument is not None:
+        image.setInstrument(instrument)
+        objectives = instrument.copyObjective()
+        if objectives:
+            objective_settings = ObjectiveSettingsI()
+            objective_settings.setObjective(objectives[0])
+            objective_settings.setRefractiveIndex(rdouble(1.518))
+            image.setObjectiveSettings(objective_settings)
+
+    image = store.save(image)
+
+    for r in range(rois):
+        roi = RoiI()
+        roi.setName(rstring(f"roi {r}"))
+        for s in range(shapes_per_roi):
+            roi.addShape(build_shape(SHAPE_BUILDERS[(r + s) % len(SHAPE_BUILDERS)], s, size_z, size_t))
+        roi.setImage(image)
+        store.save(roi)
+
+    return image
+
+
+def build_channel(store: FakeStore, index: int, instrument: Optional[InstrumentI] = None) -> ChannelI:
+    lch = LogicalChannelI()
+    lch.setName(rstring(f"channel {index}"))
+    lch.setEmissionWave(LengthI(450.0 + 50 * index, UnitsLength.NANOMETER))
+    lch.setIllumination(store.enumeration("IlluminationI", "Epifluorescence"))
+
+    if instrument is not None:
+        detectors, lasers, filters = instrument.copyDetector(), instrument.copyLightSource(), instrument.copyFilter()
+        if detectors:
+            detector_settings = DetectorSettingsI()
+            detector_settings.setDetector(detectors[index % len(detectors)])
+            lch.setDetectorSettings(detector_settings)
+        if lasers:
+            light_settings = LightSettingsI()
+            light_settings.setLightSource(lasers[index % len(lasers)])
+            lch.setLightSourceSettings(light_settings)
+        if filters:
+            light_path = LightPathI()
+            light_path.linkEmissionFilter(filters[index % len(filters)])
+            lch.setLightPath(light_path)
+
+    channel = ChannelI()
+    channel.setLogicalChannel(lch)
+    red, green, blue, alpha = CHANNEL_COLORS[index % len(CHANNEL_COLORS)]
+    channel.setRed(rint(red))
+    channel.setGreen(rint(green))
+    channel.setBlue(rint(blue))
+    channel.setAlpha(rint(alpha))
+    return channel
+
+
+def build_shape(shape_type: str, index: int, size_z: int = 1, size_t: int = 1):
+    x, y = 10.0 + index, 20.0 + index
+
+    if shape_type == "Rectangle":
+        shape = RectangleI()
+        shape.setX(rdouble(x))
+        shape.setY(rdouble(y))
+        shape.setWidth(rdouble(30.0))
+        shape.setHeight(rdouble(15.0))
+    elif shape_type == "Ellipse":
+        shape = EllipseI()
+        shape.setX(rdouble(x))
+        shape.setY(rdouble(y))
+        shape.setRadiusX(rdouble(8.0))
+        shape.setRadiusY(rdouble(4.0))
+    elif shape_type == "Point":
+        shape = PointI()
+        shape.setX(rdouble(x))
+        shape.setY(rdouble(y))
+    elif shape_type == "Polygon":
+        shape = PolygonI()
+        shape.setPoints(rstring(" ".join(f"{x + dx:.1f},{y + dy:.1f}" for dx, dy in ((0, 0), (10, 0), (10, 10), (0, 10)))))
+    elif shape_type == "Line":
+        shape = LineI()
+        shape.setX1(rdouble(x))
+        shape.setY1(rdouble(y))
+        shape.setX2(rdouble(x + 25))
+        shape.setY2(rdouble(y + 5))
+    else:
+        raise ValueError(f"Unknown shape type: {shape_type}")
+
+    shape.setTheZ(rint(index % size_z))
+    shape.setTheT(rint(index % size_t))
+    shape.setStrokeWidth(LengthI(1.0, UnitsLength.PIXEL))
+    return shape
+
+
+def populate(
+    store: FakeStore,
+    images: int = 10,
+    instruments: int = 1,
+    **kwargs,
+) -> List[int]:
+    """Save ``images`` images sharing ``instruments`` instruments round robin. Returns the image IDs.
+
+    Keyword arguments are passed to :func:`build_image`.
+    """
+    instrument_objs = [build_instrument(store) for _ in range(instruments)]
+
+    return [
+        build_image(store, instrument=instrument_objs[i % len(instrument_objs)] if instrument_objs else None, **kwargs)
+        .getId().getValue()
+        for i in range(images)
+    ]
+
+
+def build_plate(
+    store: FakeStore,
+    image_ids: List[int],
+    columns: int = 2,
+    row_convention: Optional[str] = "letter",
+    column_convention: Optional[str] = "number",
+) -> PlateI:
+    """Save a plate with one well per image, filled row by row with ``columns`` wells per row."""
+    plate = PlateI()
+    plate.setName(rstring("synthetic"))
+    if row_convention is not None:
+        plate.setRowNamingConvention(rstring(row_convention))
+    if column_convention is not None:
+        plate.setColumnNamingConvention(rstring(column_convention))
+    plate = store.save(plate)
+
+    for i, image_id in enumerate(image_ids):
+        well = WellI()
+        well.setPlate(PlateI(plate.getId().getValue(), False))
+        well.setRow(rint(i // columns))
+        well.setColumn(rint(i % columns))
+
+        sample = WellSampleI()
+        sample.setWell(well)
+        sample.setImage(ImageI(image_id, False))
+        store.save(sample)
+
+    return plate
+
+
+def write_ome_tiff(path: str, size_c: int = 2, size_z: int = 3, size_t: int = 2) -> None:
+    """Write a one pixel TIFF whose ImageDescription is a minimal OME-XML document, as exported by OMERO."""
+    description = (
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        '<OME xmlns="http://www.openmicroscopy.org/Schemas/OME/2016-06">'
+        '<Image ID="Image:0" Name="synthetic">'
+        f'<Pixels ID="Pixels:0" DimensionOrder="XYZCT" Type="uint8" SizeX="1" SizeY="1" '
+        f'SizeZ="{size_z}" SizeC="{size_c}" SizeT="{size_t}"><TiffData/></Pixels>'
+        '</Image></OME>'
+    ).encode() + b"\0"
+
+    # Little-endian header, one IFD, the description and one pixel
+    entries = [
+        (256, 3, 1, 1),  # ImageWidth
+        (257, 3, 1, 1),  # ImageLength
+        (258, 3, 1, 8),  # BitsPerSample
+        (259, 3, 1, 1),  # Compression
+        (262, 3, 1, 1),  # PhotometricInterpretation
+        (270, 2, len(description), None),  # ImageDescription
+        (273, 4, 1, None),  # StripOffsets
+        (277, 3, 1, 1),  # SamplesPerPixel
+        (278, 3, 1, 1),  # RowsPerStrip
+        (279, 4, 1, 1),  # StripByteCounts
+    ]
+    description_offset = 8 + 2 + 12 * len(entries) + 4
+    pixel_offset = description_offset + len(description)
+
+    ifd = struct.pack("<H", len(entries))
+    for tag, datatype, count, value in entries:
+        if tag == 270:
+            value = description_offset
+        elif tag == 273:
+            value = pixel_offset
+        ifd += struct.pack("<HHII", tag, datatype, count, value)
+    ifd += struct.pack("<I", 0)
+
+    with open(path, "wb") as fh:
+        fh.write(b"II" + struct.pack("<HI", 42, 8) + ifd + description + b"\0")
@@ -1,2 +1,5 @@
-from .pack import export_image_metadata
-from .unpack import attach_image_metadata, create_instruments
+from .pack import export_image_metadata, export_images_metadata
+from .unpack import attach_image_metadata, create_instruments, InstrumentIndex, TransferJournal
+from .masks import MaskStore
+from .tracing import Tracer, trace_connection, traced
+from .archive import ArchiveWriter, MetadataArchive, write_archive
@@ -0,0 +1,442 @@
+# Copyright (c) 2023 Qureator, Inc. All rights reserved.
+
+import json
+import logging
+import math
+import os
+import shutil
+from typing import Any, Dict, Iterator, List, Optional, Sequence
+from xml.etree import ElementTree
+
+import numpy as np
+from ome_types import OME, to_dict, to_xml
+from ome_types.model import Image, Instrument, Plane, ROI
+
+from .masks import MaskStore
+from .ome_xml import element_xml, parse_element
+from .pack.exports import MetadataWriter
+from .pack.exports.ome_index import OMEIndex
+from .pack.exports.plane_table import INDEX_COLUMNS, UNIT_TYPES, VALUE_COLUMNS, PlaneTable
+from .tracing import traced
+
+ARCHIVE_FORMAT = "omero-acquisition-transfer-archive"
+ARCHIVE_VERSION = 1
+
+# Shape geometry kept in columns instead of the ROI XML, by XML attribute
+SHAPE_FLOAT_COLUMNS = {
+    "X": "x",
+    "Y": "y",
+    "Width": "width",
+    "Height": "height",
+    "RadiusX": "radius_x",
+    "RadiusY": "radius_y",
+    "X1": "x1",
+    "Y1": "y1",
+    "X2": "x2",
+    "Y2": "y2",
+}
+SHAPE_INDEX_COLUMNS = {"TheZ": "the_z", "TheC": "the_c", "TheT": "the_t"}
+# Code of each shape type in the 'kind' column
+SHAPE_KINDS = ("Rectangle", "Ellipse", "Point", "Line", "Polyline", "Polygon", "Label", "Mask")
+
+
+class _Column:
+    """``.npy`` array appended to without knowing its final length, through a raw part file."""
+
+    def __init__(self, path: str, dtype: Any):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.length = 0
+        self._part = open(path + ".part", "wb")
+
+    def append(self, values: Any) -> None:
+        array = np.asarray(values, dtype=self.dtype)
+        self._part.write(array.tobytes())
+        self.length += array.size
+
+    def close(self) -> None:
+        self._part.close()
+        header = {
+            "descr": np.lib.format.dtype_to_descr(self.dtype),
+            "fortran_order": False,
+            "shape": (self.length,),
+        }
+        with open(self.path, "wb") as fh, open(self.path + ".part", "rb") as part:
+            np.lib.format.write_array_header_1_0(fh, header)
+            shutil.copyfileobj(part, fh)
+        os.remove(self.path + ".part")
+
+    def discard(self) -> None:
+        self._part.close()
+        os.remove(self.path + ".part")
+
+
+class _Blob:
+    """Byte strings concatenated in a uint8 column, with their offsets in another."""
+
+    def __init__(self, path: str):
+        self.data = _Column(f"{path}.npy", np.uint8)
+        self.offsets = _Column(f"{path}_offsets.npy", np.int64)
+        self.offsets.append([0])
+
+    def append(self, values: Sequence[bytes]) -> None:
+        start = self.data.length
+        self.data.append(np.frombuffer(b"".join(values), dtype=np.uint8))
+        self.offsets.append(start + np.cumsum([len(value) for value in values], dtype=np.int64))
+
+    def close(self) -> None:
+        self.data.close()
+        self.offsets.close()
+
+    def discard(self) -> None:
+        self.data.discard()
+        self.offsets.discard()
+
+
+class ArchiveWriter(MetadataWriter):
+    """Write packed metadata as a columnar archive directory instead of OME-XML.
+
+    Plane metadata and shape geometry are stored as NumPy columns. The parts
+    of images and ROIs without a column, e.g. names, channels or shape
+    colors, are stored as OME-XML fragments. Instruments and the rest of the
+    document go to ``ome.xml``. :class:`MetadataArchive` memory-maps the
+    columns and converts images back to ``ome_types`` models without loss.
+
+    Layout::
+
+        header.json                    format, version, image IDs and plane units
+        ome.xml                        document without its images and ROIs
+        images/xml.npy                 image fragments without the planes kept in columns
+        images/plane_offsets.npy       plane range of each image
+        images/roi_offsets.npy         range of each image in roi_indices
+        images/roi_indices.npy         positions of the ROIs referenced by the images
+        planes/<column>.npy            PlaneTable columns of all images
+        rois/xml.npy                   ROI fragments without the shape geometry
+        rois/shape_offsets.npy         shape range of each ROI
+        shapes/<column>.npy            kind, coordinates and Z, C, T of all shapes
+        shapes/points.npy              UTF-8 points of polygons and polylines
+
+    Each ``<name>.npy`` blob of bytes has its offsets in ``<name>_offsets.npy``.
+
+    Parameters
+    ----------
+    path : str
+        Archive directory, created if missing.
+
+    ome : ome_types.OME, optional
+        Document whose root attributes, instruments and other elements than
+        images and ROIs are stored. Its images and ROIs are not written.
+
+    plane_table : bool
+        Export planes as plane tables in :meth:`add_images`.
+
+    masks : MaskStore, optional
+        Sidecar receiving the bytes of exported masks instead of the ROI XML.
+
+    Examples
+    --------
+    >>> with ArchiveWriter("metadata.archive") as writer:
+    ...     writer.add_images(image_ids, conn)
+    >>> ome = MetadataArchive("metadata.archive").to_ome()
+    """
+
+    def __init__(
+        self,
+        path: str,
+        ome: Optional[OME] = None,
+        plane_table: bool = True,
+        masks: Optional[MaskStore] = None,
+    ):
+        super().__init__(OMEIndex((ome or OME()).copy(update={"images": [], "rois": []})), plane_table, masks)
+        self.path = path
+
+        for directory in ("images", "planes", "rois", "shapes"):
+            os.makedirs(os.path.join(path, directory), exist_ok=True)
+
+        self._image_ids: List[str] = []
+        self._positions: Dict[str, int] = {}
+        self._image_roi_ids: List[List[str]] = []
+        self._plane_units: List[Optional[Dict[str, Optional[str]]]] = []
+        self._roi_positions: Dict[str, int] = {}
+
+        def column(directory: str, name: str, dtype: Any) -> _Column:
+            return _Column(os.path.join(path, directory, f"{name}.npy"), dtype)
+
+        self._image_xml = _Blob(os.path.join(path, "images", "xml"))
+        self._plane_offsets = column("images", "plane_offsets", np.int64)
+        self._plane_offsets.append([0])
+        self._planes = {name: column("planes", name, np.int32) for name in INDEX_COLUMNS}
+        self._planes.update({name: column("planes", name, np.float64) for name in VALUE_COLUMNS})
+
+        self._roi_xml = _Blob(os.path.join(path, "rois", "xml"))
+        self._shape_offsets = column("rois", "shape_offsets", np.int64)
+        self._shape_offsets.append([0])
+        self._shapes = {"kind": column("shapes", "kind", np.uint8)}
+        self._shapes.update({name: column("shapes", name, np.float64) for name in SHAPE_FLOAT_COLUMNS.values()})
+        self._shapes.update({name: column("shapes", name, np.int32) for name in SHAPE_INDEX_COLUMNS.values()})
+        self._points = _Blob(os.path.join(path, "shapes", "points"))
+        self._closed = False
+
+    def write_image(self, image: Image, plane_table: Optional[PlaneTable] = None) -> None:
+        """Write an image, with the planes of ``plane_table`` instead of its own if given."""
+        if image.id in self._positions:
+            logging.warning(f"Skipping {image.id}, already written")
+            return
+        self._positions[image.id] = len(self._image_ids)
+
+        if plane_table is None and image.pixels.planes:
+            plane_table = _plane_table(image.pixels.planes)
+        if plane_table is not None and image.pixels.planes:
+            image = image.copy(update={"pixels": image.pixels.copy(update={"planes": []})})
+
+        self._image_xml.append([element_xml(image).strip().encode("utf-8")])
+        self._image_ids.append(image.id)
+        self._image_roi_ids.append([roi_ref.id for roi_ref in image.roi_ref])
+
+        if plane_table is None:
+            # Planes whose units vary stay in the fragment
+            self._plane_units.append(None)
+        else:
+            for name, column in self._planes.items():
+                column.append(plane_table.columns[name])
+            self._plane_units.append({
+                name: None if unit is None else unit.value for name, unit in plane_table.units.items()
+            })
+        self._plane_offsets.append([self._planes["the_c"].length])
+
+    def write_roi(self, roi: ROI) -> None:
+        if roi.id in self._roi_positions:
+            return
+        self._roi_positions[roi.id] = len(self._roi_positions)
+
+        elem = ElementTree.fromstring(element_xml(roi).strip())
+        union = elem.find("Union")
+        shapes = list(union) if union is not None else []
+
+        self._shapes["kind"].append([SHAPE_KINDS.index(shape.tag) for shape in shapes])
+        for attribute, name in SHAPE_FLOAT_COLUMNS.items():
+            values = [shape.attrib.pop(attribute, None) for shape in shapes]
+            self._shapes[name].append([math.nan if value is None else float(value) for value in values])
+        for attribute, name in SHAPE_INDEX_COLUMNS.items():
+            values = [shape.attrib.pop(attribute, None) for shape in shapes]
+            self._shapes[name].append([-1 if value is None else int(value) for value in values])
+        self._points.append([shape.attrib.pop("Points", "").encode("utf-8") for shape in shapes])
+        self._shape_offsets.append([self._shapes["kind"].length])
+
+        self._roi_xml.append([ElementTree.tostring(elem, encoding="unicode").encode("utf-8")])
+
+    @traced
+    def close(self) -> None:
+        if self._closed:
+            return
+        self._closed = True
+
+        roi_offsets = np.cumsum([0] + [len(roi_ids) for roi_ids in self._image_roi_ids], dtype=np.int64)
+        roi_indices = [
+            self._roi_positions.get(roi_id, -1) for roi_ids in self._image_roi_ids for roi_id in roi_ids
+        ]
+        np.save(os.path.join(self.path, "images", "roi_offsets.npy"), roi_offsets)
+        np.save(os.path.join(self.path, "images", "roi_indices.npy"), np.array(roi_indices, dtype=np.int64))
+
+        for column in (self._plane_offsets, self._shape_offsets, *self._planes.values(), *self._shapes.values()):
+            column.close()
+        for blob in (self._image_xml, self._roi_xml, self._points):
+            blob.close()
+
+        with open(os.path.join(self.path, "ome.xml"), "w", encoding="utf-8") as f:
+            f.write(to_xml(self._document.ome))
+
+        header = {
+            "format": ARCHIVE_FORMAT,
+            "version": ARCHIVE_VERSION,
+            "images": self._image_ids,
+            "plane_units": self._plane_units,
+        }
+        # Written last, an archive without a header is incomplete
+        with open(os.path.join(self.path, "header.json"), "w", encoding="utf-8") as f:
+            json.dump(header, f)
+        logging.info(f"Wrote {len(self._image_ids)} images and {len(self._roi_positions)} ROIs to archive {self.path}")
+
+    def discard(self) -> None:
+        """Remove the unfinished columns without writing the archive."""
+        self._closed = True
+        for column in (self._plane_offsets, self._shape_offsets, *self._planes.values(), *self._shapes.values()):
+            column.discard()
+        for blob in (self._image_xml, self._roi_xml, self._points):
+            blob.discard()
+
+
+def _plane_table(planes: List[Plane]) -> Optional[PlaneTable]:
+    # Planes with annotations or hashes have no column for them
+    if any(plane.annotation_ref or plane.hash_sha1 is not None for plane in planes):
+        return None
+    # Nor has the unit of a missing value, unless it is the default one
+    defaults = Plane(the_c=0, the_z=0, the_t=0)
+    if any(
+        getattr(plane, name) is None and getattr(plane, f"{name}_unit") != getattr(defaults, f"{name}_unit")
+        for plane in planes for name in VALUE_COLUMNS
+    ):
+        return None
+    return PlaneTable.from_planes(planes)
+
+
+class MetadataArchive:
+    """Read an archive written by :class:`ArchiveWriter`, one image at a time.
+
+    Columns are memory-mapped, so opening an archive reads only its header
+    and an image reads only its own rows and fragments.
+
+    Parameters
+    ----------
+    path : str
+        Archive directory.
+
+    mmap : bool
+        Memory-map the columns instead of loading them.
+
+    Examples
+    --------
+    >>> archive = MetadataArchive("metadata.archive")
+    >>> archive.plane_table("Image:1").columns["delta_t"]
+    >>> image = archive.image("Image:1")
+    >>> rois = archive.rois("Image:1")
+    """
+
+    def __init__(self, path: str, mmap: bool = True):
+        self.path = path
+
+        with open(os.path.join(path, "header.json"), encoding="utf-8") as f:
+            header = json.load(f)
+        if header.get("format") != ARCHIVE_FORMAT or header.get("version") != ARCHIVE_VERSION:
+            raise ValueError(f"{path} is not a version {ARCHIVE_VERSION} metadata archive")
+
+        self.image_ids: List[str] = header["images"]
+        self._positions = {image_id: position for position, image_id in enumerate(self.image_ids)}
+        self._plane_units = header["plane_units"]
+
+        def load(*names: str) -> np.ndarray:
+            return np.load(os.path.join(path, *names[:-1], f"{names[-1]}.npy"), mmap_mode="r" if mmap else None)
+
+        self._image_xml = load("images", "xml")
+        self._image_xml_offsets = load("images", "xml_offsets")
+        self._plane_offsets = load("images", "plane_offsets")
+        self._roi_offsets = load("images", "roi_offsets")
+        self._roi_indices = load("images", "roi_indices")
+        self.planes: Dict[str, np.ndarray] = {name: load("planes", name) for name in INDEX_COLUMNS + VALUE_COLUMNS}
+
+        self._roi_xml = load("rois", "xml")
+        self._roi_xml_offsets = load("rois", "xml_offsets")
+        self._shape_offsets = load("rois", "shape_offsets")
+        self.shapes: Dict[str, np.ndarray] = {
+            name: load("shapes", name)
+            for name in ("kind", *SHAPE_FLOAT_COLUMNS.values(), *SHAPE_INDEX_COLUMNS.values())
+        }
+        self._points = load("shapes", "points")
+        self._points_offsets = load("shapes", "points_offsets")
+
+    def __len__(self) -> int:
+        return len(self.image_ids)
+
+    def __contains__(self, image_id: str) -> bool:
+        return image_id in self._positions
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.image_ids)
+
+    def _position(self, image_id: str) -> int:
+        if image_id not in self._positions:
+            raise KeyError(f"{image_id} is not in archive {self.path}")
+        return self._positions[image_id]
+
+    def plane_table(self, image_id: str) -> Optional[PlaneTable]:
+        """Planes of an image as views of the columns. None if they are kept in the image fragment."""
+        position = self._position(image_id)
+        units = self._plane_units[position]
+        if units is None:
+            return None
+
+        start, stop = self._plane_offsets[position], self._plane_offsets[position + 1]
+        return PlaneTable(
+            {name: column[start:stop] for name, column in self.planes.items()},
+            {name: None if unit is None else UNIT_TYPES[name](unit) for name, unit in units.items()},
+        )
+
+    def roi_positions(self, image_id: str) -> np.ndarray:
+        position = self._position(image_id)
+        indices = self._roi_indices[self._roi_offsets[position]:self._roi_offsets[position + 1]]
+        return indices[indices >= 0]
+
+    def shape_columns(self, image_id: str) -> Dict[str, np.ndarray]:
+        """Geometry of the shapes of an image's ROIs, with the position of their ROI in 'roi'."""
+        roi_positions = self.roi_positions(image_id)
+        ranges = [np.arange(self._shape_offsets[roi], self._shape_offsets[roi + 1]) for roi in roi_positions]
+        rows = np.concatenate(ranges) if ranges else np.empty(0, dtype=np.int64)
+
+        columns = {name: column[rows] for name, column in self.shapes.items()}
+        columns["roi"] = np.repeat(roi_positions, [len(shape_rows) for shape_rows in ranges])
+        return columns
+
+    @traced
+    def image(self, image_id: str) -> Image:
+        position = self._position(image_id)
+        image = parse_element(_slice(self._image_xml, self._image_xml_offsets, position), "Image")
+
+        plane_table = self.plane_table(image_id)
+        if plane_table is not None:
+            image.pixels.planes = plane_table.to_planes()
+        return image
+
+    def rois(self, image_id: str) -> List[ROI]:
+        return [self.roi(position) for position in self.roi_positions(image_id)]
+
+    @traced
+    def roi(self, position: int) -> ROI:
+        elem = ElementTree.fromstring(_slice(self._roi_xml, self._roi_xml_offsets, position))
+        union = elem.find("Union")
+
+        start = int(self._shape_offsets[position])
+        for row, shape in enumerate(union if union is not None else [], start=start):
+            if SHAPE_KINDS[self.shapes["kind"][row]] != shape.tag:
+                raise ValueError(f"Shape {row} of archive {self.path} does not match its ROI")
+
+            for attribute, name in SHAPE_FLOAT_COLUMNS.items():
+                value = float(self.shapes[name][row])
+                if not math.isnan(value):
+                    shape.set(attribute, repr(value))
+            for attribute, name in SHAPE_INDEX_COLUMNS.items():
+                value = int(self.shapes[name][row])
+                if value >= 0:
+                    shape.set(attribute, str(value))
+            points = _slice(self._points, self._points_offsets, row)
+            if points:
+                shape.set("Points", points.decode("utf-8"))
+
+        return parse_element(ElementTree.tostring(elem), "ROI")
+
+    def instruments(self) -> List[Instrument]:
+        return [Instrument(**instrument) for instrument in self._rest().get("instruments", [])]
+
+    def _rest(self) -> Dict[str, Any]:
+        return to_dict(os.path.join(self.path, "ome.xml"), parser="lxml")
+
+    @traced
+    def to_ome(self) -> OME:
+        """The whole document, as written."""
+        rest = self._rest()
+        rest["images"] = [self.image(image_id) for image_id in self.image_ids]
+        rest["rois"] = [self.roi(position) for position in range(len(self._shape_offsets) - 1)]
+        return OME(**rest)
+
+
+def _slice(blob: np.ndarray, offsets: np.ndarray, position: int) -> bytes:
+    return blob[offsets[position]:offsets[position + 1]].tobytes()
+
+
+@traced
+def write_archive(ome: OME, path: str) -> None:
+    """Write a whole document as an archive, see :class:`ArchiveWriter`."""
+    with ArchiveWriter(path, ome) as writer:
+        for image in ome.images:
+            writer.write_image(image)
+        for roi in ome.rois:
+            writer.write_roi(roi)
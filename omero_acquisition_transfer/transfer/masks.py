@@ -0,0 +1,107 @@
+# Copyright (c) 2023 Qureator, Inc. All rights reserved.
+
+import base64
+import bz2
+import threading
+import zipfile
+import zlib
+from typing import List, Optional
+
+import numpy as np
+from ome_types.model import ROI, BinData, Mask
+from ome_types.model.bin_data import Compression
+
+
+class MaskStore:
+    """Mask bytes kept out of the OME-XML in an ``.npz`` sidecar, keyed by shape ID.
+
+    Each mask is written to its own ``.npy`` member as soon as it is added,
+    and read back only when requested, so neither side holds all masks in
+    memory. The bytes are OMERO's packed-bit mask payload, one bit per pixel.
+
+    Parameters
+    ----------
+    path : str
+        Path of the ``.npz`` file.
+    mode : str
+        'r' to read, 'w' to create or 'a' to append.
+
+    Examples
+    --------
+    >>> with MaskStore("masks.npz", "w") as masks:
+    ...     builder = OMEBuilder(masks=masks)
+    ...     builder.add_images(image_ids, conn)
+    """
+
+    def __init__(self, path: str, mode: str = "r"):
+        self.path = path
+        self._zip = zipfile.ZipFile(path, mode, compression=zipfile.ZIP_DEFLATED, allowZip64=True)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _member(shape_id: str) -> str:
+        return f"{shape_id.replace(':', '_')}.npy"
+
+    def __contains__(self, shape_id: str) -> bool:
+        return self._member(shape_id) in self._zip.NameToInfo
+
+    def put(self, shape_id: str, data: bytes) -> None:
+        with self._lock, self._zip.open(self._member(shape_id), "w", force_zip64=True) as fh:
+            np.lib.format.write_array(fh, np.frombuffer(data, dtype=np.uint8), allow_pickle=False)
+
+    def get(self, shape_id: str) -> Optional[bytes]:
+        if shape_id not in self:
+            return None
+
+        with self._lock, self._zip.open(self._member(shape_id)) as fh:
+            return np.lib.format.read_array(fh, allow_pickle=False).tobytes()
+
+    def close(self) -> None:
+        self._zip.close()
+
+    def __enter__(self) -> "MaskStore":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+def encode_mask(shape_id: str, data: bytes, masks: Optional[MaskStore] = None) -> BinData:
+    """Encode mask bytes as BinData.
+
+    With a store, the bytes go to the sidecar under the shape ID, which also
+    keeps their length, and the BinData is left empty with a length of 0 as
+    the schema requires for an empty value. Otherwise they are inlined,
+    zlib-compressed, with the length of the base64 text.
+    """
+    if masks is not None:
+        masks.put(shape_id, data)
+        return BinData(value="", length=0, big_endian=True)
+
+    value = base64.b64encode(zlib.compress(data)).decode("ascii")
+    return BinData(value=value, length=len(value), big_endian=True, compression=Compression.ZLIB)
+
+
+def decode_mask(shape_id: str, bin_data: BinData, masks: Optional[MaskStore] = None) -> bytes:
+    if not bin_data.value:
+        # Inlined masks are never empty, even without bytes, so the bytes are in the sidecar
+        data = None if masks is None else masks.get(shape_id)
+        if data is None:
+            raise ValueError(f"Mask bytes of {shape_id} are not in the mask store")
+        return data
+
+    data = base64.b64decode(bin_data.value)
+    if bin_data.compression == Compression.ZLIB:
+        data = zlib.decompress(data)
+    elif bin_data.compression == Compression.BZIP2:
+        data = bz2.decompress(data)
+
+    return data
+
+
+def externalize_masks(rois: List[ROI], masks: MaskStore) -> None:
+    # Move inlined mask bytes into the store, e.g. for ROIs exported without one
+    for roi in rois:
+        for shape in roi.union:
+            if isinstance(shape, Mask) and shape.bin_data.value:
+                shape.bin_data = encode_mask(shape.id, decode_mask(shape.id, shape.bin_data), masks)
@@ -0,0 +1,76 @@
+# Copyright (c) 2023 Qureator, Inc. All rights reserved.
+"""OME-XML of single top level elements, for formats that store or stream them one at a time."""
+
+import re
+from typing import Any, Dict, Tuple, Type, Union
+
+from ome_types import OME, to_dict, to_xml
+from ome_types.model import Image, Instrument, ROI
+
+from .tracing import traced
+
+URI_OME = "http://www.openmicroscopy.org/Schemas/OME/2016-06"
+
+# OME field and model of the top level elements handled one at a time, in schema order
+OME_ELEMENTS: Dict[str, Tuple[str, Type]] = {
+    "Instrument": ("instruments", Instrument),
+    "Image": ("images", Image),
+    "ROI": ("rois", ROI),
+}
+
+OMEElement = Union[Instrument, Image, ROI]
+
+_XML_DECLARATION = re.compile(r"^\s*<\?xml[^>]*\?>\s*")
+
+
+def split_root(xml: str) -> Tuple[str, str]:
+    """Split ``to_xml`` output into the OME start tag and its children.
+
+    Attribute values are escaped, so the first '>' ends the start tag.
+    """
+    xml = _XML_DECLARATION.sub("", xml, count=1).rstrip()
+    start_end = xml.index(">") + 1
+    if xml[start_end - 2] == "/":
+        return xml[:start_end - 2].rstrip() + ">", ""
+    return xml[:start_end], xml[start_end:xml.rindex("</")]
+
+
+def element_xml(element: OMEElement) -> str:
+    """OME-XML of one instrument, image or ROI, indented and on a new line like ``to_xml`` writes it.
+
+    The element is in the OME default namespace without declaring it, i.e.
+    meant to be written inside an OME root element.
+    """
+    field, _ = OME_ELEMENTS[type(element).__name__]
+    # Constructed without validation, as OME rejects references to elements outside of it
+    _, body = split_root(to_xml(OME.construct(**{field: [element]})))
+    return "\n" + body.strip("\r\n")
+
+
+@traced
+def parse_element(xml: bytes, tag: str) -> OMEElement:
+    """Parse and validate the OME-XML of one instrument, image or ROI.
+
+    ``xml`` is in the OME default namespace, declared or not.
+    """
+    field, model = OME_ELEMENTS[tag]
+    document = f'<OME xmlns="{URI_OME}">'.encode() + xml + b"</OME>"
+    data = to_dict(document, parser="lxml")[field][0]
+    _fill_empty_bin_data(data)
+    return model(**data)
+
+
+def _fill_empty_bin_data(data: Any) -> None:
+    # The lxml parser leaves out the value of empty BinData, e.g. of masks kept in a MaskStore
+    if isinstance(data, dict):
+        bin_data = data.get("bin_data")
+        if isinstance(bin_data, dict):
+            bin_data.setdefault("value", "")
+        values = data.values()
+    elif isinstance(data, list):
+        values = data
+    else:
+        return
+
+    for value in values:
+        _fill_empty_bin_data(value)
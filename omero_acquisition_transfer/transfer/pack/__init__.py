@@ -6,11 +6,20 @@ from .exports import roi
 
 from .exports import (
     export_image_metadata,
+    export_images_metadata,
     export_instrument_metadata,
     export_channel_metadata,
     export_pixels_metadata,
     export_imaging_environment_metadata,
     export_objective_settings_metadata,
     export_stage_label_metadata,
+    prefetch_images,
+    MetadataWriter,
+    OMEBuilder,
+    OMEIndex,
+    OMEXMLWriter,
 )
-from .pack_utils import merge_metadata_tiff, move_tiff_files
+from .pack_utils import merge_metadata_tiff, merge_metadata_tiffs, move_tiff_files
+from .cache import MetadataCache, export_images_metadata_cached, image_versions
+from .hierarchy import resolve_image_ids
+from .parallel import export_metadata_parallel
@@ -0,0 +1,266 @@
+# Copyright (c) 2023 Qureator, Inc. All rights reserved.
+
+import json
+import logging
+import pickle
+import sqlite3
+import threading
+from collections import defaultdict
+from typing import Any, Dict, List, Optional, Union
+
+import ome_types
+from ome_types import OME
+from ome_types.model import Image
+from omero.gateway import BlitzGateway
+from omero.rtypes import unwrap
+from omero.sys import ParametersI
+
+from ..masks import externalize_masks
+from ..tracing import traced
+from .exports import OMEIndex, export_image_metadata, iter_prefetched_images
+
+# Bump when the layout of cached fragments changes
+CACHE_FORMAT = 1
+
+# Rows of (image ID, ...) whose remaining columns change whenever the exported
+# image changes. Counts catch deleted children, which leave the maxima as is.
+IMAGE_VERSION_QUERIES = (
+    "select i.id, i.details.updateEvent.id, os.details.updateEvent.id, ie.details.updateEvent.id, "
+    "sl.details.updateEvent.id, ins.id "
+    "from Image as i "
+    "left outer join i.objectiveSettings as os "
+    "left outer join i.imagingEnvironment as ie "
+    "left outer join i.stageLabel as sl "
+    "left outer join i.instrument as ins "
+    "where i.id in (:ids)",
+    "select p.image.id, max(p.details.updateEvent.id), count(p) from Pixels as p "
+    "where p.image.id in (:ids) group by p.image.id",
+    "select p.image.id, max(c.details.updateEvent.id), max(lc.details.updateEvent.id), count(c) "
+    "from Channel as c join c.pixels as p join c.logicalChannel as lc "
+    "where p.image.id in (:ids) group by p.image.id",
+    "select p.image.id, max(lp.details.updateEvent.id), max(ds.details.updateEvent.id), "
+    "max(ls.details.updateEvent.id), max(fs.details.updateEvent.id) "
+    "from Channel as c join c.pixels as p join c.logicalChannel as lc "
+    "left outer join lc.lightPath as lp "
+    "left outer join lc.detectorSettings as ds "
+    "left outer join lc.lightSourceSettings as ls "
+    "left outer join lc.filterSet as fs "
+    "where p.image.id in (:ids) group by p.image.id",
+    "select p.image.id, max(l.details.updateEvent.id), count(l) "
+    "from Channel as c join c.pixels as p join c.logicalChannel as lc "
+    "join lc.lightPath as lp join lp.emissionFilterLink as l "
+    "where p.image.id in (:ids) group by p.image.id",
+    "select p.image.id, max(l.details.updateEvent.id), count(l) "
+    "from Channel as c join c.pixels as p join c.logicalChannel as lc "
+    "join lc.lightPath as lp join lp.excitationFilterLink as l "
+    "where p.image.id in (:ids) group by p.image.id",
+    "select p.image.id, max(pi.details.updateEvent.id), count(pi) from PlaneInfo as pi join pi.pixels as p "
+    "where p.image.id in (:ids) group by p.image.id",
+    "select r.image.id, max(r.details.updateEvent.id), count(r) from Roi as r "
+    "where r.image.id in (:ids) group by r.image.id",
+    "select r.image.id, max(s.details.updateEvent.id), count(s) from Shape as s join s.roi as r "
+    "where r.image.id in (:ids) group by r.image.id",
+)
+# Rows of (instrument ID, ...), same as above for the components of instruments
+INSTRUMENT_VERSION_QUERIES = (
+    "select ins.id, ins.details.updateEvent.id, m.details.updateEvent.id from Instrument as ins "
+    "left outer join ins.microscope as m where ins.id in (:ids)",
+    "select d.instrument.id, max(d.details.updateEvent.id), count(d) from Detector as d "
+    "where d.instrument.id in (:ids) group by d.instrument.id",
+    "select o.instrument.id, max(o.details.updateEvent.id), count(o) from Objective as o "
+    "where o.instrument.id in (:ids) group by o.instrument.id",
+    "select f.instrument.id, max(f.details.updateEvent.id), count(f) from Filter as f "
+    "where f.instrument.id in (:ids) group by f.instrument.id",
+    "select d.instrument.id, max(d.details.updateEvent.id), count(d) from Dichroic as d "
+    "where d.instrument.id in (:ids) group by d.instrument.id",
+    "select l.instrument.id, max(l.details.updateEvent.id), count(l) from LightSource as l "
+    "where l.instrument.id in (:ids) group by l.instrument.id",
+)
+
+
+class MetadataCache:
+    """On-disk SQLite cache of exported OME fragments.
+
+    Fragments are keyed by (server, object type, ID) and stored with a version,
+    e.g. from :func:`image_versions`. A fragment is only served while its
+    version, the cache format and the ome_types version are unchanged.
+
+    Parameters
+    ----------
+    path : str
+        Path of the SQLite database, created if missing.
+
+    Examples
+    --------
+    >>> with MetadataCache("metadata.sqlite") as cache:
+    ...     export_images_metadata_cached(image_ids, conn, ome, cache)
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("pragma journal_mode=wal")
+        self._db.execute(
+            "create table if not exists fragments ("
+            "server text not null, kind text not null, id integer not null, "
+            "version text not null, format text not null, data blob not null, "
+            "primary key (server, kind, id))"
+        )
+        self._db.commit()
+        self._format = f"{CACHE_FORMAT}:{ome_types.__version__}"
+
+    def get(self, server: str, kind: str, id_: int, version: str) -> Optional[Any]:
+        with self._lock:
+            row = self._db.execute(
+                "select data from fragments where server = ? and kind = ? and id = ? and version = ? and format = ?",
+                (server, kind, id_, version, self._format),
+            ).fetchone()
+
+        return None if row is None else pickle.loads(row[0])
+
+    def put(self, server: str, kind: str, id_: int, version: str, fragment: Any) -> None:
+        data = pickle.dumps(fragment, protocol=pickle.HIGHEST_PROTOCOL)
+
+        with self._lock:
+            self._db.execute(
+                "insert or replace into fragments (server, kind, id, version, format, data) values (?, ?, ?, ?, ?, ?)",
+                (server, kind, id_, version, self._format, data),
+            )
+            self._db.commit()
+
+    def invalidate(self, server: Optional[str] = None, kind: Optional[str] = None, id_: Optional[int] = None) -> None:
+        clauses = [(column, value) for column, value in (("server", server), ("kind", kind), ("id", id_)) if value is not None]
+        where = " and ".join(f"{column} = ?" for column, _ in clauses) or "1 = 1"
+
+        with self._lock:
+            self._db.execute(f"delete from fragments where {where}", [value for _, value in clauses])
+            self._db.commit()
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+    def __enter__(self) -> "MetadataCache":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+def server_key(conn: BlitzGateway) -> str:
+    host = conn.c.getProperty("omero.host")
+    port = conn.c.getProperty("omero.port") or "4064"
+    return f"{host}:{port}"
+
+
+def image_versions(image_ids: List[int], conn: BlitzGateway) -> Dict[int, str]:
+    """Version of the exported metadata of many images with a fixed number of projection queries.
+
+    Parameters
+    ----------
+    image_ids : List[int]
+        Image IDs.
+    conn : omero.gateway.BlitzGateway
+        OMERO connection.
+
+    Returns
+    -------
+    versions : Dict[int, str]
+        Version by image ID. Missing images are skipped.
+    """
+    columns = _query_versions(IMAGE_VERSION_QUERIES, image_ids, conn)
+
+    # The instrument ID is the last column of the first query
+    instrument_ids = {image_id: values[0][-1] for image_id, values in columns.items() if values[0] is not None}
+    instrument_columns = _query_versions(
+        INSTRUMENT_VERSION_QUERIES, sorted(set(filter(None, instrument_ids.values()))), conn
+    )
+
+    versions = {}
+    for image_id in image_ids:
+        if image_id not in columns or columns[image_id][0] is None:
+            continue
+
+        instrument_id = instrument_ids[image_id]
+        instrument_version = None if instrument_id is None else instrument_columns.get(instrument_id)
+        versions[image_id] = json.dumps([columns[image_id], instrument_version])
+
+    return versions
+
+
+def _query_versions(queries, ids: List[int], conn: BlitzGateway) -> Dict[int, List[Optional[List[Any]]]]:
+    columns = defaultdict(lambda: [None] * len(queries))
+    if not ids:
+        return columns
+
+    query_service = conn.getQueryService()
+    for position, query in enumerate(queries):
+        for row in query_service.projection(query, ParametersI().addIds(ids), conn.SERVICE_OPTS):
+            id_, *values = [unwrap(value) for value in row]
+            columns[id_][position] = values
+
+    return columns
+
+
+@traced
+def export_images_metadata_cached(
+        image_ids: List[int],
+        conn: BlitzGateway,
+        ome: Union[OME, OMEIndex],
+        cache: MetadataCache,
+        batch_size: int = 100,
+        plane_table: bool = False,
+) -> List[Image]:
+    """Export images like ``export_images_metadata``, serving unchanged images from ``cache``.
+
+    Each image is cached as a fragment with its instrument and ROIs. Only images
+    whose version changed since they were cached are fetched from the server.
+    Mask bytes are cached inline and moved to the mask store of ``ome``, if any.
+    """
+    index = OMEIndex.of(ome)
+    server = server_key(conn)
+
+    images = []
+    hits = 0
+    for start in range(0, len(image_ids), batch_size):
+        batch = image_ids[start:start + batch_size]
+        versions = image_versions(batch, conn)
+
+        fragments: Dict[int, OMEIndex] = {}
+        misses = []
+        for image_id in batch:
+            if image_id not in versions:
+                continue
+
+            fragment = cache.get(server, "Image", image_id, versions[image_id])
+            if fragment is None:
+                misses.append(image_id)
+            else:
+                fragments[image_id] = fragment
+                hits += 1
+
+        for image_obj in iter_prefetched_images(misses, conn, batch_size=batch_size, plane_tables=plane_table):
+            fragment = OMEIndex()
+            export_image_metadata(image_obj, conn, fragment, in_place=True, plane_table=plane_table)
+
+            cache.put(server, "Image", image_obj.getId(), versions[image_obj.getId()], fragment)
+            fragments[image_obj.getId()] = fragment
+
+        for image_id in batch:
+            if image_id not in fragments:
+                continue
+
+            fragment = fragments[image_id]
+            if index.masks is not None:
+                externalize_masks(fragment.ome.rois, index.masks)
+            index.merge(fragment)
+            images.append(index.get_image(image_id))
+
+    logging.info(f"Served {hits} of {len(images)} images from the metadata cache")
+
+    if index is not ome:
+        index.materialize_planes()
+        index.plane_tables.clear()
+
+    return images
@@ -1,3 +1,4 @@
+from .builder import OMEBuilder
 from .channel import (
     export_channel_metadata,
     export_detector_metadata,
@@ -8,6 +9,7 @@ from .channel import (
 from .common import convert_units
 from .image import (
     export_image_metadata,
+    export_images_metadata,
     export_objective_settings_metadata,
     export_pixels_metadata,
     export_imaging_environment_metadata,
@@ -22,4 +24,9 @@ from .instrument import (
     export_objectives_metadata,
     export_light_sources_metadata
 )
+from .ome_index import OMEIndex
+from .plane_table import PlaneTable, load_plane_table, load_plane_tables
+from .prefetch import prefetch_images, iter_prefetched_images, PrefetchedImageWrapper
+from .writer import MetadataWriter, OMEXMLWriter
 
+from .roi import export_attach_rois_metadata, iter_rois_metadata, iter_roi_objects
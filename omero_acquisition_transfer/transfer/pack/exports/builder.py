@@ -0,0 +1,40 @@
+# Copyright (c) 2023 Qureator, Inc. All rights reserved.
+
+from typing import List, Optional
+
+from ome_types import OME
+from ome_types.model import Image
+from omero.gateway import BlitzGateway, ImageWrapper
+
+from ...masks import MaskStore
+from .image import export_image_metadata, export_images_metadata
+from .ome_index import OMEIndex
+
+
+class OMEBuilder(OMEIndex):
+    """Incrementally pack many images into one OME document in linear time.
+
+    Examples
+    --------
+    >>> builder = OMEBuilder()
+    >>> for image_obj in dataset.listChildren():
+    ...     builder.add_image(image_obj, conn)
+    >>> ome = builder.build()
+
+    With ``plane_table=True`` planes are loaded as :class:`PlaneTable` columns
+    and only turned into ``Plane`` models by :meth:`build`.
+    """
+
+    def __init__(self, ome: Optional[OME] = None, plane_table: bool = False, masks: Optional[MaskStore] = None):
+        super().__init__(ome, masks)
+        self.plane_table = plane_table
+
+    def add_image(self, image_obj: ImageWrapper, conn: BlitzGateway) -> Image:
+        return export_image_metadata(image_obj, conn, self, in_place=True, plane_table=self.plane_table)
+
+    def add_images(self, image_ids: List[int], conn: BlitzGateway, batch_size: int = 100) -> List[Image]:
+        return export_images_metadata(image_ids, conn, self, batch_size=batch_size, plane_table=self.plane_table)
+
+    def build(self) -> OME:
+        self.materialize_planes()
+        return self.ome
@@ -15,9 +15,11 @@ from omero.model import (
     LightSettingsI, LightPathI,
 )
 
-from .common import convert_units
+from ...tracing import traced
+from .common import convert_units, wrapped
 
 
+@traced
 def export_channel_metadata(ch_obj: ChannelWrapper):
     lch_obj = ch_obj.getLogicalChannel()
 
@@ -48,8 +50,10 @@ def export_channel_metadata(ch_obj: ChannelWrapper):
         fluor=fluor,
         nd_filter=nd_filter,
         pockel_cell_setting=pockel_cell_setting,
-        color=color,
     )
+    # Unknown without a rendering engine, the schema default is kept
+    if color is not None:
+        channel.color = color
 
     # Light path should be called before light source settings
     channel.light_path = export_light_path_metadata(lch_obj.getLightPath())
@@ -59,9 +63,10 @@ def export_channel_metadata(ch_obj: ChannelWrapper):
     return channel
 
 
+@traced
 def export_light_path_metadata(lp_obj: LightPathI) -> Optional[LightPath]:
     if lp_obj is not None:
-        if lp_obj.getDichroic() is not None:
+        if wrapped(lp_obj.getDichroic()) is not None:
             dichroic: Optional[int] = lp_obj.getDichroic().getId()
             dichroic_ref: Optional[DichroicRef] = DichroicRef(id=dichroic)
         else:
@@ -85,6 +90,7 @@ def export_light_path_metadata(lp_obj: LightPathI) -> Optional[LightPath]:
     return None
 
 
+@traced
 def export_light_source_settings_metadata(lss_obj: LightSettingsI) -> Optional[LightSettingsI]:
     if lss_obj._obj is not None and lss_obj.getLightSource() is not None:
         # Add light source settings
@@ -105,6 +111,7 @@ def export_light_source_settings_metadata(lss_obj: LightSettingsI) -> Optional[L
     return None
 
 
+@traced
 def export_detector_settings_metadata(det_set_obj: DetectorSettingsI) -> Optional[DetectorSettings]:
     if det_set_obj._obj is not None and det_set_obj.getDetector() is not None:
         # Add detector
@@ -120,7 +127,7 @@ def export_detector_settings_metadata(det_set_obj: DetectorSettingsI) -> Optiona
         zoom: Optional[float] = det_set_obj.getZoom()
         read_out_rate: Optional[float] = None if not det_set_obj.getReadOutRate() else det_set_obj.getReadOutRate().getValue()
         read_out_rate_unit: Optional[str] = None if not det_set_obj.getReadOutRate() else det_set_obj.getReadOutRate().getUnit()
-        binning: Optional[str] = None if not det_set_obj.getBinning() else det_set_obj.getBinning().getValue()
+        binning: Optional[str] = None if not wrapped(det_set_obj.getBinning()) else det_set_obj.getBinning().getValue()
         integration: Optional[int] = det_set_obj.getIntegration()
 
         detector_settings = DetectorSettings(
@@ -144,6 +151,7 @@ def export_detector_settings_metadata(det_set_obj: DetectorSettingsI) -> Optiona
     return None
 
 
+@traced
 def export_detector_metadata(det_obj: DetectorI) -> Detector:
     gain: Optional[float] = det_obj.getGain()
     voltage: Optional[float] = None if not det_obj.getVoltage() else det_obj.getVoltage().getValue()
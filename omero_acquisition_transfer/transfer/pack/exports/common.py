@@ -11,3 +11,8 @@ unit_converter = {
 
 def convert_units(unit):
     return unit_converter.get(str(unit), unit)
+
+
+def wrapped(obj):
+    """``obj``, or None for a wrapper of nothing, as ``omero.gateway`` wraps unset links."""
+    return None if obj is None or obj._obj is None else obj
@@ -2,7 +2,7 @@
 
 from datetime import datetime
 import logging
-from typing import Optional, List
+from typing import Optional, List, Union
 
 from ome_types import OME
 from ome_types.model import (
@@ -28,56 +28,111 @@ from omero.model import (
     PlaneInfoI,
 )
 
+from ...tracing import traced
 from .channel import export_channel_metadata
 from .common import convert_units
 from .instrument import export_instrument_metadata, append_instrument_metadata
+from .ome_index import OMEIndex
+from .plane_table import PlaneTable, load_plane_table
+from .prefetch import iter_prefetched_images, PrefetchedImageWrapper
 from .roi import export_attach_rois_metadata
 
 
-def export_image_metadata(image_obj: ImageWrapper, conn: BlitzGateway, ome: OME, in_place: bool = True) -> Image:
+@traced
+def export_images_metadata(
+        image_ids: List[int],
+        conn: BlitzGateway,
+        ome: Union[OME, OMEIndex],
+        batch_size: int = 100,
+        plane_table: bool = False,
+        roi_page_size: Optional[int] = None,
+        roi_projection: bool = False,
+) -> List[Image]:
+    # Load the acquisition graphs with a few queries per batch instead of lazy loads per getter
+    index = OMEIndex.of(ome)
+    # ROIs exported page by page are not prefetched
+    prefetch_rois = roi_page_size is None and not roi_projection
+
+    images = []
+    for image_obj in iter_prefetched_images(
+            image_ids, conn, batch_size=batch_size, plane_tables=plane_table, rois=prefetch_rois
+    ):
+        images.append(export_image_metadata(
+            image_obj, conn, index, in_place=True, plane_table=plane_table,
+            roi_page_size=roi_page_size, roi_projection=roi_projection,
+        ))
+
+    if index is not ome:
+        index.materialize_planes()
+        # The planes are in the document, the reused index of a plain OME keeps no tables
+        index.plane_tables.clear()
+
+    return images
+
+
+@traced
+def export_image_metadata(
+        image_obj: ImageWrapper,
+        conn: BlitzGateway,
+        ome: Union[OME, OMEIndex],
+        in_place: bool = True,
+        plane_table: bool = False,
+        roi_page_size: Optional[int] = None,
+        roi_projection: bool = False,
+) -> Image:
     assert image_obj.getId() is not None, "no image ID"
     assert image_obj.getPrimaryPixels().getId() is not None, "no Pixels ID"
 
+    index = OMEIndex.of(ome)
+
     id_: int = image_obj.getId()
     name: Optional[str] = image_obj.getName()
     acquisition_date: Optional[datetime] = image_obj.getAcquisitionDate()
     desc: Optional[str] = image_obj.getDescription()
 
-    pixels: Pixels = export_pixels_metadata(image_obj)
-    rois_ref: Optional[List[ROIRef]] = export_attach_rois_metadata(image_obj, conn, ome)
+    table: Optional[PlaneTable] = None
+    if plane_table:
+        if isinstance(image_obj, PrefetchedImageWrapper):
+            table = image_obj.getPrefetchedPlaneTable()
+        else:
+            table = load_plane_table(image_obj.getPrimaryPixels().getId(), conn)
+
+    pixels: Pixels = export_pixels_metadata(image_obj, include_planes=table is None)
+    rois_ref: Optional[List[ROIRef]] = export_attach_rois_metadata(
+        image_obj, conn, index, page_size=roi_page_size, projection=roi_projection
+    )
 
-    indices = [int(img.id.split(':')[-1]) for img in ome.images]
+    image = index.get_image(id_)
 
-    if id_ not in indices:
+    if image is None:
         image = Image(
             id=id_,
             name=name,
             acquisition_date=acquisition_date,
             description=desc,
             pixels=pixels,
-            # roi_ref=rois_ref,
+            roi_ref=rois_ref,
         )
         logging.info(f"Adding image {id_} to OME")
     else:
-        image = ome.images[indices.index(id_)]
         image.name = name
         image.acquisition_date = acquisition_date
         image.description = desc
         image.pixels = pixels
-        # image.roi_ref = roi_ref # Not implemented
+        image.roi_ref = rois_ref
         logging.info(f"Updating image {id_} in OME")
 
     if image_obj.getInstrument() is not None:
         instrument_ref: Optional[InstrumentRef] = InstrumentRef(id=image_obj.getInstrument().getId())
 
-        if instrument_ref.id not in [ins.id for ins in ome.instruments]:
-            ome.instruments.append(export_instrument_metadata(image_obj.getInstrument()))
+        if instrument_ref.id not in index.instruments:
+            index.put_instrument(export_instrument_metadata(image_obj.getInstrument()))
 
         image.instrument_ref = instrument_ref
 
         # There are some exceptional cases -- Light path has dichroic not within instrument
         # MIP images?
-        append_instrument_metadata(ome, image_obj)
+        append_instrument_metadata(index, image_obj, instrument_ref.id)
 
     if image_obj.getObjectiveSettings() is not None:
         objective_settings: Optional[ObjectiveSettings] = export_objective_settings_metadata(image_obj.getObjectiveSettings())
@@ -92,11 +147,17 @@ def export_image_metadata(image_obj: ImageWrapper, conn: BlitzGateway, ome: OME,
         image.stage_label = stage_label
 
     if in_place:
-        ome.images.append(image)
+        index.put_image(image)
+        index.put_plane_table(id_, table)
+
+        if index is not ome:
+            index.materialize_planes()
+            index.plane_tables.clear()
 
     return image
 
 
+@traced
 def export_plane_metadata(pi_obj: PlaneInfoI) -> Plane:
     plane = Plane(
         the_c=pi_obj.getTheC(),
@@ -127,6 +188,7 @@ def export_plane_metadata(pi_obj: PlaneInfoI) -> Plane:
     return plane
 
 
+@traced
 def export_stage_label_metadata(sl_obj: StageLabelI) -> Optional[StageLabel]:
     if sl_obj:
         name: str = sl_obj.getName()
@@ -155,6 +217,7 @@ def export_stage_label_metadata(sl_obj: StageLabelI) -> Optional[StageLabel]:
     return None
 
 
+@traced
 def export_objective_settings_metadata(os_obj: ObjectiveSettingsI) -> Optional[ObjectiveSettings]:
     if os_obj:
         id_: int = os_obj.getObjective().getId()
@@ -173,6 +236,7 @@ def export_objective_settings_metadata(os_obj: ObjectiveSettingsI) -> Optional[O
     return None
 
 
+@traced
 def export_imaging_environment_metadata(ie_obj: ImagingEnvironmentI) -> Optional[ImagingEnvironment]:
     if ie_obj:
         id_: int = ie_obj.getId()
@@ -200,7 +264,8 @@ def export_imaging_environment_metadata(ie_obj: ImagingEnvironmentI) -> Optional
     return None
 
 
-def export_pixels_metadata(image_obj: ImageWrapper) -> Pixels:
+@traced
+def export_pixels_metadata(image_obj: ImageWrapper, include_planes: bool = True) -> Pixels:
     pix_obj: PixelsI = image_obj.getPrimaryPixels()
     pixel_type = image_obj.getPixelsType()
     try:
@@ -233,9 +298,10 @@ def export_pixels_metadata(image_obj: ImageWrapper) -> Pixels:
         channel = export_channel_metadata(ch_obj)
         pixels.channels.append(channel)
 
-    for pi_obj in image_obj.getPrimaryPixels().copyPlaneInfo():
-        plane: Optional[Plane] = export_plane_metadata(pi_obj)
-        pixels.planes.append(plane)
+    if include_planes:
+        for pi_obj in image_obj.getPrimaryPixels().copyPlaneInfo():
+            plane: Optional[Plane] = export_plane_metadata(pi_obj)
+            pixels.planes.append(plane)
 
     return pixels
 
@@ -1,6 +1,6 @@
 # Copyright (c) 2023 Qureator, Inc. All rights reserved.
 
-from typing import Optional, List
+from typing import Optional, List, Union
 
 from ome_types import OME
 from ome_types.model import (
@@ -23,10 +23,18 @@ from omero.model import (
 )
 from omero.gateway import ImageWrapper
 
-from .common import convert_units
+from ...tracing import traced
+from .common import convert_units, wrapped
+from .ome_index import OMEIndex, ome_id
 
 
-def append_instrument_metadata(ome: OME, image_obj: ImageWrapper) -> None:
+def append_instrument_metadata(
+        ome: Union[OME, OMEIndex], image_obj: ImageWrapper, instrument_id: Optional[str] = None
+) -> None:
+    index = OMEIndex.of(ome)
+    if instrument_id is None:
+        instrument_id = index.ome.instruments[0].id
+
     for ch_obj in image_obj.getChannels():
         lch_obj = ch_obj.getLogicalChannel()
         if lch_obj is None:
@@ -36,19 +44,20 @@ def append_instrument_metadata(ome: OME, image_obj: ImageWrapper) -> None:
         if lp_obj is None:
             continue
 
-        dichroic_obj = lp_obj.getDichroic()
-        if dichroic_obj is not None and dichroic_obj.getId() not in ome.instruments[0].dichroics:
-            ome.instruments[0].dichroics.append(export_dichroic_metadata(dichroic_obj))
+        dichroic_obj = wrapped(lp_obj.getDichroic())
+        if dichroic_obj is not None and ome_id('Dichroic', dichroic_obj.getId()) not in index.dichroics:
+            index.put_dichroic(instrument_id, export_dichroic_metadata(dichroic_obj))
 
         for filter_obj in lp_obj.getEmissionFilters():
-            if filter_obj.getId() not in ome.instruments[0].filters:
-                ome.instruments[0].filters.append(export_filter_metadata(filter_obj))
+            if ome_id('Filter', filter_obj.getId()) not in index.filters:
+                index.put_filter(instrument_id, export_filter_metadata(filter_obj))
 
         for filter_obj in lp_obj.getExcitationFilters():
-            if filter_obj.getId() not in ome.instruments[0].filters:
-                ome.instruments[0].filters.append(export_filter_metadata(filter_obj))
+            if ome_id('Filter', filter_obj.getId()) not in index.filters:
+                index.put_filter(instrument_id, export_filter_metadata(filter_obj))
 
 
+@traced
 def export_instrument_metadata(instrument_obj: InstrumentI) -> Instrument:
     if not instrument_obj:
         return Instrument()
@@ -96,6 +105,7 @@ def export_instrument_metadata(instrument_obj: InstrumentI) -> Instrument:
     return instrument
 
 
+@traced
 def export_microscope_metadata(microscope_obj: MicroscopeI) -> Optional[Microscope]:
     if microscope_obj is not None:
         id_: str = microscope_obj.getId()
@@ -121,6 +131,7 @@ def export_microscope_metadata(microscope_obj: MicroscopeI) -> Optional[Microsco
     return None
 
 
+@traced
 def export_light_sources_metadata(lss_obj: List) -> Optional[List[LightSource]]:
     if lss_obj:
         light_sources = []
@@ -136,6 +147,7 @@ def export_light_sources_metadata(lss_obj: List) -> Optional[List[LightSource]]:
     return []
 
 
+@traced
 def export_light_source_metadata(ls_obj) -> Optional[LightSource]:
     if isinstance(ls_obj._obj, LaserI):
         medium = None if not ls_obj.getLaserMedium() else ls_obj.getLaserMedium().getValue()
@@ -228,6 +240,7 @@ def export_light_source_metadata(ls_obj) -> Optional[LightSource]:
     return light_source
 
 
+@traced
 def export_detectors_metadata(detectors_obj: List[DetectorI]) -> Optional[List[Detector]]:
     if detectors_obj:
         detectors = []
@@ -242,6 +255,7 @@ def export_detectors_metadata(detectors_obj: List[DetectorI]) -> Optional[List[D
     return []
 
 
+@traced
 def export_detector_metadata(detector_obj: DetectorI) -> Optional[Detector]:
     id_: int = detector_obj.getId()
     name: Optional[str] = detector_obj.getName()
@@ -281,6 +295,7 @@ def export_detector_metadata(detector_obj: DetectorI) -> Optional[Detector]:
     return detector
 
 
+@traced
 def export_objectives_metadata(objectives_obj: List[ObjectiveI]) -> Optional[List[Objective]]:
     if objectives_obj:
         objectives = []
@@ -294,6 +309,7 @@ def export_objectives_metadata(objectives_obj: List[ObjectiveI]) -> Optional[Lis
     return []
 
 
+@traced
 def export_objective_metadata(objective_obj: ObjectiveI) -> Optional[Objective]:
     if objective_obj:
         id_: int = objective_obj.getId().getValue()
@@ -337,6 +353,7 @@ def export_objective_metadata(objective_obj: ObjectiveI) -> Optional[Objective]:
     return None
 
 
+@traced
 def export_filters_metadata(filters_obj: List[FilterI]) -> Optional[List[Filter]]:
     if filters_obj:
         filters = []
@@ -350,6 +367,7 @@ def export_filters_metadata(filters_obj: List[FilterI]) -> Optional[List[Filter]
     return []
 
 
+@traced
 def export_filter_metadata(filter_obj: FilterI) -> Optional[Filter]:
     if filter_obj:
         id_: int = filter_obj.getId()
@@ -394,6 +412,7 @@ def export_filter_metadata(filter_obj: FilterI) -> Optional[Filter]:
     return None
 
 
+@traced
 def export_dichroics_metadata(dichroics_obj: List[DichroicI]) -> Optional[List[Dichroic]]:
     if dichroics_obj:
         dichroics = []
@@ -407,6 +426,7 @@ def export_dichroics_metadata(dichroics_obj: List[DichroicI]) -> Optional[List[D
     return []
 
 
+@traced
 def export_dichroic_metadata(dichroic_obj: DichroicI) -> Optional[Dichroic]:
     if dichroic_obj:
         id_: int = dichroic_obj.getId()
@@ -0,0 +1,179 @@
+# Copyright (c) 2023 Qureator, Inc. All rights reserved.
+
+import threading
+from typing import Dict, Optional, Tuple, Union
+
+from ome_types import OME
+from ome_types.model import (
+    Image,
+    Instrument,
+    ROI,
+    Detector,
+    Filter,
+    Dichroic,
+)
+
+from ...masks import MaskStore
+from .plane_table import PlaneTable
+
+
+def ome_id(kind: str, id_: int) -> str:
+    # Same form as the IDs ome_types generates from integers, e.g. "Filter:5"
+    return f"{kind}:{id_}"
+
+
+def image_index_key(image: Image) -> int:
+    return int(image.id.split(':')[-1])
+
+
+# Index of the last plain OME given to OMEIndex.of, e.g. when exporting image by image
+_last_index: "Optional[OMEIndex]" = None
+_last_index_lock = threading.Lock()
+
+
+class OMEIndex:
+    """Dict-backed lookups over an OME document.
+
+    Every lookup and insert is O(1), so adding n images to one document is
+    linear instead of quadratic. All inserts go through the index so that it
+    stays in sync with the wrapped ``OME``.
+
+    Parameters
+    ----------
+    ome : ome_types.OME, optional
+        Document to index and extend. A new document is created if omitted.
+    masks : MaskStore, optional
+        Sidecar receiving the bytes of exported masks instead of the XML.
+    """
+
+    def __init__(self, ome: Optional[OME] = None, masks: Optional[MaskStore] = None):
+        self.ome: OME = OME() if ome is None else ome
+        self.masks = masks
+
+        self.images: Dict[int, Image] = {}
+        self.instruments: Dict[str, Instrument] = {}
+        self.rois: Dict[str, ROI] = {}
+        self.detectors: Dict[str, Detector] = {}
+        self.filters: Dict[str, Filter] = {}
+        self.dichroics: Dict[str, Dichroic] = {}
+        # Planes kept as columns until materialize_planes, by image key
+        self.plane_tables: Dict[int, PlaneTable] = {}
+        self._roi_positions: Dict[str, int] = {}
+
+        for image in self.ome.images:
+            self.images.setdefault(image_index_key(image), image)
+        for instrument in self.ome.instruments:
+            self._index_instrument(instrument)
+        for position, roi in enumerate(self.ome.rois):
+            self.rois[roi.id] = roi
+            self._roi_positions[roi.id] = position
+        self._lists = self._snapshot()
+
+    @staticmethod
+    def of(ome: "Union[OME, OMEIndex]") -> "OMEIndex":
+        """``ome`` if it is an index, else an index of it.
+
+        The index of the last plain ``OME`` is reused as long as its images,
+        instruments and ROIs were only added through the index, so exporting
+        many images into one ``OME`` one call at a time stays linear.
+        """
+        global _last_index
+
+        if isinstance(ome, OMEIndex):
+            return ome
+
+        with _last_index_lock:
+            index = _last_index
+            if index is None or index.ome is not ome or not index._in_sync():
+                index = _last_index = OMEIndex(ome)
+        return index
+
+    def _snapshot(self) -> Tuple[Tuple[list, int], ...]:
+        return tuple((items, len(items)) for items in (self.ome.images, self.ome.instruments, self.ome.rois))
+
+    def _in_sync(self) -> bool:
+        return all(
+            items is known and len(items) == length
+            for (items, _), (known, length) in zip(self._snapshot(), self._lists)
+        )
+
+    def _index_instrument(self, instrument: Instrument) -> None:
+        self.instruments[instrument.id] = instrument
+        for detector in instrument.detectors:
+            self.detectors[detector.id] = detector
+        for filter_ in instrument.filters:
+            self.filters[filter_.id] = filter_
+        for dichroic in instrument.dichroics:
+            self.dichroics[dichroic.id] = dichroic
+
+    def get_image(self, image_id: int) -> Optional[Image]:
+        return self.images.get(image_id)
+
+    def put_image(self, image: Image) -> Image:
+        key = image_index_key(image)
+        if key not in self.images:
+            self.images[key] = image
+            self.ome.images.append(image)
+            self._lists = self._snapshot()
+        return self.images[key]
+
+    def put_instrument(self, instrument: Instrument) -> Instrument:
+        if instrument.id not in self.instruments:
+            self._index_instrument(instrument)
+            self.ome.instruments.append(instrument)
+            self._lists = self._snapshot()
+        return self.instruments[instrument.id]
+
+    def put_filter(self, instrument_id: str, filter_: Filter) -> None:
+        if filter_.id not in self.filters:
+            self.filters[filter_.id] = filter_
+            self.instruments[instrument_id].filters.append(filter_)
+
+    def put_dichroic(self, instrument_id: str, dichroic: Dichroic) -> None:
+        if dichroic.id not in self.dichroics:
+            self.dichroics[dichroic.id] = dichroic
+            self.instruments[instrument_id].dichroics.append(dichroic)
+
+    def put_roi(self, roi: ROI) -> None:
+        if roi.id in self._roi_positions:
+            self.ome.rois[self._roi_positions[roi.id]] = roi
+        else:
+            self._roi_positions[roi.id] = len(self.ome.rois)
+            self.ome.rois.append(roi)
+            self._lists = self._snapshot()
+        self.rois[roi.id] = roi
+
+    def merge(self, other: "OMEIndex") -> None:
+        """Add the images, instruments and ROIs of another document, skipping known IDs."""
+        self.merge_instruments(other)
+
+        for image in other.ome.images:
+            self.put_image(image)
+
+        for roi in other.ome.rois:
+            self.put_roi(roi)
+
+        for image_id, plane_table in other.plane_tables.items():
+            self.put_plane_table(image_id, plane_table)
+
+    def merge_instruments(self, other: "OMEIndex") -> None:
+        """Add the instruments of another document, and the filters and dichroics missing from known ones."""
+        for instrument in other.ome.instruments:
+            if instrument.id in self.instruments:
+                for filter_ in instrument.filters:
+                    self.put_filter(instrument.id, filter_)
+                for dichroic in instrument.dichroics:
+                    self.put_dichroic(instrument.id, dichroic)
+            else:
+                self.put_instrument(instrument)
+
+    def put_plane_table(self, image_id: int, plane_table: Optional[PlaneTable]) -> None:
+        if plane_table is None:
+            self.plane_tables.pop(image_id, None)
+        else:
+            self.plane_tables[image_id] = plane_table
+
+    def materialize_planes(self) -> None:
+        """Fill the planes of images from their plane tables, e.g. before serializing."""
+        for image_id, plane_table in self.plane_tables.items():
+            self.images[image_id].pixels.planes = plane_table.to_planes()
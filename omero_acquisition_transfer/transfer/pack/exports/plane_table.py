@@ -0,0 +1,234 @@
+# Copyright (c) 2023 Qureator, Inc. All rights reserved.
+
+import math
+from collections import defaultdict
+from enum import Enum
+from typing import Dict, Iterator, List, Optional, Sequence, Type
+from xml.sax.saxutils import quoteattr
+
+import numpy as np
+from ome_types.model import Plane
+from ome_types.model.simple_types import UnitsLength, UnitsTime
+from omero.gateway import BlitzGateway
+from omero.model import TimeI
+from omero.rtypes import unwrap
+from omero.sys import ParametersI
+
+from ...tracing import traced
+from .common import convert_units
+
+INDEX_COLUMNS = ("the_c", "the_z", "the_t")
+VALUE_COLUMNS = ("delta_t", "exposure_time", "position_x", "position_y", "position_z")
+UNIT_TYPES: Dict[str, Type[Enum]] = {
+    "delta_t": UnitsTime,
+    "exposure_time": UnitsTime,
+    "position_x": UnitsLength,
+    "position_y": UnitsLength,
+    "position_z": UnitsLength,
+}
+# OME-XML attribute of each value column, followed by "Unit" for its unit
+XML_ATTRIBUTES = {
+    "delta_t": "DeltaT",
+    "exposure_time": "ExposureTime",
+    "position_x": "PositionX",
+    "position_y": "PositionY",
+    "position_z": "PositionZ",
+}
+
+PLANE_TABLE_QUERY = (
+    "select pi.pixels.id, pi.theC, pi.theZ, pi.theT, "
+    "pi.deltaT.value, pi.deltaT.unit, "
+    "pi.exposureTime.value, pi.exposureTime.unit, "
+    "pi.positionX.value, pi.positionX.unit, "
+    "pi.positionY.value, pi.positionY.unit, "
+    "pi.positionZ.value, pi.positionZ.unit "
+    "from PlaneInfo as pi "
+    "where pi.pixels.id in (:ids) "
+    "order by pi.id"
+)
+
+
+class PlaneTable:
+    """Plane metadata of one image as NumPy columns with one unit per column.
+
+    Index columns are integer arrays and value columns float arrays with NaN
+    for missing values. Planes are only turned into ``Plane`` models by
+    :meth:`iter_planes` or :meth:`to_planes`, e.g. when writing OME-XML.
+
+    Parameters
+    ----------
+    columns : Dict[str, numpy.ndarray]
+        Arrays of equal length by column name, see ``INDEX_COLUMNS`` and ``VALUE_COLUMNS``.
+    units : Dict[str, Enum], optional
+        Unit of each value column. None for columns without values.
+    """
+
+    def __init__(self, columns: Dict[str, np.ndarray], units: Optional[Dict[str, Optional[Enum]]] = None):
+        self.columns = columns
+        self.units: Dict[str, Optional[Enum]] = {name: None for name in VALUE_COLUMNS}
+        self.units.update(units or {})
+
+    def __len__(self) -> int:
+        return len(self.columns["the_c"])
+
+    @classmethod
+    def empty(cls) -> "PlaneTable":
+        columns = {name: np.empty(0, dtype=np.int32) for name in INDEX_COLUMNS}
+        columns.update({name: np.empty(0, dtype=np.float64) for name in VALUE_COLUMNS})
+        return cls(columns)
+
+    @classmethod
+    def from_rows(cls, rows: Sequence[Sequence], time_unit: Optional[UnitsTime] = None) -> Optional["PlaneTable"]:
+        """Build a table from rows of theC, theZ, theT and a (value, unit) pair per value column.
+
+        Values of the time columns are converted to ``time_unit`` if given, as
+        ``PlaneInfo.getDeltaT(units=...)`` does. Returns None if a column that
+        is not converted has more than one unit.
+        """
+        if not rows:
+            return cls.empty()
+
+        columns = {
+            name: np.array([row[i] for row in rows], dtype=np.int32)
+            for i, name in enumerate(INDEX_COLUMNS)
+        }
+
+        units = {}
+        for i, name in enumerate(VALUE_COLUMNS):
+            position = len(INDEX_COLUMNS) + 2 * i
+            values = np.array([row[position] for row in rows], dtype=np.float64)
+
+            column_units = {row[position + 1] for row in rows if row[position] is not None}
+            if time_unit is not None and UNIT_TYPES[name] is UnitsTime and column_units:
+                factors = {unit: _time_factor(unit, time_unit) for unit in column_units}
+                values *= [factors[row[position + 1]] if row[position] is not None else 1.0 for row in rows]
+                column_units = {time_unit}
+            if len(column_units) > 1:
+                return None
+
+            columns[name] = values
+            units[name] = _parse_unit(UNIT_TYPES[name], column_units.pop()) if column_units else None
+
+        return cls(columns, units)
+
+    @classmethod
+    def from_planes(cls, planes: List[Plane]) -> Optional["PlaneTable"]:
+        """Build a table from ``Plane`` models. Returns None if a column has more than one unit."""
+        rows = []
+        for plane in planes:
+            row = [plane.the_c, plane.the_z, plane.the_t]
+            for name in VALUE_COLUMNS:
+                row += [getattr(plane, name), getattr(plane, f"{name}_unit")]
+            rows.append(row)
+
+        return cls.from_rows(rows)
+
+    def sorted(self) -> "PlaneTable":
+        """Copy with the planes ordered by T, C and Z."""
+        order = np.lexsort((self.columns["the_z"], self.columns["the_c"], self.columns["the_t"]))
+        return PlaneTable({name: column[order] for name, column in self.columns.items()}, self.units)
+
+    def equals(self, other: "PlaneTable") -> bool:
+        """Whether both tables hold the same planes in any order, with the same units."""
+        if len(self) != len(other) or self.units != other.units:
+            return False
+
+        this, other = self.sorted(), other.sorted()
+        return all(
+            np.array_equal(this.columns[name], other.columns[name], equal_nan=name in VALUE_COLUMNS)
+            for name in INDEX_COLUMNS + VALUE_COLUMNS
+        )
+
+    def iter_planes(self) -> Iterator[Plane]:
+        index_columns = [self.columns[name].tolist() for name in INDEX_COLUMNS]
+        value_columns = [self.columns[name].tolist() for name in VALUE_COLUMNS]
+
+        for i, (the_c, the_z, the_t) in enumerate(zip(*index_columns)):
+            kwargs = {}
+            for name, values in zip(VALUE_COLUMNS, value_columns):
+                if not math.isnan(values[i]):
+                    kwargs[name] = values[i]
+                    kwargs[f"{name}_unit"] = self.units[name]
+
+            yield Plane(the_c=the_c, the_z=the_z, the_t=the_t, **kwargs)
+
+    def to_planes(self) -> List[Plane]:
+        return list(self.iter_planes())
+
+    def iter_xml(self) -> Iterator[str]:
+        """Planes as OME-XML ``<Plane>`` elements, as ``to_xml`` writes them, without building ``Plane`` models."""
+        defaults = Plane(the_c=0, the_z=0, the_t=0)
+        # Units equal to the schema default are left out like ome_types does
+        units = {
+            name: None if unit is None or unit == getattr(defaults, f"{name}_unit") else quoteattr(unit.value)
+            for name, unit in self.units.items()
+        }
+        index_columns = [self.columns[name].tolist() for name in INDEX_COLUMNS]
+        value_columns = [self.columns[name].tolist() for name in VALUE_COLUMNS]
+
+        for i, (the_c, the_z, the_t) in enumerate(zip(*index_columns)):
+            attributes = f'TheC="{the_c}" TheT="{the_t}" TheZ="{the_z}"'
+            for name, values in zip(VALUE_COLUMNS, value_columns):
+                if not math.isnan(values[i]):
+                    attributes += f' {XML_ATTRIBUTES[name]}="{values[i]!r}"'
+                    if units[name] is not None:
+                        attributes += f' {XML_ATTRIBUTES[name]}Unit={units[name]}'
+
+            yield f"<Plane {attributes} />"
+
+
+@traced
+def load_plane_tables(pixels_ids: List[int], conn: BlitzGateway) -> Dict[int, Optional[PlaneTable]]:
+    """Load the plane tables of many pixels with one projection query.
+
+    Parameters
+    ----------
+    pixels_ids : List[int]
+        Pixels IDs to load.
+    conn : omero.gateway.BlitzGateway
+        OMERO connection.
+
+    Returns
+    -------
+    plane_tables : Dict[int, Optional[PlaneTable]]
+        Table by pixels ID, for every ID of ``pixels_ids``, with times in
+        seconds like ``export_plane_metadata``. None for pixels whose planes
+        mix length units within a column, which have to be exported as
+        ``PlaneInfo`` objects instead.
+    """
+    if not pixels_ids:
+        return {}
+
+    rows = defaultdict(list)
+    for row in conn.getQueryService().projection(
+        PLANE_TABLE_QUERY, ParametersI().addIds(pixels_ids), conn.SERVICE_OPTS
+    ):
+        row = [unwrap(value) for value in row]
+        rows[row[0]].append(row[1:])
+
+    return {pixels_id: PlaneTable.from_rows(rows[pixels_id], time_unit=UnitsTime.SECOND) for pixels_id in pixels_ids}
+
+
+@traced
+def load_plane_table(pixels_id: int, conn: BlitzGateway) -> Optional[PlaneTable]:
+    return load_plane_tables([pixels_id], conn)[pixels_id]
+
+
+def _parse_unit(unit_type: Type[Enum], unit) -> Enum:
+    if isinstance(unit, unit_type):
+        return unit
+
+    unit = convert_units(str(unit))
+    try:
+        return unit_type(unit)
+    except ValueError:
+        # Enum names such as 'MICROMETER'
+        return unit_type[unit]
+
+
+def _time_factor(unit, target: UnitsTime) -> float:
+    unit = _parse_unit(UnitsTime, unit)
+    if unit == target:
+        return 1.0
+    # Scaling by the conversion of 1 gives the same floats as TimeI itself
+    return TimeI(TimeI(1.0, unit.name), target.name).getValue()
@@ -0,0 +1,296 @@
+# Copyright (c) 2023 Qureator, Inc. All rights reserved.
+
+from collections import defaultdict
+from typing import Dict, Iterator, List, Optional
+
+from omero.gateway import (
+    BlitzGateway,
+    ChannelWrapper,
+    ColorHolder,
+    ImageWrapper,
+    PixelsWrapper,
+    PlaneInfoWrapper,
+)
+from omero.model import (
+    ChannelI,
+    ImageI,
+    InstrumentI,
+    PlaneInfoI,
+    RoiI,
+)
+from omero.rtypes import unwrap
+from omero.sys import ParametersI
+
+from ...tracing import traced
+from .plane_table import PlaneTable, load_plane_tables
+
+PREFETCH_IMAGES_QUERY = (
+    "select distinct i from Image as i "
+    "left outer join fetch i.pixels as p "
+    "left outer join fetch p.pixelsType "
+    "left outer join fetch p.dimensionOrder "
+    "left outer join fetch i.objectiveSettings as os "
+    "left outer join fetch os.medium "
+    "left outer join fetch i.imagingEnvironment "
+    "left outer join fetch i.stageLabel "
+    "where i.id in (:ids)"
+)
+PREFETCH_CHANNELS_QUERY = (
+    "select distinct p from Pixels as p "
+    "join fetch p.channels as c "
+    "join fetch c.logicalChannel "
+    "where p.id in (:ids)"
+)
+PREFETCH_PLANE_INFOS_QUERY = (
+    "select info from PlaneInfo as info "
+    "where info.pixels.id in (:ids) "
+    "order by info.id"
+)
+PREFETCH_ROIS_QUERY = (
+    "select distinct r from Roi as r "
+    "left outer join fetch r.shapes "
+    "where r.image.id in (:ids) "
+    "order by r.id"
+)
+
+
+class PrefetchedPixelsWrapper(PixelsWrapper):
+    """Pixels wrapper serving plane infos loaded by :func:`prefetch_images`."""
+
+    def __init__(self, conn: BlitzGateway, obj, plane_infos: List[PlaneInfoI], **kwargs):
+        super().__init__(conn, obj, **kwargs)
+        self._prefetched_plane_infos = plane_infos
+
+    def copyPlaneInfo(self, theC=None, theT=None, theZ=None) -> Iterator[PlaneInfoWrapper]:
+        for pi_obj in self._prefetched_plane_infos:
+            if theC is not None and pi_obj.getTheC().getValue() != theC:
+                continue
+            if theT is not None and pi_obj.getTheT().getValue() != theT:
+                continue
+            if theZ is not None and pi_obj.getTheZ().getValue() != theZ:
+                continue
+            yield PlaneInfoWrapper(self._conn, pi_obj)
+
+
+class PrefetchedChannelWrapper(ChannelWrapper):
+    """``ChannelWrapper`` without a rendering engine, colored by the RGBA of the ``Channel`` itself."""
+
+    def getColor(self) -> Optional[ColorHolder]:
+        obj = self._obj
+        rgba = [unwrap(value) for value in (obj.getRed(), obj.getGreen(), obj.getBlue(), obj.getAlpha())]
+        if None in rgba:
+            return None
+        return ColorHolder.fromRGBA(*rgba)
+
+
+class PrefetchedImageWrapper(ImageWrapper):
+    """Image wrapper whose acquisition graph was loaded by :func:`prefetch_images`.
+
+    Channels, plane infos and ROIs are served from memory so that the export
+    functions do not issue any further server calls for this image.
+    """
+
+    def __init__(
+            self,
+            conn: BlitzGateway,
+            obj: ImageI,
+            channels: List[ChannelI],
+            plane_infos: List[PlaneInfoI],
+            rois: List[RoiI],
+            plane_table: Optional[PlaneTable] = None,
+            **kwargs
+    ):
+        super().__init__(conn, obj, **kwargs)
+        self._prefetched_channels = channels
+        self._prefetched_plane_infos = plane_infos
+        self._prefetched_rois = rois
+        self._prefetched_plane_table = plane_table
+
+    def getPrimaryPixels(self) -> Optional[PrefetchedPixelsWrapper]:
+        if self._obj.sizeOfPixels() <= 0:
+            return None
+        return PrefetchedPixelsWrapper(self._conn, self._obj.getPrimaryPixels(), self._prefetched_plane_infos)
+
+    def getChannels(self, noRE: bool = False) -> List[ChannelWrapper]:
+        return [
+            PrefetchedChannelWrapper(self._conn, ch_obj, idx=idx, img=self)
+            for idx, ch_obj in enumerate(self._prefetched_channels)
+        ]
+
+    def getPrefetchedRois(self) -> List[RoiI]:
+        return self._prefetched_rois
+
+    def getPrefetchedPlaneTable(self) -> Optional[PlaneTable]:
+        # None unless prefetched with plane tables and the planes have one unit per column
+        return self._prefetched_plane_table
+
+
+def iter_prefetched_images(
+        image_ids: List[int],
+        conn: BlitzGateway,
+        batch_size: int = 100,
+        plane_tables: bool = False,
+        rois: bool = True,
+) -> Iterator[PrefetchedImageWrapper]:
+    """Prefetch images batch by batch, sharing loaded instruments across batches.
+
+    Parameters
+    ----------
+    image_ids : List[int]
+        Image IDs to load.
+    conn : omero.gateway.BlitzGateway
+        OMERO connection.
+    batch_size : int
+        Number of images loaded per set of queries.
+    plane_tables : bool
+        Load planes as :class:`PlaneTable` instead of ``PlaneInfo`` objects.
+    rois : bool
+        Prefetch ROIs with their shapes.
+    """
+    instruments: Dict[int, InstrumentI] = {}
+
+    for start in range(0, len(image_ids), batch_size):
+        yield from prefetch_images(image_ids[start:start + batch_size], conn, instruments, plane_tables, rois)
+
+
+@traced
+def prefetch_images(
+        image_ids: List[int],
+        conn: BlitzGateway,
+        instruments: Optional[Dict[int, InstrumentI]] = None,
+        plane_tables: bool = False,
+        rois: bool = True,
+) -> List[PrefetchedImageWrapper]:
+    """Load the acquisition graph of many images with a fixed number of queries.
+
+    Images, channels with their acquisition data, plane infos and ROIs are each
+    loaded with a single query for the whole batch. Instruments are loaded once
+    per distinct instrument.
+
+    Parameters
+    ----------
+    image_ids : List[int]
+        Image IDs to load.
+    conn : omero.gateway.BlitzGateway
+        OMERO connection.
+    instruments : Dict[int, omero.model.InstrumentI], optional
+        Already loaded instruments by ID. Newly loaded instruments are added to it.
+    plane_tables : bool
+        Load planes as :class:`PlaneTable` with one projection query. Only
+        pixels whose planes mix length units are loaded as ``PlaneInfo`` objects.
+    rois : bool
+        Prefetch ROIs with their shapes. Skip it when exporting ROIs page by page.
+
+    Returns
+    -------
+    images : List[PrefetchedImageWrapper]
+        Wrapped images in the order of ``image_ids``. Missing images are skipped.
+    """
+    if instruments is None:
+        instruments = {}
+
+    if not image_ids:
+        return []
+
+    query_service = conn.getQueryService()
+    image_objs: Dict[int, ImageI] = {
+        image_obj.getId().getValue(): image_obj
+        for image_obj in query_service.findAllByQuery(
+            PREFETCH_IMAGES_QUERY, ParametersI().addIds(image_ids), conn.SERVICE_OPTS
+        )
+    }
+
+    pixels_ids = [
+        image_obj.getPrimaryPixels().getId().getValue()
+        for image_obj in image_objs.values()
+        if image_obj.sizeOfPixels() > 0
+    ]
+    channels = prefetch_channels(pixels_ids, conn)
+    tables = load_plane_tables(pixels_ids, conn) if plane_tables else {}
+    plane_infos = prefetch_plane_infos([pixels_id for pixels_id in pixels_ids if tables.get(pixels_id) is None], conn)
+    roi_objs = prefetch_rois(list(image_objs), conn) if rois else {}
+
+    for image_obj in image_objs.values():
+        instrument_obj = image_obj.getInstrument()
+        if instrument_obj is None:
+            continue
+
+        instrument_id = instrument_obj.getId().getValue()
+        if instrument_id not in instruments:
+            instruments[instrument_id] = conn.getMetadataService().loadInstrument(instrument_id, conn.SERVICE_OPTS)
+        image_obj.setInstrument(instruments[instrument_id])
+
+    images = []
+    for image_id in image_ids:
+        image_obj = image_objs.get(image_id)
+        if image_obj is None:
+            continue
+
+        pixels_id = None if image_obj.sizeOfPixels() <= 0 else image_obj.getPrimaryPixels().getId().getValue()
+        images.append(PrefetchedImageWrapper(
+            conn,
+            image_obj,
+            channels=channels.get(pixels_id, []),
+            plane_infos=plane_infos.get(pixels_id, []),
+            rois=roi_objs.get(image_id, []),
+            plane_table=tables.get(pixels_id),
+        ))
+
+    return images
+
+
+@traced
+def prefetch_channels(pixels_ids: List[int], conn: BlitzGateway) -> Dict[int, List[ChannelI]]:
+    if not pixels_ids:
+        return {}
+
+    pixels_objs = conn.getQueryService().findAllByQuery(
+        PREFETCH_CHANNELS_QUERY, ParametersI().addIds(pixels_ids), conn.SERVICE_OPTS
+    )
+    channels = {pix_obj.getId().getValue(): pix_obj.copyChannels() for pix_obj in pixels_objs}
+
+    # Light paths, filters, detector and light source settings of every logical channel at once
+    lch_ids = list({
+        ch_obj.getLogicalChannel().getId().getValue()
+        for ch_objs in channels.values()
+        for ch_obj in ch_objs
+    })
+    if lch_ids:
+        lch_objs = conn.getMetadataService().loadChannelAcquisitionData(lch_ids, conn.SERVICE_OPTS)
+        lch_objs = {lch_obj.getId().getValue(): lch_obj for lch_obj in lch_objs}
+
+        for ch_objs in channels.values():
+            for ch_obj in ch_objs:
+                lch_id = ch_obj.getLogicalChannel().getId().getValue()
+                if lch_id in lch_objs:
+                    ch_obj.setLogicalChannel(lch_objs[lch_id])
+
+    return channels
+
+
+@traced
+def prefetch_plane_infos(pixels_ids: List[int], conn: BlitzGateway) -> Dict[int, List[PlaneInfoI]]:
+    plane_infos = defaultdict(list)
+    if not pixels_ids:
+        return plane_infos
+
+    for pi_obj in conn.getQueryService().findAllByQuery(
+        PREFETCH_PLANE_INFOS_QUERY, ParametersI().addIds(pixels_ids), conn.SERVICE_OPTS
+    ):
+        plane_infos[pi_obj.getPixels().getId().getValue()].append(pi_obj)
+
+    return plane_infos
+
+
+@traced
+def prefetch_rois(image_ids: List[int], conn: BlitzGateway) -> Dict[int, List[RoiI]]:
+    rois = defaultdict(list)
+    if not image_ids:
+        return rois
+
+    for roi_obj in conn.getQueryService().findAllByQuery(
+        PREFETCH_ROIS_QUERY, ParametersI().addIds(image_ids), conn.SERVICE_OPTS
+    ):
+        rois[roi_obj.getImage().getId().getValue()].append(roi_obj)
+
+    return rois
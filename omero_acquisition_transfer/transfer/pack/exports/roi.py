@@ -1,12 +1,13 @@
 # Copyright (c) 2023 Qureator, Inc. All rights reserved.
 
-import logging
-from typing import Optional, List
+from collections import defaultdict
+from typing import Any, Dict, Iterator, Optional, List, Tuple, Type, Union
 
 from ome_types import OME
 from ome_types.model import (
-    ROI, ROIRef, Shape, Point, Line, Rectangle, Polygon, Polyline, Ellipse, Label
+    ROI, ROIRef, Shape, Point, Line, Rectangle, Polygon, Polyline, Ellipse, Label, Mask
 )
+from omero.api import RoiOptions
 from omero.gateway import (
     ImageWrapper,
     BlitzGateway,
@@ -15,30 +16,204 @@ from omero.gateway import (
 from omero.model import (
     RoiI, PointI, LineI, RectangleI, PolygonI, PolylineI, EllipseI, MaskI, LabelI
 )
+from omero.rtypes import rint, unwrap
+from omero.sys import ParametersI
 
+from ...masks import MaskStore, encode_mask
+from ...tracing import traced
+from .ome_index import OMEIndex
+from .prefetch import PrefetchedImageWrapper
 
-def export_attach_rois_metadata(image_obj: ImageWrapper, conn: BlitzGateway, ome: OME) -> Optional[List[ROIRef]]:
-    roi_service = conn.getRoiService()
-    rois_obj = roi_service.findByImage(image_obj.getId(), None).rois
+ROIS_PAGE_QUERY = (
+    "select r.id, r.name, r.description from Roi as r "
+    "where r.image.id = :id "
+    "order by r.id"
+)
+# Columns shared by all shapes, as (HQL expression, Shape field)
+SHAPE_COLUMNS = (
+    ("s.id", "id"),
+    ("s.fillColor", "fill_color"),
+    ("s.fillRule", "fill_rule"),
+    ("s.strokeColor", "stroke_color"),
+    ("s.strokeWidth.value", "stroke_width"),
+    ("s.strokeDashArray", "stroke_dash_array"),
+    ("s.textValue", "text"),
+    ("s.fontFamily", "font_family"),
+    ("s.fontSize.value", "font_size"),
+    ("s.fontStyle", "font_style"),
+    ("s.locked", "locked"),
+    ("s.theT", "the_t"),
+    ("s.theZ", "the_z"),
+    ("s.theC", "the_c"),
+)
+# Geometry columns by OMERO shape class
+SHAPE_TYPE_COLUMNS: Dict[str, Tuple[Type[Shape], Tuple[Tuple[str, str], ...]]] = {
+    "Point": (Point, (("s.x", "x"), ("s.y", "y"))),
+    "Line": (Line, (("s.x1", "x1"), ("s.x2", "x2"), ("s.y1", "y1"), ("s.y2", "y2"))),
+    "Rectangle": (Rectangle, (("s.x", "x"), ("s.y", "y"), ("s.width", "width"), ("s.height", "height"))),
+    "Ellipse": (Ellipse, (("s.x", "x"), ("s.y", "y"), ("s.radiusX", "radius_x"), ("s.radiusY", "radius_y"))),
+    "Polygon": (Polygon, (("s.points", "points"),)),
+    "Polyline": (Polyline, (("s.points", "points"),)),
+    "Label": (Label, (("s.x", "x"), ("s.y", "y"))),
+}
+# Mask bytes are loaded with the shape objects
+MASKS_QUERY = "select s from Mask as s where s.roi.id in (:ids) order by s.id"
+# Maximum number of ROI IDs bound to one 'in (:ids)' clause, well below PostgreSQL's bind parameter limit
+ROI_IDS_CHUNK_SIZE = 1000
+
+
+def shape_query(shape_type: str) -> str:
+    _, columns = SHAPE_TYPE_COLUMNS[shape_type]
+    expressions = ", ".join(expression for expression, _ in SHAPE_COLUMNS + columns)
+    return f"select s.roi.id, {expressions} from {shape_type} as s where s.roi.id in (:ids) order by s.id"
+
+
+@traced
+def export_attach_rois_metadata(
+        image_obj: ImageWrapper,
+        conn: BlitzGateway,
+        ome: Union[OME, OMEIndex],
+        page_size: Optional[int] = None,
+        projection: bool = False,
+) -> Optional[List[ROIRef]]:
+    index = OMEIndex.of(ome)
+
+    if isinstance(image_obj, PrefetchedImageWrapper) and page_size is None and not projection:
+        rois = (export_roi_metadata(roi_obj, index.masks) for roi_obj in image_obj.getPrefetchedRois())
+    else:
+        rois = iter_rois_metadata(image_obj.getId(), conn, page_size, projection, index.masks)
     rois_ref = []
 
-    if rois_obj:
-        for roi_obj in rois_obj:
-            roi = export_roi_metadata(roi_obj)
-            if roi:
-                roi_ref = ROIRef(id=roi_obj.getId().getValue())
-                rois_ref.append(roi_ref)
-                ome.rois.append(roi)
+    for roi in rois:
+        if roi:
+            roi_ref = ROIRef(id=roi.id)
+            rois_ref.append(roi_ref)
+            index.put_roi(roi)
 
     return rois_ref
 
 
-def export_roi_metadata(roi_obj: RoiWrapper) -> Optional[ROI]:
+def iter_rois_metadata(
+        image_id: int,
+        conn: BlitzGateway,
+        page_size: Optional[int] = 500,
+        projection: bool = False,
+        masks: Optional[MaskStore] = None,
+) -> Iterator[ROI]:
+    """Yield the ROIs of an image page by page.
+
+    Parameters
+    ----------
+    image_id : int
+        Image ID.
+    conn : omero.gateway.BlitzGateway
+        OMERO connection.
+    page_size : int, optional
+        Number of ROIs loaded at once. All ROIs are loaded at once if None.
+    projection : bool
+        Read shape columns with one projection query per shape type and page
+        instead of loading shape objects. Only masks are loaded as objects.
+    masks : MaskStore, optional
+        Sidecar receiving the mask bytes. Masks are inlined in BinData if None.
+    """
+    if projection:
+        yield from _iter_projected_rois(image_id, conn, page_size, masks)
+        return
+
+    for roi_obj in iter_roi_objects(image_id, conn, page_size):
+        roi = export_roi_metadata(roi_obj, masks)
+        if roi:
+            yield roi
+
+
+def iter_roi_objects(image_id: int, conn: BlitzGateway, page_size: Optional[int] = 500) -> Iterator[RoiI]:
+    roi_service = conn.getRoiService()
+
+    if page_size is None:
+        yield from roi_service.findByImage(image_id, None, conn.SERVICE_OPTS).rois
+        return
+
+    offset = 0
+    while True:
+        options = RoiOptions()
+        options.limit = rint(page_size)
+        options.offset = rint(offset)
+
+        rois_obj = roi_service.findByImage(image_id, options, conn.SERVICE_OPTS).rois
+        yield from rois_obj
+
+        if len(rois_obj) < page_size:
+            return
+        offset += page_size
+
+
+def _iter_projected_rois(
+        image_id: int, conn: BlitzGateway, page_size: Optional[int], masks: Optional[MaskStore]
+) -> Iterator[ROI]:
+    query_service = conn.getQueryService()
+
+    offset = 0
+    while True:
+        params = ParametersI().addId(image_id)
+        if page_size is not None:
+            params.page(offset, page_size)
+        rows = query_service.projection(ROIS_PAGE_QUERY, params, conn.SERVICE_OPTS)
+        if not rows:
+            return
+
+        roi_rows = [[unwrap(value) for value in row] for row in rows]
+        shapes = _project_shapes([roi_id for roi_id, _, _ in roi_rows], conn, masks)
+
+        for roi_id, name, desc in roi_rows:
+            if shapes[roi_id]:
+                shapes[roi_id].sort(key=lambda shape: int(shape.id.split(':')[-1]))
+                yield ROI(id=roi_id, name=name, description=desc, union=shapes[roi_id])
+
+        if page_size is None or len(rows) < page_size:
+            return
+        offset += page_size
+
+
+def _project_shapes(roi_ids: List[int], conn: BlitzGateway, masks: Optional[MaskStore]) -> Dict[int, List[Shape]]:
+    shapes = defaultdict(list)
+
+    # Chunked, as an unpaged export passes every ROI of the image
+    for start in range(0, len(roi_ids), ROI_IDS_CHUNK_SIZE):
+        _project_shapes_chunk(roi_ids[start:start + ROI_IDS_CHUNK_SIZE], conn, masks, shapes)
+
+    return shapes
+
+
+def _project_shapes_chunk(
+        roi_ids: List[int], conn: BlitzGateway, masks: Optional[MaskStore], shapes: Dict[int, List[Shape]]
+) -> None:
+    query_service = conn.getQueryService()
+
+    for shape_type, (shape_class, columns) in SHAPE_TYPE_COLUMNS.items():
+        fields = [field for _, field in SHAPE_COLUMNS + columns]
+
+        for row in query_service.projection(shape_query(shape_type), ParametersI().addIds(roi_ids), conn.SERVICE_OPTS):
+            roi_id, *values = [unwrap(value) for value in row]
+
+            args: Dict[str, Any] = {
+                field: value for field, value in zip(fields, values) if value is not None
+            }
+            if 'font_style' in args:
+                args['font_style'] = args['font_style'].title()
+
+            shapes[roi_id].append(shape_class(**args))
+
+    for s_obj in query_service.findAllByQuery(MASKS_QUERY, ParametersI().addIds(roi_ids), conn.SERVICE_OPTS):
+        shapes[s_obj.getRoi().getId().getValue()].append(export_shape_metadata(s_obj, masks))
+
+
+@traced
+def export_roi_metadata(roi_obj: RoiWrapper, masks: Optional[MaskStore] = None) -> Optional[ROI]:
     id_: int = roi_obj.getId().getValue()
     name: Optional[str] = None if not roi_obj.getName() else roi_obj.getName().getValue()
     desc: Optional[str] = None if not roi_obj.getDescription() else roi_obj.getDescription().getValue()
 
-    shapes = export_shapes_metadata(roi_obj)
+    shapes = export_shapes_metadata(roi_obj, masks)
     if not shapes:
         return None
 
@@ -52,18 +227,20 @@ def export_roi_metadata(roi_obj: RoiWrapper) -> Optional[ROI]:
     return roi
 
 
-def export_shapes_metadata(roi_obj: RoiWrapper) -> Optional[List[Shape]]:
+@traced
+def export_shapes_metadata(roi_obj: RoiWrapper, masks: Optional[MaskStore] = None) -> Optional[List[Shape]]:
     shapes: List[Shape] = []
 
     for s_obj in roi_obj.copyShapes():
-        shape = export_shape_metadata(s_obj)
+        shape = export_shape_metadata(s_obj, masks)
         if shape:
             shapes.append(shape)
 
     return shapes
 
 
-def export_shape_metadata(s_obj) -> Optional[Shape]:
+@traced
+def export_shape_metadata(s_obj, masks: Optional[MaskStore] = None) -> Optional[Shape]:
     if s_obj:
         args = {
             'id': s_obj.getId().getValue(),
@@ -72,11 +249,11 @@ def export_shape_metadata(s_obj) -> Optional[Shape]:
             'stroke_color': None if not s_obj.getStrokeColor() else s_obj.getStrokeColor().getValue(),
             'stroke_width': None if not s_obj.getStrokeWidth() else s_obj.getStrokeWidth().getValue(),
             'stroke_dash_array': None if not s_obj.getStrokeDashArray() else s_obj.getStrokeDashArray().getValue(),
-            'label': None if not s_obj.getTextValue() else s_obj.getTextValue().getValue(),
+            'text': None if not s_obj.getTextValue() else s_obj.getTextValue().getValue(),
             'font_family': None if not s_obj.getFontFamily() else s_obj.getFontFamily().getValue(),
             'font_size': None if not s_obj.getFontSize() else s_obj.getFontSize().getValue(),
             'font_style': None if not s_obj.getFontStyle() else s_obj.getFontStyle().getValue().title(),
-            'locked': s_obj.getLocked(),
+            'locked': None if not s_obj.getLocked() else s_obj.getLocked().getValue(),
             'the_t': None if not s_obj.getTheT() else s_obj.getTheT().getValue(),
             'the_z': None if not s_obj.getTheZ() else s_obj.getTheZ().getValue(),
             'the_c': None if not s_obj.getTheC() else s_obj.getTheC().getValue(),
@@ -115,8 +292,12 @@ def export_shape_metadata(s_obj) -> Optional[Shape]:
             args['y']: Optional[float] = None if not s_obj.getY() else s_obj.getY().getValue()
             shape = Label(**args)
         elif isinstance(s_obj, MaskI):
-            logging.warn('Mask ROIs are not implemented')
-            shape = MaskI(**args)
+            args['x']: Optional[float] = None if not s_obj.getX() else s_obj.getX().getValue()
+            args['y']: Optional[float] = None if not s_obj.getY() else s_obj.getY().getValue()
+            args['width']: Optional[float] = None if not s_obj.getWidth() else s_obj.getWidth().getValue()
+            args['height']: Optional[float] = None if not s_obj.getHeight() else s_obj.getHeight().getValue()
+            args['bin_data'] = encode_mask(f"Shape:{args['id']}", s_obj.getBytes() or b"", masks)
+            shape = Mask(**args)
         else:
             raise NotImplementedError('Unknown ROI type: %s' % s_obj.__class__.__name__)
 
@@ -0,0 +1,210 @@
+# Copyright (c) 2023 Qureator, Inc. All rights reserved.
+
+import logging
+import shutil
+import tempfile
+from typing import IO, List, Optional, Set, TextIO
+
+from ome_types import OME, to_xml
+from ome_types.model import Image, Instrument, ROI
+from omero.gateway import BlitzGateway, ImageWrapper
+
+from ...masks import MaskStore
+from ...ome_xml import element_xml, split_root
+from ...tracing import traced
+from .image import export_image_metadata, export_images_metadata
+from .ome_index import OMEIndex, image_index_key
+from .plane_table import PlaneTable
+
+
+class MetadataWriter:
+    """Base of the writers that export images batch by batch and write them one at a time.
+
+    Subclasses implement :meth:`write_image`, :meth:`write_roi`, ``close`` and
+    ``discard``. Instruments are merged into ``document``, which subclasses
+    write on ``close``.
+
+    Parameters
+    ----------
+    document : OMEIndex
+        Document receiving the instruments of the written images.
+
+    plane_table : bool
+        Export planes as plane tables, see ``export_images_metadata``.
+
+    masks : MaskStore, optional
+        Sidecar receiving the bytes of exported masks instead of the ROIs.
+    """
+
+    def __init__(self, document: OMEIndex, plane_table: bool = True, masks: Optional[MaskStore] = None):
+        self.plane_table = plane_table
+        self.masks = masks
+        self._document = document
+
+    def add_image(self, image_obj: ImageWrapper, conn: BlitzGateway) -> None:
+        index = OMEIndex(masks=self.masks)
+        export_image_metadata(image_obj, conn, index, in_place=True, plane_table=self.plane_table)
+        self.write_index(index)
+
+    def add_images(self, image_ids: List[int], conn: BlitzGateway, batch_size: int = 100) -> None:
+        """Export and write images ``batch_size`` at a time, each batch prefetched with a few queries."""
+        for start in range(0, len(image_ids), batch_size):
+            index = OMEIndex(masks=self.masks)
+            export_images_metadata(
+                image_ids[start:start + batch_size], conn, index, batch_size=batch_size, plane_table=self.plane_table
+            )
+            self.write_index(index)
+
+    @traced
+    def write_index(self, index: OMEIndex) -> None:
+        """Write the images and ROIs of a document, e.g. of an ``OMEBuilder``, and keep its instruments."""
+        self._document.merge_instruments(index)
+
+        for image in index.ome.images:
+            self.write_image(image, index.plane_tables.get(image_index_key(image)))
+
+        for roi in index.ome.rois:
+            self.write_roi(roi)
+
+    def write_instrument(self, instrument: Instrument) -> None:
+        self._document.merge_instruments(OMEIndex(OME.construct(instruments=[instrument])))
+
+    def write_image(self, image: Image, plane_table: Optional[PlaneTable] = None) -> None:
+        raise NotImplementedError
+
+    def write_roi(self, roi: ROI) -> None:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        raise NotImplementedError
+
+    def discard(self) -> None:
+        raise NotImplementedError
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+
+class OMEXMLWriter(MetadataWriter):
+    """Stream one OME-XML document to a file handle as images are exported.
+
+    Unlike :class:`OMEBuilder`, no document holding every image is kept.
+    Instruments stay in memory until :meth:`close`, because the schema puts
+    them before the images. Images and ROIs are serialized one at a time to
+    temporary spool files that are copied to ``fh`` on :meth:`close`. Planes
+    are written straight from plane tables without building ``Plane`` models.
+    Memory therefore depends on the largest image and the instruments, not on
+    the number of images.
+
+    Parameters
+    ----------
+    fh : TextIO
+        Text file handle receiving the document. It is not closed.
+
+    creator : str, optional
+        Creator attribute of the OME root element.
+
+    plane_table : bool
+        Export planes as plane tables, see ``export_images_metadata``.
+
+    masks : MaskStore, optional
+        Sidecar receiving the bytes of exported masks instead of the XML.
+
+    spool_dir : str, optional
+        Directory of the spool files. The system temporary directory by default.
+
+    Examples
+    --------
+    >>> with open("metadata.ome.xml", "w", encoding="utf-8") as fh, OMEXMLWriter(fh) as writer:
+    ...     writer.add_images(image_ids, conn)
+    """
+
+    def __init__(
+        self,
+        fh: TextIO,
+        creator: Optional[str] = None,
+        plane_table: bool = True,
+        masks: Optional[MaskStore] = None,
+        spool_dir: Optional[str] = None,
+    ):
+        super().__init__(OMEIndex(), plane_table, masks)
+        self.fh = fh
+        self.creator = creator
+
+        self._image_ids: Set[str] = set()
+        self._roi_ids: Set[str] = set()
+        self._images: IO[str] = tempfile.TemporaryFile("w+", encoding="utf-8", dir=spool_dir)
+        self._rois: IO[str] = tempfile.TemporaryFile("w+", encoding="utf-8", dir=spool_dir)
+        self._closed = False
+
+    @property
+    def image_count(self) -> int:
+        return len(self._image_ids)
+
+    def write_image(self, image: Image, plane_table: Optional[PlaneTable] = None) -> None:
+        """Spool an image, with the planes of ``plane_table`` instead of its own if given."""
+        if image.id in self._image_ids:
+            logging.warning(f"Skipping {image.id}, already written")
+            return
+        self._image_ids.add(image.id)
+
+        xml = element_xml(image)
+        if plane_table is None:
+            self._images.write(xml)
+            return
+
+        # Planes are the last children of Pixels
+        end = xml.rindex("</Pixels>")
+        line_start = xml.rfind("\n", 0, end)
+        if line_start >= 0 and not xml[line_start + 1:end].strip():
+            indent = xml[line_start + 1:end]
+            prefix, end = "\n" + indent + "    ", line_start
+        else:
+            prefix = ""
+
+        self._images.write(xml[:end])
+        for plane in plane_table.iter_xml():
+            self._images.write(prefix + plane)
+        self._images.write(xml[end:])
+
+    def write_roi(self, roi: ROI) -> None:
+        if roi.id in self._roi_ids:
+            return
+        self._roi_ids.add(roi.id)
+        self._rois.write(element_xml(roi))
+
+    @traced
+    def close(self) -> None:
+        """Write the document to ``fh`` and remove the spool files."""
+        if self._closed:
+            return
+        self._closed = True
+
+        try:
+            start_tag, _ = split_root(to_xml(OME.construct(creator=self.creator)))
+            self.fh.write(start_tag)
+
+            for instrument in self._document.ome.instruments:
+                self.fh.write(element_xml(instrument))
+
+            for spool in (self._images, self._rois):
+                spool.seek(0)
+                shutil.copyfileobj(spool, self.fh)
+
+            self.fh.write("\n</OME>\n")
+            logging.info(f"Wrote {len(self._image_ids)} images and {len(self._roi_ids)} ROIs as OME-XML")
+        finally:
+            self._images.close()
+            self._rois.close()
+
+    def discard(self) -> None:
+        """Remove the spool files without writing the document."""
+        self._closed = True
+        self._images.close()
+        self._rois.close()
@@ -0,0 +1,163 @@
+# Copyright (c) 2023 Qureator, Inc. All rights reserved.
+
+from typing import Any, List, Optional
+
+from omero.gateway import BlitzGateway
+from omero.rtypes import unwrap
+from omero.sys import ParametersI
+
+from ..tracing import traced
+
+IMAGE_IDS_QUERIES = {
+    "Dataset": (
+        "select l.child.id from DatasetImageLink as l "
+        "where l.parent.id in (:ids) "
+        "order by l.parent.id, l.child.id"
+    ),
+    "Project": (
+        "select dl.child.id from ProjectDatasetLink as pl, DatasetImageLink as dl "
+        "where dl.parent.id = pl.child.id and pl.parent.id in (:ids) "
+        "order by pl.parent.id, dl.parent.id, dl.child.id"
+    ),
+    "Plate": (
+        "select ws.image.id from WellSample as ws "
+        "where ws.well.plate.id in (:ids) "
+        "order by ws.well.plate.id, ws.image.id"
+    ),
+    "Screen": (
+        "select ws.image.id from ScreenPlateLink as sl, WellSample as ws "
+        "where ws.well.plate.id = sl.child.id and sl.parent.id in (:ids) "
+        "order by sl.parent.id, ws.well.plate.id, ws.image.id"
+    ),
+}
+
+# Rows to lay out tiff files, ordered like the containers are walked
+LAYOUT_QUERIES = {
+    "Image": "select i.id, i.name from Image as i where i.id in (:ids)",
+    "Dataset": (
+        "select l.parent.id, l.child.id, l.child.name from DatasetImageLink as l "
+        "where l.parent.id in (:ids) "
+        "order by l.parent.id, l.child.id"
+    ),
+    "Project": (
+        "select pl.parent.id, dl.parent.id, dl.child.id, dl.child.name "
+        "from ProjectDatasetLink as pl, DatasetImageLink as dl "
+        "where dl.parent.id = pl.child.id and pl.parent.id in (:ids) "
+        "order by pl.parent.id, dl.parent.id, dl.child.id"
+    ),
+    "Plate": (
+        "select p.id, w.row, w.column, p.rowNamingConvention, p.columnNamingConvention, ws.image.id "
+        "from WellSample as ws join ws.well as w join w.plate as p "
+        "where p.id in (:ids) "
+        "order by p.id, w.row, w.column, ws.image.id"
+    ),
+    "Screen": (
+        "select sl.parent.id, p.id, w.row, w.column, p.rowNamingConvention, p.columnNamingConvention, ws.image.id "
+        "from ScreenPlateLink as sl, WellSample as ws join ws.well as w join w.plate as p "
+        "where p.id = sl.child.id and sl.parent.id in (:ids) "
+        "order by sl.parent.id, p.id, w.row, w.column, ws.image.id"
+    ),
+}
+
+
+@traced
+def resolve_image_ids(conn: BlitzGateway, target_type: str, target_ids: List[int]) -> List[int]:
+    """Resolve the images under screens, plates, projects or datasets with one query.
+
+    Parameters
+    ----------
+    conn : omero.gateway.BlitzGateway
+        OMERO connection.
+
+    target_type : str
+        Data type of the data ID.
+        e.g. 'Screen', 'Plate', 'Project', 'Dataset', 'Image'
+
+    target_ids : List[int]
+        Data IDs to resolve.
+
+    Returns
+    -------
+    image_ids : List[int]
+        Image IDs without duplicates, ordered by container and image ID.
+    """
+    if target_type == "Image":
+        return list(dict.fromkeys(target_ids))
+
+    if target_type not in IMAGE_IDS_QUERIES:
+        raise ValueError("Data type not supported.")
+
+    if not target_ids:
+        return []
+
+    rows = conn.getQueryService().projection(
+        IMAGE_IDS_QUERIES[target_type], ParametersI().addIds(target_ids), conn.SERVICE_OPTS
+    )
+    return list(dict.fromkeys(unwrap(row[0]) for row in rows))
+
+
+@traced
+def query_layout(conn: BlitzGateway, target_type: str, target_ids: List[int]) -> List[List[Any]]:
+    """Fetch the rows of ``LAYOUT_QUERIES`` for a data type with one query.
+
+    Parameters
+    ----------
+    conn : omero.gateway.BlitzGateway
+        OMERO connection.
+
+    target_type : str
+        Data type of the data ID.
+        e.g. 'Screen', 'Plate', 'Project', 'Dataset', 'Image'
+
+    target_ids : List[int]
+        Data IDs to resolve.
+
+    Returns
+    -------
+    rows : List[List[Any]]
+        Unwrapped rows, with the columns of the query of ``target_type``.
+    """
+    if target_type not in LAYOUT_QUERIES:
+        raise ValueError("Data type not supported.")
+
+    if not target_ids:
+        return []
+
+    rows = conn.getQueryService().projection(
+        LAYOUT_QUERIES[target_type], ParametersI().addIds(target_ids), conn.SERVICE_OPTS
+    )
+    return [[unwrap(value) for value in row] for row in rows]
+
+
+def grid_label(index: int, convention: Optional[str], default: str) -> str:
+    """Label of a zero-based plate row or column, as ``WellWrapper.getWellPos`` does.
+
+    Parameters
+    ----------
+    index : int
+        Zero-based row or column index.
+
+    convention : str, optional
+        Naming convention of the plate, 'letter' or 'number'.
+
+    default : str
+        Convention used when the plate has none.
+    """
+    if (convention or default).lower() == "number":
+        return str(index + 1)
+
+    label = chr(ord("A") + index % 26)
+    index //= 26
+    while index > 0:
+        index -= 1
+        label = chr(ord("A") + index % 26) + label
+        index //= 26
+
+    return label
+
+
+def well_position(
+    row: int, column: int, row_convention: Optional[str], column_convention: Optional[str]
+) -> str:
+    """Well position such as 'A1', following the naming conventions of its plate."""
+    return grid_label(row, row_convention, "letter") + grid_label(column, column_convention, "number")
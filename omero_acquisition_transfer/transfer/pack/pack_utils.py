@@ -1,23 +1,51 @@
+import logging
+import multiprocessing
 import os
 import string
+import struct
 import tifftools
-from typing import List, Optional
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from typing import BinaryIO, Callable, Dict, List, NamedTuple, Optional, Tuple
 from ome_types import OME, to_dict, to_xml
-from ome_types.model import InstrumentRef
+from ome_types.model import Channel, ImagingEnvironment, Instrument, InstrumentRef, ObjectiveSettings
 from omero.gateway import BlitzGateway, ImageWrapper
 from pathlib import Path
 
+from ..sessions import WorkerSessions, join_session
+from ..tracing import propagate_context, traced
 from .exports import (
     export_instrument_metadata,
     export_pixels_metadata,
     export_imaging_environment_metadata,
     export_objective_settings_metadata,
+    prefetch_images,
 )
+from .hierarchy import query_layout, well_position
 
-__all__ = ["merge_metadata_tiff", "move_tiff_files"]
+__all__ = [
+    "merge_metadata_tiff",
+    "merge_metadata_tiffs",
+    "move_tiff_files",
+    "read_image_description",
+    "write_image_description",
+]
 
 
-def merge_metadata_tiff(image: ImageWrapper, tiff_path: str) -> None:
+class TiffMetadata(NamedTuple):
+    instrument: Instrument
+    channels: List[Channel]
+    objective_settings: Optional[ObjectiveSettings]
+    imaging_environment: Optional[ImagingEnvironment]
+
+
+class MergeResult(NamedTuple):
+    image_id: int
+    tiff_path: str
+    error: Optional[BaseException]
+
+
+@traced
+def merge_metadata_tiff(image: ImageWrapper, tiff_path: str, in_place: bool = True) -> None:
     """Merge metadata from image to tiff file.
 
     Parameters
@@ -26,27 +54,215 @@ def merge_metadata_tiff(image: ImageWrapper, tiff_path: str) -> None:
         Image to get metadata from.
     tiff_path : str
         File name of tiff file.
+    in_place : bool
+        Append the new ImageDescription to the file and patch its tag in IFD0
+        instead of rewriting the whole file. Falls back to a full rewrite when
+        the tag cannot be patched safely.
     """
+    merge_metadata_description(tiff_path, export_tiff_metadata(image), in_place=in_place)
+
+
+@traced
+def export_tiff_metadata(image: ImageWrapper) -> TiffMetadata:
     # Get metadata from image
-    instrument = export_instrument_metadata(image.getInstrument())
-    pixels = export_pixels_metadata(image)
-    imaging_environment = export_imaging_environment_metadata(image.getImagingEnvironment())
-    objective_settings = export_objective_settings_metadata(image.getObjectiveSettings())
+    return TiffMetadata(
+        instrument=export_instrument_metadata(image.getInstrument()),
+        channels=export_pixels_metadata(image, include_planes=False).channels,
+        objective_settings=export_objective_settings_metadata(image.getObjectiveSettings()),
+        imaging_environment=export_imaging_environment_metadata(image.getImagingEnvironment()),
+    )
 
-    # Read tifffile
-    tiff = tifftools.read_tiff(tiff_path)
 
+@traced
+def merge_metadata_description(tiff_path: str, metadata: TiffMetadata, in_place: bool = True) -> None:
     # Merge metadata to ome object
-    ome = OME(**to_dict(tiff["ifds"][0]["tags"][tifftools.Tag.ImageDescription.value]["data"], parser="lxml"))
+    ome = OME(**to_dict(read_image_description(tiff_path), parser="lxml"))
 
-    ome.instruments.append(instrument)
+    ome.instruments.append(metadata.instrument)
     ome.images[0].instrument_ref = InstrumentRef(id=ome.instruments[-1].id)
-    ome.images[0].pixels.channels = pixels.channels
-    ome.images[0].objective_settings = objective_settings
-    ome.images[0].imaging_environment = imaging_environment
+    ome.images[0].pixels.channels = metadata.channels
+    ome.images[0].objective_settings = metadata.objective_settings
+    ome.images[0].imaging_environment = metadata.imaging_environment
 
     # Write tifffile
-    tiff["ifds"][0]["tags"][tifftools.Tag.ImageDescription.value]["data"] = to_xml(ome)
+    write_image_description(tiff_path, to_xml(ome), in_place=in_place)
+
+
+@traced
+def merge_metadata_tiffs(
+    conn: BlitzGateway,
+    items: List[Tuple[int, str]],
+    workers: Optional[int] = None,
+    fetch_workers: int = 8,
+    batch_size: int = 50,
+    in_place: bool = True,
+    join: Callable[[BlitzGateway], BlitzGateway] = join_session,
+) -> List[MergeResult]:
+    """Merge metadata from many images to their tiff files in parallel.
+
+    Metadata is fetched by threads with joined sessions, while parsing,
+    merging and writing the OME-XML runs in a process pool as soon as each
+    fetched batch arrives.
+
+    Parameters
+    ----------
+    conn : omero.gateway.BlitzGateway
+        OMERO connection.
+    items : List[Tuple[int, str]]
+        Pairs of image ID and tiff file path.
+    workers : int, optional
+        Number of processes. Defaults to the number of CPUs.
+    fetch_workers : int
+        Number of threads fetching metadata from OMERO.
+    batch_size : int
+        Number of images prefetched at once by a fetch thread.
+    in_place : bool
+        See :func:`merge_metadata_tiff`.
+    join : Callable[[BlitzGateway], BlitzGateway]
+        Opens the connection of a fetch thread, ``join_session`` by default.
+
+    Returns
+    -------
+    results : List[MergeResult]
+        Result per item in the order of ``items``, with the error if it failed.
+    """
+    tiff_paths: Dict[int, List[str]] = {}
+    for image_id, tiff_path in items:
+        tiff_paths.setdefault(image_id, []).append(tiff_path)
+
+    image_ids = list(tiff_paths)
+    batches = [image_ids[start:start + batch_size] for start in range(0, len(image_ids), batch_size)]
+    errors: Dict[Tuple[int, str], Optional[BaseException]] = {}
+
+    def fetch(batch: List[int]) -> Dict[int, TiffMetadata]:
+        worker_conn = sessions.get()
+        return {
+            image_obj.getId(): export_tiff_metadata(image_obj)
+            for image_obj in prefetch_images(batch, worker_conn, rois=False)
+        }
+
+    # Spawn: forking a process running Ice threads is unsafe
+    with WorkerSessions(conn, join) as sessions, \
+            ThreadPoolExecutor(max_workers=fetch_workers) as fetch_executor, \
+            ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+        fetch_futures = {fetch_executor.submit(propagate_context(fetch), batch): batch for batch in batches}
+        merge_futures = {}
+
+        for fetch_future in as_completed(fetch_futures):
+            batch = fetch_futures[fetch_future]
+            try:
+                metadata = fetch_future.result()
+            except Exception as e:
+                metadata = {}
+                for image_id in batch:
+                    for tiff_path in tiff_paths[image_id]:
+                        errors[(image_id, tiff_path)] = e
+
+            for image_id in batch:
+                for tiff_path in tiff_paths[image_id]:
+                    if (image_id, tiff_path) in errors:
+                        continue
+                    if image_id not in metadata:
+                        errors[(image_id, tiff_path)] = ValueError(f"Image {image_id} not found")
+                        continue
+
+                    future = executor.submit(merge_metadata_description, tiff_path, metadata[image_id], in_place)
+                    merge_futures[future] = (image_id, tiff_path)
+
+        for future in as_completed(merge_futures):
+            errors[merge_futures[future]] = future.exception()
+
+    results = [MergeResult(image_id, tiff_path, errors[(image_id, tiff_path)]) for image_id, tiff_path in items]
+    for result in results:
+        if result.error is not None:
+            logging.error(f"Failed to merge metadata of image {result.image_id} to {result.tiff_path}: {result.error}")
+
+    return results
+
+
+class _DescriptionEntry(NamedTuple):
+    byte_order: str
+    bigtiff: bool
+    datatype: int
+    count: int
+    offset: int
+    entry_pos: int
+
+
+def _locate_image_description(fh: BinaryIO) -> Optional[_DescriptionEntry]:
+    # Find the ImageDescription tag of IFD0 without reading the rest of the file
+    header = fh.read(16)
+    if header[:2] == b"II":
+        byte_order = "<"
+    elif header[:2] == b"MM":
+        byte_order = ">"
+    else:
+        return None
+
+    version = struct.unpack(byte_order + "H", header[2:4])[0]
+    if version == 42:
+        bigtiff = False
+        ifd_offset = struct.unpack(byte_order + "I", header[4:8])[0]
+    elif version == 43:
+        bigtiff = True
+        ifd_offset = struct.unpack(byte_order + "Q", header[8:16])[0]
+    else:
+        return None
+
+    count_format, count_size, entry_size = ("Q", 8, 20) if bigtiff else ("H", 2, 12)
+    value_format, value_size = ("Q", 8) if bigtiff else ("I", 4)
+
+    fh.seek(ifd_offset)
+    num_entries = struct.unpack(byte_order + count_format, fh.read(count_size))[0]
+    entries = fh.read(num_entries * entry_size)
+
+    for i in range(num_entries):
+        entry = entries[i * entry_size:(i + 1) * entry_size]
+        tag, datatype = struct.unpack(byte_order + "HH", entry[:4])
+        if tag != tifftools.Tag.ImageDescription.value:
+            continue
+
+        count, offset = struct.unpack(byte_order + value_format * 2, entry[4:4 + 2 * value_size])
+        if count <= value_size:
+            # Value is stored inline in the entry; nothing to point at
+            return None
+
+        return _DescriptionEntry(
+            byte_order, bigtiff, datatype, count, offset, ifd_offset + count_size + i * entry_size
+        )
+    return None
+
+
+def read_image_description(tiff_path: str) -> str:
+    """Read the ImageDescription of the first IFD of a tiff file."""
+    with open(tiff_path, "rb") as fh:
+        entry = _locate_image_description(fh)
+        if entry is not None and entry.datatype == tifftools.Datatype.ASCII.value:
+            fh.seek(entry.offset)
+            return fh.read(entry.count).rstrip(b"\0").decode("utf-8")
+
+    tiff = tifftools.read_tiff(tiff_path)
+    return tiff["ifds"][0]["tags"][tifftools.Tag.ImageDescription.value]["data"]
+
+
+def write_image_description(tiff_path: str, description: str, in_place: bool = True) -> None:
+    """Replace the ImageDescription of the first IFD of a tiff file.
+
+    Parameters
+    ----------
+    tiff_path : str
+        File name of tiff file.
+    description : str
+        New ImageDescription, e.g. OME-XML.
+    in_place : bool
+        Append the description and patch the IFD0 entry instead of rewriting the
+        file. The previous description stays in the file as unreferenced bytes.
+    """
+    if in_place and _write_image_description_in_place(tiff_path, description):
+        return
+
+    tiff = tifftools.read_tiff(tiff_path)
+    tiff["ifds"][0]["tags"][tifftools.Tag.ImageDescription.value]["data"] = description
 
     # Wierd bug: not properly write tiff file if the file is existing even if it is removed or
     tifftools.write_tiff(tiff, tiff_path.replace(".tiff", "_new.tiff"))
@@ -54,6 +270,33 @@ def merge_metadata_tiff(image: ImageWrapper, tiff_path: str) -> None:
     os.rename(tiff_path.replace(".tiff", "_new.tiff"), tiff_path)
 
 
+def _write_image_description_in_place(tiff_path: str, description: str) -> bool:
+    data = description.encode("utf-8") + b"\0"
+
+    with open(tiff_path, "r+b") as fh:
+        entry = _locate_image_description(fh)
+        if entry is None or entry.datatype != tifftools.Datatype.ASCII.value:
+            return False
+
+        fh.seek(0, os.SEEK_END)
+        offset = fh.tell()
+        padding = offset % 2  # TIFF offsets are word aligned
+        offset += padding
+        if not entry.bigtiff and offset + len(data) > 0xFFFFFFFF:
+            return False
+
+        # Write the data before pointing the entry at it, so an interrupted
+        # write leaves the previous description intact
+        fh.write(b"\0" * padding + data)
+        fh.flush()
+
+        value_format = "Q" if entry.bigtiff else "I"
+        fh.seek(entry.entry_pos + 4)
+        fh.write(struct.pack(entry.byte_order + value_format * 2, len(data), offset))
+
+    return True
+
+
 def move_tiff_files(
     conn: BlitzGateway,
     target_type: str,
@@ -134,23 +377,11 @@ def rename_tiff_paths_by_screen(conn: BlitzGateway, screen_ids: List[int]) -> Li
     tiff_paths_sorted : list [str]
         List of sorted tiff file paths.
     """
-    tiff_paths_map = {}
-    plate_ids = []
-    for screen_id in screen_ids:
-        screen = conn.getObject("Screen", screen_id)
-        for plate in screen.listChildren():
-            plate_ids.append(plate.getId())
-            tiff_paths_map[plate.getId()] = "Screen-" + str(screen_id)
-
-    tiff_paths_sorted = [rename_tiff_paths_by_plate(conn, [plate_id]) for plate_id in plate_ids]
-    tiff_paths_sorted = [
-        os.path.join(tiff_paths_map[plate_id], value)
-        for plate_id, values in zip(plate_ids, tiff_paths_sorted)
-        for value in values
+    return [
+        os.path.join(f"Screen-{screen_id}", f"Plate-{plate_id}", f"{well_position(*well)}-{image_id}.tiff")
+        for screen_id, plate_id, *well, image_id in query_layout(conn, "Screen", screen_ids)
     ]
 
-    return tiff_paths_sorted
-
 
 def rename_tiff_paths_by_plate(conn: BlitzGateway, plate_ids: List[int]) -> List[str]:
     """Rename tiff paths by their screen/plate/dataset/project folder structure.
@@ -173,25 +404,11 @@ def rename_tiff_paths_by_plate(conn: BlitzGateway, plate_ids: List[int]) -> List
     tiff_paths_sorted : list [str]
         List of sorted tiff file paths.
     """
-    tiff_paths_map = {}
-    image_ids = []
-    for plate_id in plate_ids:
-        plate = conn.getObject("Plate", plate_id)
-        for well in plate.listChildren():
-            for ws in well.listChildren():
-                image = ws.image()
-                image_ids.append(image.getId())
-                tiff_paths_map[image.getId()] = os.path.join(
-                    "Plate-" + str(plate_id), well.getWellPos() + "-"
-                )
-
-    tiff_paths_sorted = rename_tiff_paths_by_image(conn, image_ids)
-    tiff_paths_sorted = [
-        tiff_paths_map[image_id] + value for image_id, value in zip(image_ids, tiff_paths_sorted)
+    return [
+        os.path.join(f"Plate-{plate_id}", f"{well_position(*well)}-{image_id}.tiff")
+        for plate_id, *well, image_id in query_layout(conn, "Plate", plate_ids)
     ]
 
-    return tiff_paths_sorted
-
 
 def rename_tiff_paths_by_dataset(conn: BlitzGateway, dataset_ids: List[int]) -> List[str]:
     """Sort tiff paths by their screen/plate/dataset/project folder structure.
@@ -214,22 +431,11 @@ def rename_tiff_paths_by_dataset(conn: BlitzGateway, dataset_ids: List[int]) ->
     tiff_paths_sorted : list [str]
         List of sorted tiff file paths.
     """
-    tiff_paths_map = {}
-    image_ids = []
-    for dataset_id in dataset_ids:
-        dataset = conn.getObject("Dataset", dataset_id)
-        for image in dataset.listChildren():
-            image_ids.append(image.getId())
-            tiff_paths_map[image.getId()] = "Dataset-" + str(dataset.getId())
-
-    tiff_paths_sorted = rename_tiff_paths_by_image(conn, image_ids, add_name=True)
-    tiff_paths_sorted = [
-        os.path.join(tiff_paths_map[image_id], value)
-        for image_id, value in zip(image_ids, tiff_paths_sorted)
+    return [
+        os.path.join(f"Dataset-{dataset_id}", f"{_clean_name(name)}-{image_id}.tiff")
+        for dataset_id, image_id, name in query_layout(conn, "Dataset", dataset_ids)
     ]
 
-    return tiff_paths_sorted
-
 
 def rename_tiff_paths_by_project(conn: BlitzGateway, project_ids: List[int]) -> List[str]:
     """Sort tiff paths by their screen/plate/dataset/project folder structure.
@@ -252,25 +458,11 @@ def rename_tiff_paths_by_project(conn: BlitzGateway, project_ids: List[int]) ->
     tiff_paths_sorted : list [str]
         List of sorted tiff file paths.
     """
-    tiff_paths_map = {}
-    dataset_ids = []
-    for project_id in project_ids:
-        project = conn.getObject("Project", project_id)
-        for dataset in project.listChildren():
-            dataset_ids.append(dataset.getId())
-            tiff_paths_map[dataset.getId()] = "Project-" + str(project.getId())
-
-    tiff_paths_sorted = [
-        rename_tiff_paths_by_dataset(conn, dataset_id) for dataset_id in dataset_ids
-    ]
-    tiff_paths_sorted = [
-        os.path.join(tiff_paths_map[dataset_id], value)
-        for dataset_id, values in zip(dataset_ids, tiff_paths_sorted)
-        for value in values
+    return [
+        os.path.join(f"Project-{project_id}", f"Dataset-{dataset_id}", f"{_clean_name(name)}-{image_id}.tiff")
+        for project_id, dataset_id, image_id, name in query_layout(conn, "Project", project_ids)
     ]
 
-    return tiff_paths_sorted
-
 
 def rename_tiff_paths_by_image(
     conn: BlitzGateway, image_ids: List[int], add_name: bool = False
@@ -299,20 +491,20 @@ def rename_tiff_paths_by_image(
         List of sorted tiff file paths.
     """
 
-    def clean_name(name: str, valid_chars: Optional[str] = None) -> str:
-        if valid_chars is None:
-            valid_chars = "-_.() %s%s" % (string.ascii_letters, string.digits)
+    if not add_name:
+        return [f"{image_id}.tiff" for image_id in image_ids]
 
-        cleaned_name = "".join(c for c in name if c in valid_chars)
-        return cleaned_name
+    names = {image_id: name for image_id, name in query_layout(conn, "Image", image_ids)}
+    missing = [image_id for image_id in image_ids if image_id not in names]
+    if missing:
+        raise ValueError(f"Images not found: {missing}")
 
-    tiff_paths_sorted = []
-    for image_id in image_ids:
-        image = conn.getObject("Image", image_id)
-        if add_name:
-            cleaned_name = clean_name(image.getName())
-            tiff_paths_sorted.append(f"{cleaned_name}-{image.getId()}.tiff")
-        else:
-            tiff_paths_sorted.append(f"{image.getId()}.tiff")
+    return [f"{_clean_name(names[image_id])}-{image_id}.tiff" for image_id in image_ids]
 
-    return tiff_paths_sorted
+
+def _clean_name(name: str, valid_chars: Optional[str] = None) -> str:
+    if valid_chars is None:
+        valid_chars = "-_.() %s%s" % (string.ascii_letters, string.digits)
+
+    cleaned_name = "".join(c for c in name if c in valid_chars)
+    return cleaned_name
@@ -0,0 +1,124 @@
+# Copyright (c) 2023 Qureator, Inc. All rights reserved.
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Union
+
+from ome_types import OME
+from omero.gateway import BlitzGateway
+
+from ..masks import MaskStore
+from ..sessions import WorkerSessions, join_session
+from ..tracing import propagate_context, traced
+from .cache import MetadataCache, export_images_metadata_cached
+from .exports import OMEBuilder, prefetch_images
+from .hierarchy import resolve_image_ids
+
+__all__ = ["export_metadata_parallel"]
+
+
+@traced
+def export_metadata_parallel(
+    conn: BlitzGateway,
+    target_type: str,
+    target_ids: List[int],
+    workers: int = 8,
+    batch_size: int = 50,
+    per_image: bool = False,
+    plane_table: bool = False,
+    masks: Optional[MaskStore] = None,
+    cache: Optional[MetadataCache] = None,
+    join: Callable[[BlitzGateway], BlitzGateway] = join_session,
+) -> Union[OME, Dict[int, OME]]:
+    """Export image metadata concurrently with one joined session per worker.
+
+    Parameters
+    ----------
+    conn : omero.gateway.BlitzGateway
+        OMERO connection. Workers join its session and group.
+
+    target_type : str
+        Data type of the data ID.
+        e.g. 'Screen', 'Plate', 'Project', 'Dataset', 'Image'
+
+    target_ids : List[int]
+        Data IDs whose images are exported.
+
+    workers : int
+        Number of worker threads and sessions.
+
+    batch_size : int
+        Number of images prefetched and exported by a worker at once.
+
+    per_image : bool
+        Return one OME document per image instead of a single merged document.
+
+    plane_table : bool
+        Load planes as columns with one projection query per batch.
+
+    masks : MaskStore, optional
+        Sidecar shared by the workers for the mask bytes.
+
+    cache : MetadataCache, optional
+        Serve unchanged images from this cache. Only used for merged documents.
+
+    join : Callable[[BlitzGateway], BlitzGateway]
+        Opens the connection of a worker, ``join_session`` by default, e.g.
+        ``FakeGateway.join`` offline.
+
+    Returns
+    -------
+    ome : ome_types.OME or Dict[int, ome_types.OME]
+        Merged document, or documents by image ID. Images are in the same order
+        regardless of the number of workers.
+    """
+    image_ids = resolve_image_ids(conn, target_type, target_ids)
+    batches = [image_ids[start:start + batch_size] for start in range(0, len(image_ids), batch_size)]
+
+    with WorkerSessions(conn, join) as sessions, ThreadPoolExecutor(max_workers=workers) as executor:
+        if per_image:
+            results = executor.map(
+                propagate_context(lambda batch: _export_batch_per_image(sessions, batch, plane_table, masks)), batches
+            )
+            omes = {}
+            for res in results:
+                omes.update(res)
+            return {image_id: omes[image_id] for image_id in image_ids if image_id in omes}
+
+        builder = OMEBuilder(plane_table=plane_table, masks=masks)
+        # map yields in submission order, which keeps the merged document deterministic
+        export_batch = propagate_context(lambda batch: _export_batch(sessions, batch, plane_table, masks, cache))
+        for batch_builder in executor.map(export_batch, batches):
+            builder.merge(batch_builder)
+
+        return builder.build()
+
+
+def _export_batch(
+    sessions: WorkerSessions,
+    image_ids: List[int],
+    plane_table: bool,
+    masks: Optional[MaskStore],
+    cache: Optional[MetadataCache],
+) -> OMEBuilder:
+    builder = OMEBuilder(plane_table=plane_table, masks=masks)
+    if cache is None:
+        builder.add_images(image_ids, sessions.get(), batch_size=len(image_ids))
+    else:
+        export_images_metadata_cached(
+            image_ids, sessions.get(), builder, cache, batch_size=len(image_ids), plane_table=plane_table
+        )
+    return builder
+
+
+def _export_batch_per_image(
+    sessions: WorkerSessions, image_ids: List[int], plane_table: bool, masks: Optional[MaskStore]
+) -> Dict[int, OME]:
+    worker_conn = sessions.get()
+
+    omes = {}
+    for image_obj in prefetch_images(image_ids, worker_conn, plane_tables=plane_table):
+        builder = OMEBuilder(plane_table=plane_table, masks=masks)
+        builder.add_image(image_obj, worker_conn)
+        omes[image_obj.getId()] = builder.build()
+
+    return omes
@@ -0,0 +1,96 @@
+# Copyright (c) 2023 Qureator, Inc. All rights reserved.
+
+import threading
+from typing import Callable, List
+
+import omero
+from omero.gateway import BlitzGateway
+
+from .tracing import trace_connection
+
+
+def join_session(conn: BlitzGateway) -> BlitzGateway:
+    """Open a new connection joined to the session of an existing one.
+
+    Parameters
+    ----------
+    conn : omero.gateway.BlitzGateway
+        Connected gateway whose session is joined. Its group context is copied.
+
+    Returns
+    -------
+    worker_conn : omero.gateway.BlitzGateway
+        Independent connection sharing the session. Close it with
+        ``close(hard=False)`` so the shared session stays alive. Traced if
+        ``conn`` is, see ``trace_connection``.
+    """
+    host = conn.c.getProperty("omero.host")
+    port = conn.c.getProperty("omero.port") or "4064"
+
+    client = omero.client(host, int(port))
+    client.joinSession(conn.c.getSessionId())
+
+    worker_conn = BlitzGateway(client_obj=client)
+    group_id = conn.SERVICE_OPTS.getOmeroGroup()
+    if group_id is not None:
+        worker_conn.SERVICE_OPTS.setOmeroGroup(str(group_id))
+
+    return _trace_like(conn, worker_conn)
+
+
+def _trace_like(conn: BlitzGateway, worker_conn: BlitzGateway) -> BlitzGateway:
+    if getattr(conn, "_traced", False):
+        trace_connection(worker_conn)
+    return worker_conn
+
+
+class WorkerSessions:
+    """One joined connection per worker thread, all closed together.
+
+    Parameters
+    ----------
+    conn : omero.gateway.BlitzGateway
+        Connected gateway whose session the workers join.
+
+    join : Callable[[BlitzGateway], BlitzGateway]
+        Opens the connection of a worker from ``conn``, :func:`join_session`
+        by default. Worker connections are traced if ``conn`` is.
+
+    Examples
+    --------
+    >>> with WorkerSessions(conn) as sessions:
+    ...     with ThreadPoolExecutor(8) as executor:
+    ...         executor.submit(lambda: sessions.get().getObject("Image", 1))
+    """
+
+    def __init__(self, conn: BlitzGateway, join: Callable[[BlitzGateway], BlitzGateway] = join_session):
+        self._conn = conn
+        self._join = join
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._worker_conns: List[BlitzGateway] = []
+
+    def get(self) -> BlitzGateway:
+        worker_conn = getattr(self._local, "conn", None)
+
+        if worker_conn is None:
+            worker_conn = self._local.conn = _trace_like(self._conn, self._join(self._conn))
+            with self._lock:
+                self._worker_conns.append(worker_conn)
+
+        return worker_conn
+
+    def close(self) -> None:
+        with self._lock:
+            worker_conns, self._worker_conns = self._worker_conns, []
+            self._local = threading.local()
+
+        for worker_conn in worker_conns:
+            # Detach only; a hard close would kill the session shared with the caller
+            worker_conn.close(hard=False)
+
+    def __enter__(self) -> "WorkerSessions":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
@@ -0,0 +1,410 @@
+# Copyright (c) 2023 Qureator, Inc. All rights reserved.
+"""Spans around server calls and export/attach functions, aggregated per function.
+
+Tracing is off unless a :class:`Tracer` is activated in the current context.
+Decorated functions then only pay for one context variable lookup.
+
+Examples
+--------
+>>> tracer = Tracer()
+>>> with tracer.activate():
+...     conn = trace_connection(conn)
+...     ome = export_images_metadata(image_ids, conn, OME())
+>>> tracer.summary()["functions"]["QueryService.findAllByQuery"]["count"]
+5
+>>> tracer.to_chrome_trace("trace.json")  # open in chrome://tracing or Perfetto
+"""
+
+import bisect
+import contextvars
+import functools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from typing import Any, Callable, ContextManager, Dict, Iterator, List, Optional, Tuple
+
+from omero.gateway import BlitzGateway
+
+SERVER = "server"
+FUNCTION = "function"
+
+# Upper bounds in seconds, doubling from 0.1 ms to about 105 s, plus one overflow bucket
+HISTOGRAM_BOUNDS: Tuple[float, ...] = tuple(1e-4 * 2 ** i for i in range(21))
+
+TRACED_SERVICES = (
+    "getQueryService",
+    "getUpdateService",
+    "getTypesService",
+    "getRoiService",
+    "getMetadataService",
+    "getContainerService",
+)
+TRACED_METHODS = ("getObject", "getObjects", "deleteObjects", "createRenderingEngine")
+
+_active_tracer: "contextvars.ContextVar[Optional[Tracer]]" = contextvars.ContextVar("tracer", default=None)
+_current_span: "contextvars.ContextVar[Optional[Span]]" = contextvars.ContextVar("span", default=None)
+
+
+class Span:
+    """One timed call. ``start`` and ``end`` are ``time.perf_counter`` values."""
+
+    __slots__ = ("name", "category", "attributes", "parent", "thread_id", "start", "end", "error", "child_seconds")
+
+    def __init__(self, name: str, category: str, attributes: Dict[str, Any], parent: Optional["Span"]):
+        self.name = name
+        self.category = category
+        self.attributes = attributes
+        self.parent = parent
+        self.thread_id = threading.get_ident()
+        self.start = time.perf_counter()
+        self.end: Optional[float] = None
+        self.error: Optional[str] = None
+        # Time spent in child spans of the same thread
+        self.child_seconds = 0.0
+
+    @property
+    def seconds(self) -> float:
+        return (self.end if self.end is not None else time.perf_counter()) - self.start
+
+    @property
+    def self_seconds(self) -> float:
+        """Time not spent in child spans, e.g. building ome_types models rather than waiting for the server."""
+        return self.seconds - self.child_seconds
+
+
+class FunctionStats:
+    """Count, times and latency histogram of the spans of one function."""
+
+    def __init__(self, name: str, category: str):
+        self.name = name
+        self.category = category
+        self.count = 0
+        self.errors = 0
+        self.total_seconds = 0.0
+        self.self_seconds = 0.0
+        self.min_seconds = float("inf")
+        self.max_seconds = 0.0
+        self.histogram = [0] * (len(HISTOGRAM_BOUNDS) + 1)
+
+    def add(self, span: Span) -> None:
+        seconds = span.seconds
+        self.count += 1
+        self.errors += span.error is not None
+        self.total_seconds += seconds
+        self.self_seconds += span.self_seconds
+        self.min_seconds = min(self.min_seconds, seconds)
+        self.max_seconds = max(self.max_seconds, seconds)
+        self.histogram[bisect.bisect_left(HISTOGRAM_BOUNDS, seconds)] += 1
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Upper bound of the histogram bucket holding quantile ``q``, capped by the maximum."""
+        if not self.count:
+            return None
+
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.histogram):
+            seen += count
+            if seen >= rank and count:
+                return min(HISTOGRAM_BOUNDS[i], self.max_seconds) if i < len(HISTOGRAM_BOUNDS) else self.max_seconds
+        return self.max_seconds
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "category": self.category,
+            "count": self.count,
+            "errors": self.errors,
+            "total_seconds": self.total_seconds,
+            "self_seconds": self.self_seconds,
+            "mean_seconds": self.total_seconds / self.count if self.count else None,
+            "min_seconds": self.min_seconds if self.count else None,
+            "max_seconds": self.max_seconds,
+            "p50_seconds": self.quantile(0.5),
+            "p90_seconds": self.quantile(0.9),
+            "p99_seconds": self.quantile(0.99),
+            "histogram": {"bounds": list(HISTOGRAM_BOUNDS), "counts": list(self.histogram)},
+        }
+
+
+class Tracer:
+    """Collects spans and aggregates them per function.
+
+    Parameters
+    ----------
+    on_start : Callable[[Span], None], optional
+        Called when a span starts, in the thread running it.
+
+    on_end : Callable[[Span], None], optional
+        Called when a span ends, in the thread running it, e.g. to forward
+        spans to another tracing system.
+
+    max_spans : int, optional
+        Number of finished spans kept for :meth:`to_chrome_trace`. Later spans
+        are only aggregated. 0 keeps none, None keeps all.
+    """
+
+    def __init__(
+        self,
+        on_start: Optional[Callable[[Span], None]] = None,
+        on_end: Optional[Callable[[Span], None]] = None,
+        max_spans: Optional[int] = 100_000,
+    ):
+        self.max_spans = max_spans
+        self.dropped_spans = 0
+        self._on_start: List[Callable[[Span], None]] = [on_start] if on_start else []
+        self._on_end: List[Callable[[Span], None]] = [on_end] if on_end else []
+        self._lock = threading.Lock()
+        self._stats: Dict[str, FunctionStats] = {}
+        self._spans: List[Span] = []
+        self._thread_names: Dict[int, str] = {}
+        self._origin = time.perf_counter()
+
+    def subscribe(
+        self,
+        on_end: Optional[Callable[[Span], None]] = None,
+        on_start: Optional[Callable[[Span], None]] = None,
+    ) -> None:
+        if on_start is not None:
+            self._on_start.append(on_start)
+        if on_end is not None:
+            self._on_end.append(on_end)
+
+    @contextmanager
+    def activate(self) -> Iterator["Tracer"]:
+        """Trace the calls of the current context, and of worker threads it propagates to."""
+        token = _active_tracer.set(self)
+        try:
+            yield self
+        finally:
+            _active_tracer.reset(token)
+
+    @contextmanager
+    def span(self, name: str, category: str = FUNCTION, **attributes) -> Iterator[Span]:
+        span = Span(name, category, attributes, _current_span.get())
+        token = _current_span.set(span)
+        for callback in self._on_start:
+            callback(span)
+
+        try:
+            yield span
+        except BaseException as e:
+            span.error = type(e).__name__
+            raise
+        finally:
+            span.end = time.perf_counter()
+            _current_span.reset(token)
+            if span.parent is not None and span.parent.thread_id == span.thread_id:
+                span.parent.child_seconds += span.seconds
+            self._finish(span)
+
+    def _finish(self, span: Span) -> None:
+        with self._lock:
+            stats = self._stats.get(span.name)
+            if stats is None:
+                stats = self._stats[span.name] = FunctionStats(span.name, span.category)
+            stats.add(span)
+
+            if self.max_spans is None or len(self._spans) < self.max_spans:
+                self._spans.append(span)
+                if span.thread_id not in self._thread_names:
+                    self._thread_names[span.thread_id] = threading.current_thread().name
+            else:
+                self.dropped_spans += 1
+
+        for callback in self._on_end:
+            callback(span)
+
+    @property
+    def stats(self) -> Dict[str, FunctionStats]:
+        with self._lock:
+            return dict(self._stats)
+
+    @property
+    def spans(self) -> List[Span]:
+        with self._lock:
+            return list(self._spans)
+
+    def reset(self) -> None:
+        with self._lock:
+            self._stats = {}
+            self._spans = []
+            self._thread_names = {}
+            self.dropped_spans = 0
+            self._origin = time.perf_counter()
+
+    def summary(self) -> Dict[str, Any]:
+        """Aggregates per function, slowest total first."""
+        with self._lock:
+            functions = sorted(self._stats.values(), key=lambda stats: stats.total_seconds, reverse=True)
+            return {
+                "functions": {stats.name: stats.to_dict() for stats in functions},
+                "spans": len(self._spans),
+                "dropped_spans": self.dropped_spans,
+            }
+
+    def to_json(self, path: str) -> None:
+        """Write :meth:`summary` to a JSON file."""
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.summary(), f, indent=2)
+
+    def to_chrome_trace(self, path: str) -> None:
+        """Write the kept spans in the Chrome trace event format, for chrome://tracing or Perfetto."""
+        pid = os.getpid()
+        with self._lock:
+            spans = list(self._spans)
+            thread_names = dict(self._thread_names)
+            origin = self._origin
+
+        events = [
+            {"name": "thread_name", "ph": "M", "pid": pid, "tid": thread_id, "args": {"name": name}}
+            for thread_id, name in thread_names.items()
+        ]
+        for span in spans:
+            args = {name: _jsonable(value) for name, value in span.attributes.items()}
+            if span.error is not None:
+                args["error"] = span.error
+            events.append({
+                "name": span.name,
+                "cat": span.category,
+                "ph": "X",
+                "ts": (span.start - origin) * 1e6,
+                "dur": span.seconds * 1e6,
+                "pid": pid,
+                "tid": span.thread_id,
+                "args": args,
+            })
+
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+
+def _jsonable(value: Any) -> Any:
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    return str(value)
+
+
+def active_tracer() -> Optional[Tracer]:
+    return _active_tracer.get()
+
+
+def span(name: str, category: str = FUNCTION, **attributes) -> ContextManager[Optional[Span]]:
+    """Span of the active tracer, or a no-op context if tracing is off."""
+    tracer = _active_tracer.get()
+    if tracer is None:
+        return nullcontext()
+    return tracer.span(name, category, **attributes)
+
+
+def traced(func: Optional[Callable] = None, *, name: Optional[str] = None, category: str = FUNCTION):
+    """Decorator running each call of a function in a span.
+
+    The span name defaults to the module and qualified name, e.g.
+    'image.attach_planes_metadata', which keeps functions of the same name in
+    different modules apart.
+    """
+
+    def decorate(func: Callable) -> Callable:
+        span_name = name or f"{func.__module__.rsplit('.', 1)[-1]}.{func.__qualname__}"
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            tracer = _active_tracer.get()
+            if tracer is None:
+                return func(*args, **kwargs)
+            with tracer.span(span_name, category):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    if func is None:
+        return decorate
+    return decorate(func)
+
+
+class _TracedService:
+    """Proxy of a service whose method calls are server spans, e.g. 'QueryService.findAllByQuery'."""
+
+    def __init__(self, service: Any, name: str):
+        self._service = service
+        self._name = name
+
+    def __getattr__(self, attr: str) -> Any:
+        value = getattr(self._service, attr)
+        if attr.startswith("_") or not callable(value):
+            return value
+        return _traced_call(value, f"{self._name}.{attr}")
+
+
+def _traced_call(method: Callable, span_name: str) -> Callable:
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        tracer = _active_tracer.get()
+        if tracer is None:
+            return method(*args, **kwargs)
+        with tracer.span(span_name, SERVER):
+            return method(*args, **kwargs)
+
+    return wrapper
+
+
+def trace_connection(conn: BlitzGateway) -> BlitzGateway:
+    """Trace the server calls of a connection while a tracer is active.
+
+    The service getters and ``getObject``, ``getObjects``, ``deleteObjects`` and
+    ``createRenderingEngine`` are replaced on the instance itself, so the lazy
+    loads of the ``omero.gateway`` wrappers holding ``conn`` are traced too.
+    The worker connections :class:`WorkerSessions` joins from it are traced as well.
+
+    Parameters
+    ----------
+    conn : omero.gateway.BlitzGateway
+        Connection to trace. Tracing it again has no effect.
+
+    Returns
+    -------
+    conn : omero.gateway.BlitzGateway
+        The same connection.
+    """
+    if getattr(conn, "_traced", False):
+        return conn
+
+    for getter in TRACED_SERVICES:
+        original = getattr(conn, getter, None)
+        if original is not None:
+            setattr(conn, getter, _traced_getter(original, getter[len("get"):]))
+
+    for method in TRACED_METHODS:
+        original = getattr(conn, method, None)
+        if original is not None:
+            setattr(conn, method, _traced_call(original, method))
+
+    conn._traced = True
+    return conn
+
+
+def _traced_getter(getter: Callable, service_name: str) -> Callable:
+    @functools.wraps(getter)
+    def wrapper(*args, **kwargs):
+        return _TracedService(getter(*args, **kwargs), service_name)
+
+    return wrapper
+
+
+def propagate_context(func: Callable) -> Callable:
+    """Run ``func`` in a copy of the caller's context, e.g. the active tracer and span, from any thread.
+
+    Examples
+    --------
+    >>> executor.map(propagate_context(export_batch), batches)
+    """
+    context = contextvars.copy_context()
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        # One copy per call, a context cannot be entered by two threads at once
+        return context.copy().run(func, *args, **kwargs)
+
+    return wrapper
@@ -1 +1,5 @@
-from .imports import attach_image_metadata, create_instruments
+from .imports import (
+    attach_image_metadata, attach_image_metadata_delta, create_instruments, InstrumentIndex, TransferJournal,
+)
+from .parallel import attach_images_metadata_parallel
+from .reader import attach_images_metadata_streamed, iter_ome_xml
@@ -6,15 +6,28 @@ from .channel import (
     attach_channel_metadata,
     attach_logical_channel_metadata
 )
-from .common import update_metadata, update_length_metadata, update_enum_metadata
+from .common import (
+    update_metadata, update_length_metadata, update_enum_metadata,
+    EnumCache, get_enum_cache, get_enumeration, invalidate_enum_cache,
+    object_key, object_references, unloaded_objects,
+)
+from .delta import attach_image_metadata_delta
+from .fingerprint import canonical_metadata, instrument_fingerprint, InstrumentIndex
 from .image import (
     attach_image_metadata,
     attach_pixels_metadata,
+    attach_planes_metadata,
+    attach_planes_metadata_chunked,
+    attach_planes_metadata_upsert,
+    build_plane_info,
     attach_imaging_environment_metadata,
     attach_objective_settings_metadata
 )
 from .instrument import (
     create_instrument, create_instruments,
+    create_instrument_graph,
+    build_instrument,
+    match_instrument_objects,
     create_microscope,
     create_filters,
     create_detectors,
@@ -22,3 +35,5 @@ from .instrument import (
     create_objectives,
     create_light_sources,
 )
+from .journal import TransferJournal
+from .roi import create_rois, build_roi, build_shape
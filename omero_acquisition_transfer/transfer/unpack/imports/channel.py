@@ -23,9 +23,11 @@ from omero.model import (
     LogicalChannelI,
 )
 
+from ...tracing import traced
 from .common import update_metadata, update_length_metadata, update_enum_metadata
 
 
+@traced
 def attach_channels_metadata(
         channels: List[Channel],
         image_obj: ImageWrapper,
@@ -41,6 +43,7 @@ def attach_channels_metadata(
         ch_obj = attach_channel_metadata(channel, ch_obj, conn, omero_id_to_obj)
 
 
+@traced
 def attach_channel_metadata(
         channel: Channel, ch_obj: ChannelI, conn: BlitzGateway, omero_id_to_obj: Dict[str, Any]
 ) -> ChannelI:
@@ -51,6 +54,7 @@ def attach_channel_metadata(
     return ch_obj
 
 
+@traced
 def attach_logical_channel_metadata(
         channel: Channel, conn: BlitzGateway, omero_id_to_obj: Dict[str, Any]
 ) -> LogicalChannelWrapper:
@@ -73,6 +77,7 @@ def attach_logical_channel_metadata(
     return lch_obj
 
 
+@traced
 def create_logical_channel(
         channel: Channel,
         conn: Optional[BlitzGateway] = None
@@ -100,6 +105,7 @@ def create_logical_channel(
     return lch_obj
 
 
+@traced
 def create_light_path(
         light_path: LightPath,
         lp_obj: LightPathWrapper,
@@ -144,6 +150,7 @@ def create_light_path(
     return lp_obj
 
 
+@traced
 def create_light_source_settings(
         light_source_settings: LightSourceSettings,
         lss_obj: LightSettingsI,
@@ -165,6 +172,7 @@ def create_light_source_settings(
     return lss_obj
 
 
+@traced
 def create_detector_settings(
         detector_settings: DetectorSettings,
         det_obj: DetectorSettingsWrapper,
@@ -1,10 +1,13 @@
 # Copyright (c) 2023 Qureator, Inc. All rights reserved.
 
-from typing import Any
+import threading
+import weakref
+from typing import Any, Dict, Optional, Tuple
 
+import omero.model
 from omero.gateway import BlitzGateway
-from omero.rtypes import rstring, rint, rdouble, rlong
-from omero.model import LengthI, TimeI
+from omero.rtypes import rstring, rint, rdouble, rlong, unwrap
+from omero.model import IObject, LengthI, TimeI
 from omero.model.enums import UnitsLength
 
 
@@ -45,8 +48,97 @@ def update_enum_metadata(obj: Any, name: str, metadata: Any, enum_class_name: st
         if not isinstance(metadata, str):
             metadata = metadata.value
 
-        var = conn.getTypesService().getEnumeration(enum_class_name, metadata)
+        var = get_enumeration(conn, enum_class_name, metadata)
         setattr(obj, name, var)
         status = True
 
     return status
+
+
+def object_key(obj: Any, fields: Tuple[str, ...]) -> Tuple:
+    key = [obj.__class__.__name__]
+
+    for field in fields:
+        # Fields missing on a subclass (e.g. wavelength of an Arc) are None
+        value = getattr(obj, field, None)
+
+        if value is None:
+            key.append(None)
+        elif isinstance(value, IObject):
+            key.append(value.getId().getValue())
+        elif hasattr(value, 'getUnit'):
+            key.append((value.getValue(), str(value.getUnit())))
+        else:
+            key.append(unwrap(value))
+
+    return tuple(key)
+
+
+def object_references(omero_id_to_obj: Dict[str, Any]) -> Dict[str, Tuple[str, int]]:
+    # Plain (class name, ID) pairs, safe to share between threads and to persist
+    return {
+        key: (obj.__class__.__name__, obj.getId().getValue())
+        for key, obj in omero_id_to_obj.items()
+    }
+
+
+def unloaded_objects(references: Dict[str, Tuple[str, int]]) -> Dict[str, Any]:
+    return {
+        key: getattr(omero.model, class_name)(id_, False)
+        for key, (class_name, id_) in references.items()
+    }
+
+
+class EnumCache:
+    """Enumeration objects of one connection, loaded once per enumeration class."""
+
+    def __init__(self):
+        self._enums: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, conn: BlitzGateway, enum_class_name: str, value: str) -> Any:
+        with self._lock:
+            enums = self._enums.get(enum_class_name)
+
+        if enums is None:
+            enums = {
+                enum_obj.getValue().getValue(): enum_obj
+                for enum_obj in conn.getTypesService().allEnumerations(enum_class_name)
+            }
+            with self._lock:
+                enums = self._enums.setdefault(enum_class_name, enums)
+
+        if value not in enums:
+            # Created on the server after the class was loaded, or invalid (raises as before)
+            enum_obj = conn.getTypesService().getEnumeration(enum_class_name, value)
+            with self._lock:
+                enums[value] = enum_obj
+
+        return enums[value]
+
+    def invalidate(self, enum_class_name: Optional[str] = None) -> None:
+        with self._lock:
+            if enum_class_name is None:
+                self._enums.clear()
+            else:
+                self._enums.pop(enum_class_name, None)
+
+
+_enum_caches: "weakref.WeakKeyDictionary[BlitzGateway, EnumCache]" = weakref.WeakKeyDictionary()
+_enum_caches_lock = threading.Lock()
+
+
+def get_enum_cache(conn: BlitzGateway) -> EnumCache:
+    with _enum_caches_lock:
+        cache = _enum_caches.get(conn)
+        if cache is None:
+            cache = _enum_caches[conn] = EnumCache()
+    return cache
+
+
+def get_enumeration(conn: BlitzGateway, enum_class_name: str, value: str) -> Any:
+    return get_enum_cache(conn).get(conn, enum_class_name, value)
+
+
+def invalidate_enum_cache(conn: BlitzGateway, enum_class_name: Optional[str] = None) -> None:
+    get_enum_cache(conn).invalidate(enum_class_name)
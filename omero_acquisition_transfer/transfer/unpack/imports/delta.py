@@ -0,0 +1,182 @@
+# Copyright (c) 2023 Qureator, Inc. All rights reserved.
+
+import logging
+from typing import Any, Dict, List, Optional
+
+from ome_types.model import Channel, Image
+from omero.gateway import BlitzGateway, ImageWrapper
+from omero.rtypes import rstring
+from pydantic import BaseModel
+
+from ...pack.exports import (
+    PlaneTable,
+    export_channel_metadata,
+    export_imaging_environment_metadata,
+    export_objective_settings_metadata,
+    export_stage_label_metadata,
+    load_plane_table,
+)
+from ...tracing import traced
+from .channel import attach_channel_metadata
+from .fingerprint import canonical_metadata
+from .image import (
+    attach_imaging_environment_metadata,
+    attach_objective_settings_metadata,
+    attach_planes_metadata_upsert,
+    attach_stage_label_metadata,
+)
+
+
+@traced
+def attach_image_metadata_delta(
+        image: Image,
+        image_obj: ImageWrapper,
+        omero_id_to_object: Dict[str, Any],
+        conn: BlitzGateway,
+        plane_chunk_size: int = 1000,
+        dry_run: bool = False,
+) -> List[str]:
+    """Attach only the parts of the image metadata that differ from the target.
+
+    The current state of the target is exported with the pack functions and
+    compared with ``image`` section by section, ignoring IDs but comparing
+    references to instrument components through ``omero_id_to_object``.
+
+    Parameters
+    ----------
+    image : ome_types.model.Image
+        Incoming image metadata.
+    image_obj : omero.gateway.ImageWrapper
+        Target image.
+    omero_id_to_object : Dict[str, Any]
+        Created instrument objects by OME ID, e.g. from ``create_instruments``.
+    conn : omero.gateway.BlitzGateway
+        OMERO connection to the target server.
+    plane_chunk_size : int
+        Chunk size used when changed planes are saved.
+    dry_run : bool
+        Only report the changed sections without writing them.
+
+    Returns
+    -------
+    changed : List[str]
+        Changed sections, e.g. ['name', 'channel:0', 'planes'].
+    """
+    if image is None:
+        return []
+
+    if image_obj is None or image_obj._obj is None:
+        raise ValueError("image_obj is None")
+
+    changed = []
+
+    if (image.name or None) != (image_obj.getName() or None) or \
+            (image.description or None) != (image_obj.getDescription() or None):
+        changed.append('name')
+        if not dry_run:
+            # On the model object, attributes set on the wrapper are not saved
+            image_obj._obj.setName(rstring(image.name or ''))
+            image_obj._obj.setDescription(None if image.description is None else rstring(image.description))
+            image_obj.save()
+
+    if image.instrument_ref is not None:
+        instrument_obj = image_obj.getInstrument()
+        current_id = None if instrument_obj is None else instrument_obj.getId()
+        if current_id != _target_id(image.instrument_ref.id, omero_id_to_object):
+            changed.append('instrument')
+            if not dry_run:
+                image_obj.setInstrument(omero_id_to_object[image.instrument_ref.id])
+                image_obj.save()
+
+    if image.objective_settings is not None:
+        current = export_objective_settings_metadata(image_obj.getObjectiveSettings())
+        if not _same(image.objective_settings, current, omero_id_to_object, own_ref=True):
+            changed.append('objective_settings')
+            if not dry_run:
+                attach_objective_settings_metadata(image.objective_settings, image_obj, omero_id_to_object, conn)
+
+    if image.imaging_environment is not None:
+        current = export_imaging_environment_metadata(image_obj.getImagingEnvironment())
+        if not _same(image.imaging_environment, current, omero_id_to_object):
+            changed.append('imaging_environment')
+            if not dry_run:
+                attach_imaging_environment_metadata(image.imaging_environment, image_obj, conn)
+
+    if image.stage_label is not None:
+        current = export_stage_label_metadata(image_obj.getStageLabel())
+        if not _same(image.stage_label, current, omero_id_to_object):
+            changed.append('stage_label')
+            if not dry_run:
+                attach_stage_label_metadata(image.stage_label, image_obj, conn)
+
+    if image.pixels is not None:
+        changed += _attach_channels_delta(image.pixels.channels, image_obj, omero_id_to_object, conn, dry_run)
+
+        if image.pixels.planes:
+            incoming = PlaneTable.from_planes(image.pixels.planes)
+            current = load_plane_table(image_obj.getPrimaryPixels().getId(), conn)
+            if incoming is None or current is None or not incoming.equals(current):
+                changed.append('planes')
+                if not dry_run:
+                    attach_planes_metadata_upsert(image.pixels, image_obj, conn, plane_chunk_size)
+
+    logging.info(f"Changed {changed or 'nothing'} of image {image_obj.getId()}")
+
+    return changed
+
+
+def _attach_channels_delta(
+        channels: List[Channel],
+        image_obj: ImageWrapper,
+        omero_id_to_object: Dict[str, Any],
+        conn: BlitzGateway,
+        dry_run: bool,
+) -> List[str]:
+    ch_objs = image_obj.getChannels()
+
+    assert len(ch_objs) == len(channels), f'Number of channels in image {image_obj.id} {len(channels)} ' \
+                                          f'does not match number of channels {len(ch_objs)} in OME-TIFF'
+
+    changed = []
+    for idx, (ch_obj, channel) in enumerate(zip(ch_objs, channels)):
+        if _same(channel, export_channel_metadata(ch_obj), omero_id_to_object):
+            continue
+
+        changed.append(f'channel:{idx}')
+        if not dry_run:
+            attach_channel_metadata(channel, ch_obj, conn, omero_id_to_object)
+
+    return changed
+
+
+def _same(
+        incoming: BaseModel, current: Optional[BaseModel], omero_id_to_object: Dict[str, Any], own_ref: bool = False
+) -> bool:
+    if current is None:
+        return False
+
+    if canonical_metadata(incoming) != canonical_metadata(current):
+        return False
+
+    # References are compared by their IDs on the target server
+    incoming_refs = sorted(_target_id(ref_id, omero_id_to_object) or -1 for ref_id in _ref_ids(incoming, own_ref))
+    current_refs = sorted(int(ref_id.split(':')[-1]) for ref_id in _ref_ids(current, own_ref))
+    return incoming_refs == current_refs
+
+
+def _ref_ids(model: BaseModel, own_ref: bool) -> List[str]:
+    # IDs of nested models, e.g. settings and filter refs, and of the model itself if it is a reference
+    ids = [model.id] if own_ref else []
+
+    for name in model.__fields__:
+        values = getattr(model, name)
+        for value in values if isinstance(values, list) else [values]:
+            if isinstance(value, BaseModel):
+                ids += _ref_ids(value, own_ref='id' in value.__fields__)
+
+    return ids
+
+
+def _target_id(ref_id: str, omero_id_to_object: Dict[str, Any]) -> Optional[int]:
+    obj = omero_id_to_object.get(ref_id)
+    return None if obj is None else obj.getId().getValue()
@@ -0,0 +1,128 @@
+# Copyright (c) 2023 Qureator, Inc. All rights reserved.
+
+import hashlib
+import json
+import os
+from enum import Enum
+from typing import Any, Dict, Optional
+
+from ome_types.model import Instrument
+from omero.gateway import BlitzGateway
+from pydantic import BaseModel
+
+from ...pack.cache import server_key
+
+
+def canonical_metadata(value: Any, sort_lists: bool = True) -> Any:
+    """Convert an ome_types model into plain data without server-specific IDs.
+
+    Parameters
+    ----------
+    value : Any
+        Model, list or value to convert.
+    sort_lists : bool
+        Sort list items so that collections loaded in any order compare equal.
+    """
+    if isinstance(value, BaseModel):
+        data = {'__type__': type(value).__name__}
+        for name in value.__fields__:
+            if name == 'id':
+                continue
+
+            item = canonical_metadata(getattr(value, name), sort_lists)
+            if item is None or item == []:
+                continue
+            data[name] = item
+        return data
+
+    if isinstance(value, (list, tuple)):
+        items = [canonical_metadata(item, sort_lists) for item in value]
+        if sort_lists:
+            items.sort(key=lambda item: json.dumps(item, sort_keys=True))
+        return items
+
+    if isinstance(value, Enum):
+        return value.value
+
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+
+    return str(value)
+
+
+def instrument_fingerprint(instrument: Instrument) -> str:
+    data = json.dumps(canonical_metadata(instrument), sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+def server_group_key(conn: BlitzGateway) -> str:
+    """Host, port and group that objects created through ``conn`` belong to."""
+    group_id = conn.SERVICE_OPTS.getOmeroGroup()
+    if group_id is None or int(group_id) < 0:
+        group_id = conn.getEventContext().groupId
+    return f"{server_key(conn)}/{group_id}"
+
+
+class InstrumentIndex:
+    """Map from instrument fingerprints to instrument IDs on the target server.
+
+    The index belongs to the server and group of the first connection it is
+    bound to, see :meth:`bind`, and refuses to be used with any other.
+
+    Parameters
+    ----------
+    path : str, optional
+        JSON file the index is loaded from and saved to. Without a path the
+        index only lives in memory.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        self.server: Optional[str] = None
+        self._instrument_ids: Dict[str, int] = {}
+
+        if path is not None and os.path.exists(path):
+            with open(path, 'r') as f:
+                data = json.load(f)
+            # Instruments of an unknown server are not loaded
+            self.server = data.get('server')
+            if self.server is not None:
+                self._instrument_ids = {key: int(value) for key, value in data['instruments'].items()}
+
+    def bind(self, conn: BlitzGateway) -> None:
+        """Claim the index for the server and group of ``conn``, or check that it belongs to them.
+
+        Raises
+        ------
+        ValueError
+            If the index maps instruments of another server or group.
+        """
+        server = server_group_key(conn)
+        if self.server is None:
+            self.server = server
+            self.save()
+        elif self.server != server:
+            raise ValueError(f"Instrument index of {self.server} cannot be used with {server}")
+
+    def __len__(self) -> int:
+        return len(self._instrument_ids)
+
+    def get(self, fingerprint: str) -> Optional[int]:
+        return self._instrument_ids.get(fingerprint)
+
+    def add(self, fingerprint: str, instrument_id: int) -> None:
+        self._instrument_ids[fingerprint] = instrument_id
+        self.save()
+
+    def remove(self, fingerprint: str) -> None:
+        if self._instrument_ids.pop(fingerprint, None) is not None:
+            self.save()
+
+    def save(self) -> None:
+        if self.path is None:
+            return
+
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'server': self.server, 'instruments': self._instrument_ids}, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.path)
@@ -1,10 +1,14 @@
 # Copyright (c) 2023 Qureator, Inc. All rights reserved.
 
-from typing import Dict, Any
+import logging
+from collections import Counter, defaultdict
+from typing import Dict, Any, Iterator, Optional
 
 from ome_types.model import (
+    ROI,
     Image,
     Pixels,
+    Plane,
     ObjectiveSettings,
     ImagingEnvironment,
     StageLabel,
@@ -14,14 +18,36 @@ from omero.model import (
     ObjectiveSettingsI,
     ImagingEnvironmentI,
     StageLabelI,
+    PixelsI,
     PlaneInfoI,
 )
+from omero.sys import ParametersI
+
+from ...masks import MaskStore
+from ...tracing import traced
 from .channel import attach_channels_metadata
-from .common import update_metadata, update_length_metadata, update_enum_metadata
+from .common import update_metadata, update_length_metadata, update_enum_metadata, object_key, object_references
+from .journal import TransferJournal, journaled
+from .roi import create_rois
+
+# Fields compared to tell whether a plane is already saved
+PLANE_INFO_FIELDS = ('theZ', 'theC', 'theT', 'deltaT', 'exposureTime', 'positionX', 'positionY', 'positionZ')
+PLANE_INDEX_FIELDS = PLANE_INFO_FIELDS[:3]
+PLANE_INFOS_QUERY = "select pi from PlaneInfo as pi where pi.pixels.id = :id order by pi.id"
 
 
+@traced
 def attach_image_metadata(
-        image: Image, image_obj: ImageWrapper, omero_id_to_object: Dict[str, Any], conn: BlitzGateway
+        image: Image,
+        image_obj: ImageWrapper,
+        omero_id_to_object: Dict[str, Any],
+        conn: BlitzGateway,
+        plane_chunk_size: Optional[int] = None,
+        rois: Optional[Dict[str, ROI]] = None,
+        roi_batch_size: int = 500,
+        masks: Optional[MaskStore] = None,
+        journal: Optional[TransferJournal] = None,
+        plane_upsert: bool = False,
 ) -> None:
     if image is None:
         return None
@@ -29,6 +55,11 @@ def attach_image_metadata(
     if image_obj is None or image_obj._obj is None:
         raise ValueError("image_obj is None")
 
+    key = str(image_obj.getId())
+    if journal is not None and journal.done(key, 'image'):
+        logging.info(f"Skipping image {key}, already attached")
+        return None
+
     update_metadata(image_obj, 'name', image.name)
     update_metadata(image_obj, 'description', image.description)
     # update_metadata(image_obj, 'acquisition_date', image.acquisition_date)
@@ -38,25 +69,46 @@ def attach_image_metadata(
         image_obj.setInstrument(instrument)
         image_obj.save()
 
+    # Steps creating new objects are journaled, the others are idempotent
     if image.objective_settings is not None:
-        attach_objective_settings_metadata(image.objective_settings, image_obj, omero_id_to_object, conn)
+        journaled(journal, key, 'objective_settings', lambda: object_references({
+            'objective_settings': attach_objective_settings_metadata(
+                image.objective_settings, image_obj, omero_id_to_object, conn
+            )
+        }))
 
     if image.imaging_environment is not None:
-        attach_imaging_environment_metadata(image.imaging_environment, image_obj, conn)
+        journaled(journal, key, 'imaging_environment', lambda: object_references({
+            'imaging_environment': attach_imaging_environment_metadata(image.imaging_environment, image_obj, conn)
+        }))
 
     if image.pixels is not None:
-        attach_pixels_metadata(image.pixels, image_obj, conn, omero_id_to_object)
+        attach_pixels_metadata(
+            image.pixels, image_obj, conn, omero_id_to_object, plane_chunk_size, journal, plane_upsert
+        )
 
     if image.stage_label is not None:
-        attach_stage_label_metadata(image.stage_label, image_obj, conn)
+        journaled(journal, key, 'stage_label', lambda: object_references({
+            'stage_label': attach_stage_label_metadata(image.stage_label, image_obj, conn)
+        }))
+
+    if image.roi_ref and rois is not None:
+        image_rois = [rois[roi_ref.id] for roi_ref in image.roi_ref if roi_ref.id in rois]
+        # One step per batch, so an interrupted run only repeats the batch it was saving
+        for start in range(0, len(image_rois), roi_batch_size):
+            batch = image_rois[start:start + roi_batch_size]
+            journaled(journal, key, f'rois:{start}', lambda: object_references(
+                create_rois(batch, image_obj, conn, roi_batch_size, masks)
+            ))
 
-    # if image.roi_ref is not None:
-    #    create_rois(image.roi_ref, ome.rois, image_obj)
+    if journal is not None:
+        journal.record(key, 'image')
 
 
+@traced
 def attach_stage_label_metadata(
         stage_label: StageLabel, image_obj: ImageWrapper, conn: BlitzGateway
-) -> None:
+) -> StageLabelI:
     sl_obj = StageLabelI()
 
     update_metadata(sl_obj, 'name', stage_label.name)
@@ -70,9 +122,18 @@ def attach_stage_label_metadata(
     image_obj.setStageLabel(sl_obj)
     image_obj.save()
 
+    return sl_obj
+
 
+@traced
 def attach_pixels_metadata(
-        pixels: Pixels, image_obj: ImageWrapper, conn: BlitzGateway, omero_id_to_object: Dict[str, Any]
+        pixels: Pixels,
+        image_obj: ImageWrapper,
+        conn: BlitzGateway,
+        omero_id_to_object: Dict[str, Any],
+        plane_chunk_size: Optional[int] = None,
+        journal: Optional[TransferJournal] = None,
+        plane_upsert: bool = False,
 ) -> None:
     update_enum_metadata(image_obj, 'dimensionOrder', pixels.dimension_order, 'DimensionOrderI', conn)
     update_enum_metadata(image_obj, 'pixelsType', pixels.type, 'PixelsTypeI', conn)
@@ -82,15 +143,35 @@ def attach_pixels_metadata(
     update_metadata(image_obj, 'sizeC', pixels.size_c)
     update_metadata(image_obj, 'sizeT', pixels.size_t)
 
-    attach_planes_metadata(pixels, image_obj, conn)
-    attach_channels_metadata(pixels.channels, image_obj, conn, omero_id_to_object)
+    key = str(image_obj.getId())
+    journaled(journal, key, 'planes', lambda: attach_planes_metadata(
+        pixels, image_obj, conn, plane_chunk_size, plane_upsert
+    ))
+    journaled(journal, key, 'channels', lambda: attach_channels_metadata(
+        pixels.channels, image_obj, conn, omero_id_to_object
+    ))
     image_obj.save()
 
 
-def attach_planes_metadata(pixels: Pixels, image_obj: ImageWrapper, conn: BlitzGateway) -> None:
+@traced
+def attach_planes_metadata(
+        pixels: Pixels,
+        image_obj: ImageWrapper,
+        conn: BlitzGateway,
+        chunk_size: Optional[int] = None,
+        upsert: bool = False,
+) -> None:
     if pixels.planes is None:
         return
 
+    if upsert:
+        attach_planes_metadata_upsert(pixels, image_obj, conn, chunk_size or 1000)
+        return
+
+    if chunk_size is not None:
+        attach_planes_metadata_chunked(pixels, image_obj, conn, chunk_size)
+        return
+
     # Load image with plane info seq
     query_service = conn.getQueryService()
     image_obj = query_service.findByQuery(
@@ -99,27 +180,152 @@ def attach_planes_metadata(pixels: Pixels, image_obj: ImageWrapper, conn: BlitzG
     )
 
     for plane in pixels.planes:
-        plane_obj = PlaneInfoI()
-        update_length_metadata(plane_obj, 'deltaT', plane.delta_t, plane.delta_t_unit)
-        update_length_metadata(plane_obj, 'exposureTime', plane.exposure_time, plane.exposure_time_unit)
-        update_length_metadata(plane_obj, 'positionX', plane.position_x, plane.position_x_unit)
-        update_length_metadata(plane_obj, 'positionY', plane.position_y, plane.position_y_unit)
-        update_length_metadata(plane_obj, 'positionZ', plane.position_z, plane.position_z_unit)
-        update_metadata(plane_obj, 'theC', plane.the_c)
-        update_metadata(plane_obj, 'theT', plane.the_t)
-        update_metadata(plane_obj, 'theZ', plane.the_z)
-
-        image_obj.getPrimaryPixels().addPlaneInfo(plane_obj)
+        image_obj.getPrimaryPixels().addPlaneInfo(build_plane_info(plane))
 
     conn.getUpdateService().saveObject(image_obj.getPrimaryPixels(), conn.SERVICE_OPTS)
 
 
+@traced
+def attach_planes_metadata_chunked(
+        pixels: Pixels, image_obj: ImageWrapper, conn: BlitzGateway, chunk_size: int = 1000
+) -> None:
+    """Save planes in chunks of ``chunk_size``, skipping planes already saved with identical values.
+
+    Unlike ``attach_planes_metadata`` without a chunk size, the Pixels graph is
+    neither loaded nor sent, so the message size does not grow with the number
+    of planes.
+    """
+    if pixels.planes is None:
+        return
+
+    pixels_id = image_obj.getPrimaryPixels().getId()
+    existing = Counter(
+        object_key(obj, PLANE_INFO_FIELDS) for obj in iter_plane_infos(pixels_id, conn, chunk_size)
+    )
+
+    update_service = conn.getUpdateService()
+    chunk = []
+    saved = skipped = 0
+
+    for plane in pixels.planes:
+        plane_obj = build_plane_info(plane)
+
+        key = object_key(plane_obj, PLANE_INFO_FIELDS)
+        if existing[key] > 0:
+            existing[key] -= 1
+            skipped += 1
+            continue
+
+        plane_obj.setPixels(PixelsI(pixels_id, False))
+        chunk.append(plane_obj)
+
+        if len(chunk) >= chunk_size:
+            update_service.saveArray(chunk, conn.SERVICE_OPTS)
+            saved += len(chunk)
+            chunk = []
+
+    if chunk:
+        update_service.saveArray(chunk, conn.SERVICE_OPTS)
+        saved += len(chunk)
+
+    logging.info(f"Saved {saved} planes of pixels {pixels_id}, skipped {skipped} existing planes")
+
+
+@traced
+def attach_planes_metadata_upsert(
+        pixels: Pixels, image_obj: ImageWrapper, conn: BlitzGateway, chunk_size: int = 1000
+) -> None:
+    """Replace the saved planes with ``pixels.planes``, matching them by (theZ, theC, theT).
+
+    Matched planes are updated in place, in chunks of ``chunk_size`` and only if
+    their values changed, missing planes are created and saved planes without a
+    match are deleted with a single call. Repeated imports of the same planes
+    leave the saved planes unchanged. Pixels without planes are left as is.
+    """
+    if not pixels.planes:
+        return
+
+    pixels_id = image_obj.getPrimaryPixels().getId()
+    existing = defaultdict(list)
+    for obj in iter_plane_infos(pixels_id, conn, chunk_size):
+        existing[object_key(obj, PLANE_INDEX_FIELDS)].append(obj)
+
+    update_service = conn.getUpdateService()
+    chunk = []
+    created = updated = unchanged = 0
+
+    for plane in pixels.planes:
+        plane_obj = build_plane_info(plane)
+
+        matches = existing.get(object_key(plane_obj, PLANE_INDEX_FIELDS))
+        if matches:
+            saved_obj = matches.pop(0)
+            if object_key(saved_obj, PLANE_INFO_FIELDS) == object_key(plane_obj, PLANE_INFO_FIELDS):
+                unchanged += 1
+                continue
+
+            for field in PLANE_INFO_FIELDS:
+                setattr(saved_obj, field, getattr(plane_obj, field, None))
+            chunk.append(saved_obj)
+            updated += 1
+        else:
+            plane_obj.setPixels(PixelsI(pixels_id, False))
+            chunk.append(plane_obj)
+            created += 1
+
+        if len(chunk) >= chunk_size:
+            update_service.saveArray(chunk, conn.SERVICE_OPTS)
+            chunk = []
+
+    if chunk:
+        update_service.saveArray(chunk, conn.SERVICE_OPTS)
+
+    extra_ids = [obj.getId().getValue() for matches in existing.values() for obj in matches]
+    if extra_ids:
+        conn.deleteObjects("PlaneInfo", extra_ids, wait=True)
+
+    logging.info(
+        f"Upserted planes of pixels {pixels_id}: created {created}, updated {updated}, "
+        f"unchanged {unchanged}, deleted {len(extra_ids)}"
+    )
+
+
+def iter_plane_infos(pixels_id: int, conn: BlitzGateway, page_size: int = 1000) -> Iterator[PlaneInfoI]:
+    query_service = conn.getQueryService()
+
+    offset = 0
+    while True:
+        params = ParametersI().addId(pixels_id).page(offset, page_size)
+        plane_objs = query_service.findAllByQuery(PLANE_INFOS_QUERY, params, conn.SERVICE_OPTS)
+        yield from plane_objs
+
+        if len(plane_objs) < page_size:
+            return
+        offset += page_size
+
+
+def build_plane_info(plane: Plane) -> PlaneInfoI:
+    plane_obj = PlaneInfoI()
+
+    update_length_metadata(plane_obj, 'deltaT', plane.delta_t, plane.delta_t_unit)
+    update_length_metadata(plane_obj, 'exposureTime', plane.exposure_time, plane.exposure_time_unit)
+    update_length_metadata(plane_obj, 'positionX', plane.position_x, plane.position_x_unit)
+    update_length_metadata(plane_obj, 'positionY', plane.position_y, plane.position_y_unit)
+    update_length_metadata(plane_obj, 'positionZ', plane.position_z, plane.position_z_unit)
+    update_metadata(plane_obj, 'theC', plane.the_c)
+    update_metadata(plane_obj, 'theT', plane.the_t)
+    update_metadata(plane_obj, 'theZ', plane.the_z)
+
+    return plane_obj
+
+
+@traced
 def attach_objective_settings_metadata(
         objective_settings: ObjectiveSettings,
         image_obj: ImageWrapper,
         omero_id_to_object: Dict[str, Any],
         conn: BlitzGateway
-) -> None:
+) -> ObjectiveSettingsI:
     os_obj = ObjectiveSettingsI()
 
     update_metadata(os_obj, 'correctionCollar', objective_settings.correction_collar)
@@ -132,12 +338,15 @@ def attach_objective_settings_metadata(
     image_obj.setObjectiveSettings(os_obj)
     image_obj.save()
 
+    return os_obj
 
+
+@traced
 def attach_imaging_environment_metadata(
         imaging_environment: ImagingEnvironment,
         image_obj: ImageWrapper,
         conn: BlitzGateway,
-) -> None:
+) -> Optional[ImagingEnvironmentI]:
     if imaging_environment is None:
         return None
 
@@ -151,3 +360,5 @@ def attach_imaging_environment_metadata(
     ie_obj = conn.getUpdateService().saveAndReturnObject(ie_obj, conn.SERVICE_OPTS)
     image_obj.setImagingEnvironment(ie_obj)
     image_obj.save()
+
+    return ie_obj
@@ -1,6 +1,8 @@
 # Copyright (c) 2023 Qureator, Inc. All rights reserved.
 
-from typing import List, Dict, Any, Union
+import logging
+from collections import defaultdict
+from typing import List, Dict, Any, Optional, Union
 
 from ome_types.model import (
     Instrument,
@@ -11,6 +13,7 @@ from ome_types.model import (
     Filter, TransmittanceRange,
     Dichroic,
 )
+from omero import ServerError
 from omero.gateway import BlitzGateway
 from omero.model import (
     InstrumentI,
@@ -22,18 +25,153 @@ from omero.model import (
     DichroicI,
 )
 
-from .common import update_metadata, update_length_metadata, update_enum_metadata
+from ...tracing import traced
+from .common import (
+    update_metadata, update_length_metadata, update_enum_metadata, object_key, object_references, unloaded_objects,
+)
+from .fingerprint import InstrumentIndex, instrument_fingerprint
+from .journal import TransferJournal
+
+# Fields compared when matching saved instrument components back to their OME models
+MANUFACTURER_SPEC_FIELDS = ('manufacturer', 'model', 'serialNumber', 'lotNumber')
+LIGHT_SOURCE_FIELDS = MANUFACTURER_SPEC_FIELDS + (
+    'power', 'type', 'laserMedium', 'wavelength', 'frequencyMultiplication', 'tuneable', 'pulse', 'pockelCell',
+    'repetitionRate',
+)
+DETECTOR_FIELDS = MANUFACTURER_SPEC_FIELDS + ('type', 'gain', 'voltage', 'offsetValue', 'zoom', 'amplificationGain')
+OBJECTIVE_FIELDS = MANUFACTURER_SPEC_FIELDS + (
+    'correction', 'immersion', 'lensNA', 'nominalMagnification', 'calibratedMagnification', 'workingDistance', 'iris',
+)
+FILTER_FIELDS = MANUFACTURER_SPEC_FIELDS + ('type', 'filterWheel')
+DICHROIC_FIELDS = MANUFACTURER_SPEC_FIELDS
 
 
-def create_instruments(instruments: List[Instrument], conn: BlitzGateway) -> Dict[str, Any]:
+@traced
+def create_instruments(
+        instruments: List[Instrument],
+        conn: BlitzGateway,
+        single_transaction: bool = False,
+        index: Optional[InstrumentIndex] = None,
+        journal: Optional[TransferJournal] = None,
+) -> Dict[str, Any]:
     omero_id_to_objects = {}
+    if index is not None:
+        index.bind(conn)
 
     for instrument in instruments:
-        omero_id_to_objects.update(create_instrument(instrument, conn))
+        if journal is not None and journal.done(instrument.id, 'instrument'):
+            # Created by an earlier run of an interrupted transfer
+            omero_id_to_objects.update(unloaded_objects(journal.targets(instrument.id, 'instrument')))
+            continue
+
+        if index is not None:
+            fingerprint = instrument_fingerprint(instrument)
+            res = find_indexed_instrument(instrument, fingerprint, index, conn)
+            if res is not None:
+                logging.info(f"Reusing instrument {res[instrument.id].getId().getValue()} for {instrument.id}")
+                omero_id_to_objects.update(res)
+                if journal is not None:
+                    journal.record(instrument.id, 'instrument', object_references(res))
+                continue
+
+        if single_transaction:
+            res = create_instrument_graph(instrument, conn)
+        else:
+            res = create_instrument(instrument, conn)
+        omero_id_to_objects.update(res)
+
+        if journal is not None:
+            journal.record(instrument.id, 'instrument', object_references(res))
+
+        if index is not None:
+            index.add(fingerprint, res[instrument.id].getId().getValue())
+
+    return omero_id_to_objects
+
+
+def find_indexed_instrument(
+        instrument: Instrument, fingerprint: str, index: InstrumentIndex, conn: BlitzGateway
+) -> Optional[Dict[str, Any]]:
+    instrument_id = index.get(fingerprint)
+    if instrument_id is None:
+        return None
+
+    try:
+        instrument_obj = conn.getMetadataService().loadInstrument(instrument_id, conn.SERVICE_OPTS)
+        if instrument_obj is None:
+            raise ValueError(f'Instrument {instrument_id} not found')
+        return match_instrument_objects(instrument, instrument_obj, conn)
+    except (ValueError, ServerError) as e:
+        # Deleted or modified on the target server since it was indexed
+        logging.warning(f"Dropping indexed instrument {instrument_id}: {e}")
+        index.remove(fingerprint)
+        return None
+
+
+@traced
+def create_instrument_graph(instrument: Instrument, conn: BlitzGateway) -> Dict[str, Any]:
+    # Build the whole unsaved graph and persist it with a single call
+    instrument_obj = build_instrument(instrument, conn)
+    instrument_obj = conn.getUpdateService().saveAndReturnObject(instrument_obj, conn.SERVICE_OPTS)
+
+    return match_instrument_objects(instrument, instrument_obj, conn)
+
+
+def build_instrument(instrument: Instrument, conn: BlitzGateway) -> InstrumentI:
+    instrument_obj = InstrumentI()
+
+    if instrument.microscope is not None:
+        instrument_obj.setMicroscope(build_microscope(instrument.microscope, conn))
+
+    for light_source in instrument.light_source_group:
+        instrument_obj.addLightSource(build_light_source(light_source, conn))
+
+    for detector in instrument.detectors:
+        instrument_obj.addDetector(build_detector(detector, conn))
+
+    for objective in instrument.objectives:
+        instrument_obj.addObjective(build_objective(objective, conn))
+
+    for filter_ in instrument.filters:
+        instrument_obj.addFilter(build_filter(filter_, conn))
+
+    for dichroic in instrument.dichroics:
+        instrument_obj.addDichroic(build_dichroic(dichroic, conn))
+
+    return instrument_obj
+
+
+def match_instrument_objects(instrument: Instrument, instrument_obj: InstrumentI, conn: BlitzGateway) -> Dict[str, Any]:
+    """Map the OME IDs of an instrument's components to the objects of a saved instrument.
+
+    The saved collections are unordered, so components are matched by the values
+    they were created with. Components with identical values are interchangeable.
+    """
+    omero_id_to_objects = {instrument.id: instrument_obj}
+
+    components = (
+        (instrument.light_source_group, instrument_obj.copyLightSource(), build_light_source, LIGHT_SOURCE_FIELDS),
+        (instrument.detectors, instrument_obj.copyDetector(), build_detector, DETECTOR_FIELDS),
+        (instrument.objectives, instrument_obj.copyObjective(), build_objective, OBJECTIVE_FIELDS),
+        (instrument.filters, instrument_obj.copyFilter(), build_filter, FILTER_FIELDS),
+        (instrument.dichroics, instrument_obj.copyDichroic(), build_dichroic, DICHROIC_FIELDS),
+    )
+
+    for models, objs, build, fields in components:
+        candidates = defaultdict(list)
+        for obj in objs:
+            candidates[object_key(obj, fields)].append(obj)
+
+        for model in models:
+            key = object_key(build(model, conn), fields)
+            if not candidates[key]:
+                raise ValueError(f'No saved object matches {model.id} of {instrument.id}')
+            omero_id_to_objects[model.id] = candidates[key].pop(0)
 
     return omero_id_to_objects
 
 
+@traced
 def create_instrument(instrument: Instrument, conn: BlitzGateway) -> Dict[str, Any]:
     instrument_obj = InstrumentI()
 
@@ -66,6 +204,7 @@ def create_instrument(instrument: Instrument, conn: BlitzGateway) -> Dict[str, A
     return omero_id_to_objects
 
 
+@traced
 def create_microscope(
         microscope: Microscope, instrument_obj: InstrumentI, conn: BlitzGateway
 ) -> Union[Dict[str, Any], InstrumentI]:
@@ -76,14 +215,7 @@ def create_microscope(
     if instrument_obj.getMicroscope() is not None:
         return {}
 
-    microscope_obj = MicroscopeI()
-
-    update_metadata(microscope_obj, 'manufacturer', microscope.manufacturer)
-    update_metadata(microscope_obj, 'model', microscope.model)
-    update_metadata(microscope_obj, 'serialNumber', microscope.serial_number)
-    update_metadata(microscope_obj, 'lotNumber', microscope.lot_number)
-    update_enum_metadata(microscope_obj, 'type', microscope.type, 'MicroscopeTypeI', conn)
-
+    microscope_obj = build_microscope(microscope, conn)
     microscope_obj = conn.getUpdateService().saveAndReturnObject(microscope_obj, conn.SERVICE_OPTS)
 
     instrument_obj = InstrumentI(instrument_obj.id)
@@ -94,6 +226,19 @@ def create_microscope(
     return {}, instrument_obj
 
 
+def build_microscope(microscope: Microscope, conn: BlitzGateway) -> MicroscopeI:
+    microscope_obj = MicroscopeI()
+
+    update_metadata(microscope_obj, 'manufacturer', microscope.manufacturer)
+    update_metadata(microscope_obj, 'model', microscope.model)
+    update_metadata(microscope_obj, 'serialNumber', microscope.serial_number)
+    update_metadata(microscope_obj, 'lotNumber', microscope.lot_number)
+    update_enum_metadata(microscope_obj, 'type', microscope.type, 'MicroscopeTypeI', conn)
+
+    return microscope_obj
+
+
+@traced
 def create_light_sources(
         light_sources: List[LightSource], instrument_obj: InstrumentI, conn: BlitzGateway
 ) -> Union[Dict[str, Any], InstrumentI]:
@@ -110,9 +255,19 @@ def create_light_sources(
     return omero_id_to_obj, instrument_obj
 
 
+@traced
 def create_light_source(
         light_source: LightSource, instrument_obj: InstrumentI, conn: BlitzGateway
 ) -> Dict[str, Any]:
+    light_source_obj = build_light_source(light_source, conn)
+    light_source_obj.setInstrument(instrument_obj)
+
+    light_source_obj = conn.getUpdateService().saveAndReturnObject(light_source_obj, conn.SERVICE_OPTS)
+
+    return {light_source.id: light_source_obj}
+
+
+def build_light_source(light_source: LightSource, conn: BlitzGateway) -> Any:
     if isinstance(light_source, Laser):
         light_source_obj = LaserI()
 
@@ -144,8 +299,6 @@ def create_light_source(
     else:
         raise Exception(f'Unknown light source type: {type(light_source)}')
 
-    light_source_obj.setInstrument(instrument_obj)
-
     update_metadata(light_source_obj, 'manufacturer', light_source.manufacturer)
     update_metadata(light_source_obj, 'model', light_source.model)
     update_metadata(light_source_obj, 'serialNumber', light_source.serial_number)
@@ -153,11 +306,10 @@ def create_light_source(
 
     update_length_metadata(light_source_obj, 'power', light_source.power, light_source.power_unit)
 
-    light_source_obj = conn.getUpdateService().saveAndReturnObject(light_source_obj, conn.SERVICE_OPTS)
-
-    return {light_source.id: light_source_obj}
+    return light_source_obj
 
 
+@traced
 def create_detectors(
         detectors: List[Detector], instrument_obj: InstrumentI, conn: BlitzGateway
 ) -> Union[Dict[str, DetectorI], InstrumentI]:
@@ -174,12 +326,21 @@ def create_detectors(
     return omero_id_to_obj, instrument_obj
 
 
+@traced
 def create_detector(
         detector: Detector, instrument_obj: InstrumentI, conn: BlitzGateway
 ) -> Dict[str, DetectorI]:
-    detector_obj = DetectorI()
+    detector_obj = build_detector(detector, conn)
     detector_obj.setInstrument(instrument_obj)
 
+    detector_obj = conn.getUpdateService().saveAndReturnObject(detector_obj, conn.SERVICE_OPTS)
+
+    return {detector.id: detector_obj}
+
+
+def build_detector(detector: Detector, conn: BlitzGateway) -> DetectorI:
+    detector_obj = DetectorI()
+
     type_ = detector.type
 
     if type_.value == 'EMCCD':
@@ -196,11 +357,10 @@ def create_detector(
     update_metadata(detector_obj, 'zoom', detector.zoom)
     update_metadata(detector_obj, 'amplificationGain', detector.amplification_gain)
 
-    detector_obj = conn.getUpdateService().saveAndReturnObject(detector_obj, conn.SERVICE_OPTS)
-
-    return {detector.id: detector_obj}
+    return detector_obj
 
 
+@traced
 def create_objectives(
         objectives: List[Objective], instrument_obj: InstrumentI, conn: BlitzGateway
 ) -> Union[Dict[str, ObjectiveI], InstrumentI]:
@@ -217,12 +377,21 @@ def create_objectives(
     return omero_id_to_obj, instrument_obj
 
 
+@traced
 def create_objective(
         objective: Objective, instrument_obj: InstrumentI, conn: BlitzGateway
 ) -> Dict[str, ObjectiveI]:
-    objective_obj = ObjectiveI()
+    objective_obj = build_objective(objective, conn)
     objective_obj.setInstrument(instrument_obj)
 
+    objective_obj = conn.getUpdateService().saveAndReturnObject(objective_obj, conn.SERVICE_OPTS)
+
+    return {objective.id: objective_obj}
+
+
+def build_objective(objective: Objective, conn: BlitzGateway) -> ObjectiveI:
+    objective_obj = ObjectiveI()
+
     correction = objective.correction if objective.correction is not None else 'Unknown'
     immersion = objective.immersion if objective.immersion is not None else 'Unknown'
 
@@ -238,11 +407,10 @@ def create_objective(
     update_length_metadata(objective_obj, 'workingDistance', objective.working_distance, objective.working_distance_unit)
     update_metadata(objective_obj, 'iris', objective.iris)
 
-    objective_obj = conn.getUpdateService().saveAndReturnObject(objective_obj, conn.SERVICE_OPTS)
-
-    return {objective.id: objective_obj}
+    return objective_obj
 
 
+@traced
 def create_filters(
         filters: List[Filter], instrument_obj: InstrumentI, conn: BlitzGateway
 ) -> Union[Dict[str, FilterI], InstrumentI]:
@@ -259,9 +427,18 @@ def create_filters(
     return omero_id_to_obj, instrument_obj
 
 
+@traced
 def create_filter(
         filter_: Filter, instrument_obj: InstrumentI, conn: BlitzGateway
 ) -> Dict[str, FilterI]:
+    filter_obj = build_filter(filter_, conn)
+    filter_obj.setInstrument(instrument_obj)
+
+    filter_obj = conn.getUpdateService().saveAndReturnObject(filter_obj, conn.SERVICE_OPTS)
+    return {filter_.id: filter_obj}
+
+
+def build_filter(filter_: Filter, conn: BlitzGateway) -> FilterI:
     filter_obj = FilterI()
 
     update_metadata(filter_obj, 'manufacturer', filter_.manufacturer)
@@ -272,8 +449,6 @@ def create_filter(
     update_enum_metadata(filter_obj, 'type', filter_.type, 'FilterTypeI', conn)
     update_metadata(filter_obj, 'filterWheel', filter_.filter_wheel)
 
-    filter_obj.setInstrument(instrument_obj)
-
     if filter_.type.value == 'BandPass':
         tr_range_obj = TransmittanceRangeI()
         tr_range: TransmittanceRange = filter_.transmittance_range
@@ -282,10 +457,10 @@ def create_filter(
 
         filter_obj.setTransmittanceRange(tr_range_obj)
 
-    filter_obj = conn.getUpdateService().saveAndReturnObject(filter_obj, conn.SERVICE_OPTS)
-    return {filter_.id: filter_obj}
+    return filter_obj
 
 
+@traced
 def create_dichroics(
         dichroics: List[Dichroic], instrument_obj: InstrumentI, conn: BlitzGateway
 ) -> Union[Dict[str, DichroicI], InstrumentI]:
@@ -302,9 +477,19 @@ def create_dichroics(
     return omero_id_to_obj, instrument_obj
 
 
+@traced
 def create_dichroic(
         dichroic: Dichroic, instrument_obj: InstrumentI, conn: BlitzGateway
 ) -> Dict[str, DichroicI]:
+    dichroic_obj = build_dichroic(dichroic, conn)
+    dichroic_obj.setInstrument(instrument_obj)
+
+    dichroic_obj = conn.getUpdateService().saveAndReturnObject(dichroic_obj, conn.SERVICE_OPTS)
+
+    return {dichroic.id: dichroic_obj}
+
+
+def build_dichroic(dichroic: Dichroic, conn: BlitzGateway) -> DichroicI:
     dichroic_obj = DichroicI()
 
     update_metadata(dichroic_obj, 'manufacturer', dichroic.manufacturer)
@@ -312,8 +497,4 @@ def create_dichroic(
     update_metadata(dichroic_obj, 'serialNumber', dichroic.serial_number)
     update_metadata(dichroic_obj, 'lotNumber', dichroic.lot_number)
 
-    dichroic_obj.setInstrument(instrument_obj)
-
-    dichroic_obj = conn.getUpdateService().saveAndReturnObject(dichroic_obj, conn.SERVICE_OPTS)
-
-    return {dichroic.id: dichroic_obj}
+    return dichroic_obj
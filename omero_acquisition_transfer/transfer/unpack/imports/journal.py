@@ -0,0 +1,99 @@
+# Copyright (c) 2023 Qureator, Inc. All rights reserved.
+
+import json
+import logging
+import os
+import threading
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, Optional
+
+
+class TransferJournal:
+    """Append-only JSON lines journal of finished transfer steps.
+
+    Each line records one step of one key, e.g. step 'planes' of target image
+    '2001' or step 'instrument' of 'Instrument:1', with the target IDs it
+    produced. Lines are flushed and fsynced before the step counts as done, so
+    a restarted transfer skips exactly the steps that completed.
+
+    Parameters
+    ----------
+    path : str
+        Journal file, created if missing and appended to otherwise.
+
+    Examples
+    --------
+    >>> with TransferJournal("transfer.jsonl") as journal:
+    ...     omero_id_to_object = create_instruments(ome.instruments, conn, journal=journal)
+    ...     attach_image_metadata(image, image_obj, omero_id_to_object, conn, journal=journal)
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._steps: Dict[str, Dict[str, Dict[str, Any]]] = {}
+
+        if os.path.exists(path):
+            with open(path, "rb+") as f:
+                data = f.read()
+                # Drop the torn last line of a crashed run, its step did not complete
+                end = data.rfind(b"\n") + 1
+                if end < len(data):
+                    logging.warning(f"Ignoring incomplete last line of journal {path}")
+                    f.truncate(end)
+
+            for line in data[:end].decode("utf-8").splitlines():
+                entry = json.loads(line)
+                self._steps.setdefault(entry["key"], {})[entry["step"]] = entry["targets"]
+
+        self._file = open(path, "a", encoding="utf-8")
+
+    def done(self, key: str, step: str) -> bool:
+        with self._lock:
+            return step in self._steps.get(key, {})
+
+    def targets(self, key: str, step: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            return self._steps.get(key, {}).get(step)
+
+    def record(self, key: str, step: str, targets: Optional[Dict[str, Any]] = None) -> None:
+        entry = {
+            "key": key,
+            "step": step,
+            "targets": targets or {},
+            "time": datetime.now(timezone.utc).isoformat(),
+        }
+
+        with self._lock:
+            self._file.write(json.dumps(entry) + "\n")
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._steps.setdefault(key, {})[step] = entry["targets"]
+
+    def run(self, key: str, step: str, func: Callable[[], Optional[Dict[str, Any]]]) -> Dict[str, Any]:
+        """Run ``func`` unless the step is done, and record the target IDs it returns."""
+        if self.done(key, step):
+            logging.info(f"Skipping {step} of {key}, already done")
+            return self.targets(key, step)
+
+        targets = func() or {}
+        self.record(key, step, targets)
+        return targets
+
+    def close(self) -> None:
+        with self._lock:
+            self._file.close()
+
+    def __enter__(self) -> "TransferJournal":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+def journaled(
+        journal: Optional[TransferJournal], key: str, step: str, func: Callable[[], Optional[Dict[str, Any]]]
+) -> Dict[str, Any]:
+    if journal is None:
+        return func() or {}
+    return journal.run(key, step, func)
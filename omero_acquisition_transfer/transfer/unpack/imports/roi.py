@@ -1,17 +1,122 @@
 # Copyright (c) 2023 Qureator, Inc. All rights reserved.
 
-from typing import Any, Dict, List
+import logging
+from typing import Any, Dict, List, Optional
+
 from ome_types.model import (
-    ROIRef, ROI
+    ROI, Shape, Point, Line, Rectangle, Polygon, Polyline, Ellipse, Label, Mask
 )
+from omero.gateway import BlitzGateway, ImageWrapper
 from omero.model import (
-    RoiI
+    ImageI,
+    RoiI,
+    PointI, LineI, RectangleI, PolygonI, PolylineI, EllipseI, LabelI, MaskI,
 )
-from omero.gateway import BlitzGateway, ImageWrapper
+from omero.rtypes import rbool, rint, rstring
+
+from ...masks import MaskStore, decode_mask
+from ...tracing import traced
+from .common import update_metadata, update_length_metadata
 
+# OMERO shape class and geometry fields (OMERO name, OME name) by OME shape class
+SHAPE_TYPES = {
+    Point: (PointI, (('x', 'x'), ('y', 'y'))),
+    Line: (LineI, (('x1', 'x1'), ('y1', 'y1'), ('x2', 'x2'), ('y2', 'y2'))),
+    Rectangle: (RectangleI, (('x', 'x'), ('y', 'y'), ('width', 'width'), ('height', 'height'))),
+    Ellipse: (EllipseI, (('x', 'x'), ('y', 'y'), ('radiusX', 'radius_x'), ('radiusY', 'radius_y'))),
+    Polygon: (PolygonI, (('points', 'points'),)),
+    Polyline: (PolylineI, (('points', 'points'),)),
+    Label: (LabelI, (('x', 'x'), ('y', 'y'))),
+    Mask: (MaskI, (('x', 'x'), ('y', 'y'), ('width', 'width'), ('height', 'height'))),
+}
 
+
+@traced
 def create_rois(
-        rois: List[ROI], conn: BlitzGateway
+        rois: List[ROI],
+        image_obj: ImageWrapper,
+        conn: BlitzGateway,
+        batch_size: int = 500,
+        masks: Optional[MaskStore] = None,
 ) -> Dict[str, Any]:
-    # TODO: implement
-    pass
+    """Create ROIs with their shapes on an image, saving ``batch_size`` ROIs per call.
+
+    Mask bytes are read from ``masks`` when they were exported to a sidecar.
+    Returns the saved ``RoiI`` objects by OME ROI ID.
+    """
+    omero_id_to_objects = {}
+    update_service = conn.getUpdateService()
+
+    for start in range(0, len(rois), batch_size):
+        batch = []
+        for roi in rois[start:start + batch_size]:
+            roi_obj = build_roi(roi, masks)
+            if roi_obj is None:
+                continue
+            roi_obj.setImage(ImageI(image_obj.getId(), False))
+            batch.append((roi.id, roi_obj))
+
+        if not batch:
+            continue
+
+        roi_objs = update_service.saveAndReturnArray([roi_obj for _, roi_obj in batch], conn.SERVICE_OPTS)
+        for (roi_id, _), roi_obj in zip(batch, roi_objs):
+            omero_id_to_objects[roi_id] = roi_obj
+
+    logging.info(f"Created {len(omero_id_to_objects)} ROIs on image {image_obj.getId()}")
+
+    return omero_id_to_objects
+
+
+def build_roi(roi: ROI, masks: Optional[MaskStore] = None):
+    roi_obj = RoiI()
+
+    update_metadata(roi_obj, 'name', roi.name)
+    update_metadata(roi_obj, 'description', roi.description)
+
+    for shape in roi.union:
+        shape_obj = build_shape(shape, masks)
+        if shape_obj is not None:
+            roi_obj.addShape(shape_obj)
+
+    if roi_obj.sizeOfShapes() == 0:
+        return None
+
+    return roi_obj
+
+
+def build_shape(shape: Shape, masks: Optional[MaskStore] = None):
+    if type(shape) not in SHAPE_TYPES:
+        raise NotImplementedError('Unknown ROI type: %s' % shape.__class__.__name__)
+
+    shape_class, fields = SHAPE_TYPES[type(shape)]
+    shape_obj = shape_class()
+
+    if shape.fill_color is not None:
+        shape_obj.fillColor = rint(shape.fill_color.as_int32())
+    if shape.stroke_color is not None:
+        shape_obj.strokeColor = rint(shape.stroke_color.as_int32())
+    if shape.fill_rule is not None:
+        shape_obj.fillRule = rstring(shape.fill_rule.value)
+    if shape.font_family is not None:
+        shape_obj.fontFamily = rstring(shape.font_family.value)
+    if shape.font_style is not None:
+        shape_obj.fontStyle = rstring(shape.font_style.value)
+    if shape.locked is not None:
+        shape_obj.locked = rbool(shape.locked)
+
+    update_length_metadata(shape_obj, 'strokeWidth', shape.stroke_width, shape.stroke_width_unit)
+    update_length_metadata(shape_obj, 'fontSize', shape.font_size, shape.font_size_unit)
+    update_metadata(shape_obj, 'strokeDashArray', shape.stroke_dash_array)
+    update_metadata(shape_obj, 'textValue', shape.text)
+    update_metadata(shape_obj, 'theZ', shape.the_z)
+    update_metadata(shape_obj, 'theT', shape.the_t)
+    update_metadata(shape_obj, 'theC', shape.the_c)
+
+    for omero_name, ome_name in fields:
+        update_metadata(shape_obj, omero_name, getattr(shape, ome_name))
+
+    if isinstance(shape, Mask):
+        shape_obj.setBytes(decode_mask(shape.id, shape.bin_data, masks))
+
+    return shape_obj
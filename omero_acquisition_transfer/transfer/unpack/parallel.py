@@ -0,0 +1,137 @@
+# Copyright (c) 2023 Qureator, Inc. All rights reserved.
+
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional
+
+from ome_types import OME
+from ome_types.model import Image
+from omero.gateway import BlitzGateway
+
+from ..masks import MaskStore
+from ..sessions import WorkerSessions, join_session
+from ..tracing import propagate_context, traced
+from .imports import (
+    TransferJournal,
+    attach_image_metadata,
+    create_instruments,
+    object_references,
+    unloaded_objects,
+)
+
+__all__ = ["attach_images_metadata_parallel"]
+
+
+@traced
+def attach_images_metadata_parallel(
+    ome: OME,
+    target_image_ids: Dict[str, int],
+    conn: BlitzGateway,
+    workers: int = 4,
+    max_pending: Optional[int] = None,
+    omero_id_to_object: Optional[Dict[str, Any]] = None,
+    plane_chunk_size: Optional[int] = None,
+    plane_upsert: bool = False,
+    rois: bool = True,
+    masks: Optional[MaskStore] = None,
+    journal: Optional[TransferJournal] = None,
+    join: Callable[[BlitzGateway], BlitzGateway] = join_session,
+) -> Dict[str, Optional[Exception]]:
+    """Attach the metadata of many images concurrently.
+
+    Instruments are created once up front with ``conn``. Workers only receive
+    their target IDs and attach images through their own joined sessions.
+
+    Parameters
+    ----------
+    ome : ome_types.OME
+        Document with the images and instruments to import.
+
+    target_image_ids : Dict[str, int]
+        Target image ID by OME image ID, e.g. {"Image:1": 2001}.
+        Images of ``ome`` missing from it are skipped.
+
+    conn : omero.gateway.BlitzGateway
+        OMERO connection to the target server.
+
+    workers : int
+        Number of concurrent workers, i.e. the maximum number of images written
+        to the server at a time.
+
+    max_pending : int, optional
+        Maximum number of images queued or in progress. Submission blocks when
+        reached. Defaults to twice the number of workers.
+
+    omero_id_to_object : Dict[str, Any], optional
+        Already created instruments, e.g. from ``create_instruments``.
+
+    plane_chunk_size : int, optional
+        Save planes in chunks of this size, skipping already saved planes.
+
+    plane_upsert : bool
+        Replace the saved planes of each image instead of adding to them, see
+        ``attach_planes_metadata_upsert``.
+
+    rois : bool
+        Create the ROIs referenced by the images.
+
+    masks : MaskStore, optional
+        Sidecar with the mask bytes, if the masks were exported to one.
+
+    journal : TransferJournal, optional
+        Journal of finished steps. Instruments and images completed by an
+        interrupted earlier run with the same journal are skipped.
+
+    join : Callable[[BlitzGateway], BlitzGateway]
+        Opens the connection of a worker, ``join_session`` by default, e.g.
+        ``FakeGateway.join`` offline.
+
+    Returns
+    -------
+    errors : Dict[str, Optional[Exception]]
+        Error by OME image ID, None for images attached successfully.
+    """
+    if omero_id_to_object is None:
+        omero_id_to_object = create_instruments(ome.instruments, conn, journal=journal)
+    references = object_references(omero_id_to_object)
+    rois_by_id = {roi.id: roi for roi in ome.rois} if rois else None
+
+    slots = threading.BoundedSemaphore(max_pending or 2 * workers)
+    futures: Dict[str, Future] = {}
+
+    with WorkerSessions(conn, join) as sessions, ThreadPoolExecutor(max_workers=workers) as executor:
+        local = threading.local()
+
+        def attach(image: Image, target_id: int) -> None:
+            worker_conn = sessions.get()
+            if getattr(local, "objects", None) is None:
+                # Unloaded references owned by this thread only
+                local.objects = unloaded_objects(references)
+
+            image_obj = worker_conn.getObject("Image", target_id)
+            if image_obj is None:
+                raise ValueError(f"Image {target_id} not found")
+            attach_image_metadata(
+                image, image_obj, local.objects, worker_conn, plane_chunk_size, rois=rois_by_id, masks=masks,
+                journal=journal, plane_upsert=plane_upsert,
+            )
+
+        for image in ome.images:
+            if image.id not in target_image_ids:
+                continue
+            if journal is not None and journal.done(str(target_image_ids[image.id]), 'image'):
+                continue
+
+            slots.acquire()
+            future = executor.submit(propagate_context(attach), image, target_image_ids[image.id])
+            future.add_done_callback(lambda _: slots.release())
+            futures[image.id] = future
+
+    errors = {}
+    for image_id, future in futures.items():
+        errors[image_id] = future.exception()
+        if errors[image_id] is not None:
+            logging.error(f"Failed to attach {image_id}: {errors[image_id]}")
+
+    return errors
@@ -0,0 +1,246 @@
+# Copyright (c) 2023 Qureator, Inc. All rights reserved.
+
+import logging
+import os
+import queue
+import threading
+from collections import Counter
+from typing import IO, Any, Callable, Dict, Iterator, List, Optional, Union
+from xml.etree import ElementTree
+
+from ome_types.model import Image, Instrument, ROI
+from omero.gateway import BlitzGateway
+
+from ..masks import MaskStore
+from ..ome_xml import OME_ELEMENTS, OMEElement, parse_element
+from ..tracing import propagate_context, traced
+from .imports import TransferJournal, attach_image_metadata, create_instruments, create_rois, object_references
+from .imports.journal import journaled
+
+__all__ = ["iter_ome_xml", "attach_images_metadata_streamed"]
+
+
+def iter_ome_xml(source: Union[str, os.PathLike, IO[bytes]], prefetch: int = 0) -> Iterator[OMEElement]:
+    """Read the instruments, images and ROIs of an OME-XML document one at a time.
+
+    Elements are yielded in document order, which the schema fixes to all
+    instruments, then all images, then all ROIs. Each one is parsed and
+    validated as soon as its end tag is read and then dropped from the tree,
+    so memory does not grow with the document. Other top level elements,
+    e.g. plates or annotations, are skipped.
+
+    Parameters
+    ----------
+    source : str, os.PathLike or binary file object
+        OME-XML file.
+
+    prefetch : int
+        Parse in a background thread up to this many elements ahead of the
+        consumer, e.g. while it waits for the server. 0 parses in the
+        calling thread.
+
+    Yields
+    ------
+    element : ome_types.model.Instrument, Image or ROI
+    """
+    if prefetch > 0:
+        return _iter_prefetched(lambda: _iter_elements(source), prefetch)
+    return _iter_elements(source)
+
+
+def _iter_elements(source: Union[str, os.PathLike, IO[bytes]]) -> Iterator[OMEElement]:
+    root = None
+    depth = 0
+    skipped: Counter = Counter()
+
+    for event, elem in ElementTree.iterparse(source, events=("start", "end")):
+        if event == "start":
+            if root is None:
+                root = elem
+            depth += 1
+            continue
+
+        depth -= 1
+        if depth != 1:
+            continue
+
+        tag = elem.tag.rpartition("}")[2]
+        if tag in OME_ELEMENTS:
+            yield parse_element(ElementTree.tostring(elem), tag)
+        else:
+            skipped[tag] += 1
+        # Only the open path of the tree is kept
+        root.remove(elem)
+
+    if skipped:
+        logging.info(f"Skipped top level elements {dict(skipped)}")
+
+
+_DONE = object()
+
+
+class _Failure:
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+def _iter_prefetched(produce: Callable[[], Iterator[Any]], prefetch: int) -> Iterator[Any]:
+    items: "queue.Queue[Any]" = queue.Queue(maxsize=prefetch)
+    stop = threading.Event()
+
+    def put(item: Any) -> bool:
+        # Gives up when the consumer stopped reading, so the thread never blocks forever
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def run() -> None:
+        try:
+            for item in produce():
+                if not put(item):
+                    return
+        except BaseException as e:
+            put(_Failure(e))
+        else:
+            put(_DONE)
+
+    thread = threading.Thread(target=propagate_context(run), name="ome-xml-reader", daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = items.get()
+            if item is _DONE:
+                return
+            if isinstance(item, _Failure):
+                raise item.error
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+@traced
+def attach_images_metadata_streamed(
+        source: Union[str, os.PathLike, IO[bytes]],
+        target_image_ids: Dict[str, int],
+        conn: BlitzGateway,
+        prefetch: int = 16,
+        plane_chunk_size: Optional[int] = None,
+        plane_upsert: bool = False,
+        rois: bool = True,
+        roi_batch_size: int = 500,
+        masks: Optional[MaskStore] = None,
+        journal: Optional[TransferJournal] = None,
+) -> Dict[str, Any]:
+    """Attach the metadata of an OME-XML file while it is being read.
+
+    Instruments are created once the last one is read. Images are attached as
+    they are read, and ROIs, which follow all images in the document, are
+    created on the target image referencing them. The document is never held
+    in memory as a whole.
+
+    Parameters
+    ----------
+    source : str, os.PathLike or binary file object
+        OME-XML file, e.g. written by ``OMEXMLWriter``.
+
+    target_image_ids : Dict[str, int]
+        Target image ID by OME image ID, e.g. {"Image:1": 2001}.
+        Images missing from it are skipped, with their ROIs.
+
+    conn : omero.gateway.BlitzGateway
+        OMERO connection to the target server.
+
+    prefetch : int
+        Number of elements parsed ahead in a background thread while the
+        previous ones are saved. 0 parses in the calling thread.
+
+    plane_chunk_size : int, optional
+        Save planes in chunks of this size, skipping already saved planes.
+
+    plane_upsert : bool
+        Replace the saved planes of each image instead of adding to them.
+
+    rois : bool
+        Create the ROIs referenced by the images.
+
+    roi_batch_size : int
+        Number of consecutive ROIs of an image saved per call.
+
+    masks : MaskStore, optional
+        Sidecar with the mask bytes, if the masks were exported to one.
+
+    journal : TransferJournal, optional
+        Journal of finished steps, to resume an interrupted import.
+
+    Returns
+    -------
+    omero_id_to_object : Dict[str, Any]
+        Created instruments and their components by OME ID, as returned by
+        ``create_instruments``.
+    """
+    instruments: List[Instrument] = []
+    omero_id_to_object: Optional[Dict[str, Any]] = None
+    # Target image ID by OME ROI ID, filled from the ROI references of the attached images
+    roi_targets: Dict[str, int] = {}
+    pending_rois: List[ROI] = []
+    pending_target: Optional[int] = None
+    image_count = roi_count = 0
+
+    def flush_rois() -> None:
+        nonlocal roi_count
+        if not pending_rois:
+            return
+        batch = list(pending_rois)
+        pending_rois.clear()
+        journaled(journal, str(pending_target), f"rois:{batch[0].id}", lambda: object_references(
+            create_rois(batch, conn.getObject("Image", pending_target), conn, roi_batch_size, masks)
+        ))
+        roi_count += len(batch)
+
+    for element in iter_ome_xml(source, prefetch):
+        if isinstance(element, Instrument):
+            instruments.append(element)
+            continue
+
+        if omero_id_to_object is None:
+            omero_id_to_object = create_instruments(instruments, conn, journal=journal)
+            instruments = []
+
+        if isinstance(element, Image):
+            target_id = target_image_ids.get(element.id)
+            if target_id is None:
+                continue
+            image_obj = conn.getObject("Image", target_id)
+            if image_obj is None:
+                raise ValueError(f"Image {target_id} not found")
+
+            # ROIs are attached when they are read, further down the document
+            attach_image_metadata(
+                element, image_obj, omero_id_to_object, conn, plane_chunk_size,
+                journal=journal, plane_upsert=plane_upsert,
+            )
+            if rois:
+                for roi_ref in element.roi_ref:
+                    roi_targets[roi_ref.id] = target_id
+            image_count += 1
+
+        elif isinstance(element, ROI):
+            target_id = roi_targets.pop(element.id, None)
+            if target_id is None:
+                continue
+            if target_id != pending_target or len(pending_rois) >= roi_batch_size:
+                flush_rois()
+                pending_target = target_id
+            pending_rois.append(element)
+
+    flush_rois()
+    if omero_id_to_object is None:
+        omero_id_to_object = create_instruments(instruments, conn, journal=journal)
+
+    logging.info(f"Attached {image_count} images and {roi_count} ROIs from {source}")
+    return omero_id_to_object
@@ -17,6 +17,7 @@ VERSION = "1.0.0"
 
 # What packages are required for this module to be executed?
 REQUIRED = [
+    "numpy",
     "omero-py>=5.6.0",
     "ome-types>=0.3.2",
     "tifftools",
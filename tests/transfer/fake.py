@@ -0,0 +1,665 @@
+# Copyright (c) 2023 Qureator, Inc. All rights reserved.
+
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import Counter
+
+import tifftools
+from ome_types import OME, from_xml, to_xml
+from ome_types.model.simple_types import UnitsTime
+from omero.model import MaskI, RoiI, TimeI
+from omero.rtypes import rdouble, unwrap
+
+from omero_acquisition_transfer import (
+    attach_image_metadata,
+    create_instruments,
+    export_image_metadata,
+    export_images_metadata,
+)
+from omero_acquisition_transfer.testing import FakeGateway
+from omero_acquisition_transfer.testing.synthetic import (
+    build_image,
+    build_instrument,
+    build_plate,
+    populate,
+    write_ome_tiff,
+)
+from omero_acquisition_transfer.transfer.archive import ArchiveWriter, MetadataArchive, write_archive
+from omero_acquisition_transfer.transfer.masks import MaskStore, decode_mask
+from omero_acquisition_transfer.transfer.ome_xml import element_xml, parse_element
+from omero_acquisition_transfer.transfer.pack import (
+    MetadataCache,
+    export_images_metadata_cached,
+    export_metadata_parallel,
+)
+from omero_acquisition_transfer.transfer.pack.hierarchy import query_layout, resolve_image_ids, well_position
+from omero_acquisition_transfer.transfer.pack.exports.roi import ROI_IDS_CHUNK_SIZE, iter_rois_metadata
+from omero_acquisition_transfer.transfer.pack.pack_utils import (
+    merge_metadata_tiffs,
+    read_image_description,
+    write_image_description,
+)
+from omero_acquisition_transfer.transfer.pack.exports import (
+    OMEBuilder,
+    OMEIndex,
+    OMEXMLWriter,
+    export_pixels_metadata,
+    load_plane_table,
+    prefetch_images,
+)
+from omero_acquisition_transfer.transfer.tracing import SERVER, Tracer, trace_connection
+from omero_acquisition_transfer.transfer.unpack import (
+    InstrumentIndex,
+    TransferJournal,
+    attach_image_metadata_delta,
+    attach_images_metadata_parallel,
+    attach_images_metadata_streamed,
+)
+from omero_acquisition_transfer.transfer.unpack.imports import (
+    attach_planes_metadata_upsert,
+    get_enumeration,
+    instrument_fingerprint,
+    invalidate_enum_cache,
+)
+
+
+def test_prefetch_round_trips(conn: FakeGateway) -> None:
+    image_ids = [build_image(conn.store).getId().getValue() for _ in range(10)]
+
+    with conn.calls.measure() as calls:
+        images = prefetch_images(image_ids, conn)
+
+    # Images, channels, acquisition data, planes and ROIs, whatever the number of images
+    assert len(images) == 10
+    assert sum(calls.values()) == 5, calls
+
+
+def test_prefetched_channels_keep_colors(conn: FakeGateway) -> None:
+    image_id = build_image(conn.store).getId().getValue()
+
+    ome = OME()
+    export_images_metadata([image_id], conn, ome)
+
+    colors = [channel.color.as_rgb_tuple() for channel in ome.images[0].pixels.channels]
+    assert colors == [(0, 255, 0), (255, 0, 255)]
+    # Serializable, unlike channels with a color of None
+    to_xml(ome)
+
+
+def test_projected_rois_chunk_ids(conn: FakeGateway) -> None:
+    image_id = build_image(conn.store, rois=ROI_IDS_CHUNK_SIZE + 1).getId().getValue()
+
+    with conn.calls.measure() as calls:
+        rois = list(iter_rois_metadata(image_id, conn, page_size=None, projection=True))
+
+    # One ROI query, then one query per shape type and masks for each of the two chunks of ROI IDs
+    assert len(rois) == ROI_IDS_CHUNK_SIZE + 1
+    assert calls["QueryService.projection"] == 1 + 2 * 7, calls
+    assert calls["QueryService.findAllByQuery"] == 2, calls
+    assert rois == list(iter_rois_metadata(image_id, conn, page_size=None))
+
+
+def test_masks_round_trip_through_store(conn: FakeGateway) -> None:
+    image = build_image(conn.store)
+    data = bytes(range(256)) * 32
+
+    mask = MaskI()
+    for name, value in (("X", 0.0), ("Y", 0.0), ("Width", 128.0), ("Height", 64.0)):
+        getattr(mask, f"set{name}")(rdouble(value))
+    mask.setBytes(data)
+    roi = RoiI()
+    roi.addShape(mask)
+    roi.setImage(image)
+    conn.store.save(roi)
+    image_ids = [image.getId().getValue()]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        with MaskStore(os.path.join(tmp, "masks.npz"), "w") as masks:
+            builder = OMEBuilder(masks=masks)
+            builder.add_images(image_ids, conn)
+            xml = to_xml(builder.build())
+
+        roi = from_xml(xml).rois[0]
+        # Fragments of the streaming reader and the archive are parsed with lxml
+        assert parse_element(element_xml(roi).encode(), "ROI") == roi
+        shape = roi.union[0]
+        assert not shape.bin_data.value and shape.bin_data.length == 0
+        with MaskStore(os.path.join(tmp, "masks.npz")) as masks:
+            assert decode_mask(shape.id, shape.bin_data, masks) == data
+
+    builder = OMEBuilder()
+    builder.add_images(image_ids, conn)
+    shape = from_xml(to_xml(builder.build())).rois[0].union[0]
+    assert shape.bin_data.length == len(shape.bin_data.value)
+    assert decode_mask(shape.id, shape.bin_data) == data
+
+
+def test_export_attach_image_metadata(conn: FakeGateway) -> None:
+    source_id = build_image(conn.store, size_z=10).getId().getValue()
+    target_id = build_image(conn.store, size_z=10, planes=False).getId().getValue()
+
+    ome = OME()
+    with conn.calls.measure() as export_calls:
+        export_image_metadata(conn.getObject("Image", source_id), conn, ome, in_place=True)
+
+    with conn.calls.measure() as attach_calls:
+        omero_id_to_object = create_instruments(ome.instruments, conn)
+        attach_image_metadata(ome.images[0], conn.getObject("Image", target_id), omero_id_to_object, conn,
+                              plane_chunk_size=1000)
+
+    # Planes are loaded and saved in bulk, neither direction makes a call per plane
+    planes = ome.images[0].pixels.planes
+    assert len(planes) == 40
+    assert sum(export_calls.values()) < len(planes), export_calls
+    assert attach_calls["UpdateService.saveArray"] == 1, attach_calls
+    assert sum(attach_calls.values()) < len(planes), attach_calls
+
+    target_pixels_id = conn.getObject("Image", target_id).getPrimaryPixels().getId()
+    assert len(conn.store.children("PlaneInfo", "pixels", target_pixels_id)) == len(planes)
+
+
+def test_index_reused_for_plain_ome(conn: FakeGateway) -> None:
+    image_ids = populate(conn.store, images=3, instruments=2, rois=2)
+
+    ome = OME()
+    index = OMEIndex.of(ome)
+    for image_id in image_ids:
+        export_image_metadata(conn.getObject("Image", image_id), conn, ome, in_place=True)
+        assert OMEIndex.of(ome) is index
+
+    expected = OMEIndex()
+    for image_id in image_ids:
+        export_image_metadata(conn.getObject("Image", image_id), conn, expected, in_place=True)
+    assert ome == expected.ome
+
+    # Changed behind the index, so it is rebuilt
+    ome.rois.pop()
+    assert OMEIndex.of(ome) is not index
+    assert len(OMEIndex.of(ome).rois) == len(ome.rois)
+
+
+def test_enum_cache_loads_each_type_once(conn: FakeGateway) -> None:
+    image_ids = populate(conn.store, images=3)
+    ome = OME()
+    export_images_metadata(image_ids, conn, ome)
+    target_ids = [build_image(conn.store, planes=False).getId().getValue() for _ in image_ids]
+
+    with conn.calls.measure() as calls:
+        get_enumeration(conn, "PixelsTypeI", "uint16")
+        get_enumeration(conn, "PixelsTypeI", "uint16")
+        get_enumeration(conn, "DimensionOrderI", "XYZCT")
+        # Not loaded with its class, fetched on its own
+        get_enumeration(conn, "PixelsTypeI", "float")
+    assert calls["TypesService.allEnumerations"] == 2, calls
+    assert calls["TypesService.getEnumeration"] == 1, calls
+
+    omero_id_to_object = create_instruments(ome.instruments, conn)
+    attach_image_metadata(ome.images[0], conn.getObject("Image", target_ids[0]), omero_id_to_object, conn)
+
+    # Every type is loaded by the first image, the others make no enumeration calls
+    with conn.calls.measure() as calls:
+        for image, target_id in zip(ome.images[1:], target_ids[1:]):
+            attach_image_metadata(image, conn.getObject("Image", target_id), omero_id_to_object, conn)
+    assert not [name for name in calls if name.startswith("TypesService.")], calls
+
+    invalidate_enum_cache(conn, "PixelsTypeI")
+    with conn.calls.measure() as calls:
+        get_enumeration(conn, "PixelsTypeI", "uint16")
+        get_enumeration(conn, "DimensionOrderI", "XYZCT")
+    assert calls["TypesService.allEnumerations"] == 1, calls
+
+
+def test_cache_misses_after_detector_settings_change(conn: FakeGateway) -> None:
+    image_id = populate(conn.store, images=1)[0]
+
+    with tempfile.TemporaryDirectory() as tmp, MetadataCache(os.path.join(tmp, "cache.sqlite")) as cache:
+        export_images_metadata_cached([image_id], conn, OME(), cache)
+        with conn.calls.measure() as calls:
+            export_images_metadata_cached([image_id], conn, OME(), cache)
+        assert calls["QueryService.findAllByQuery"] == 0, calls
+
+        query_service, update_service = conn.getQueryService(), conn.getUpdateService()
+        for settings_id in [obj.getId().getValue() for obj in conn.store.all("DetectorSettings")]:
+            settings = query_service.get("DetectorSettings", settings_id)
+            settings.setGain(rdouble(2.5))
+            update_service.saveObject(settings)
+
+        ome = OME()
+        with conn.calls.measure() as calls:
+            export_images_metadata_cached([image_id], conn, ome, cache)
+        assert calls["QueryService.findAllByQuery"] > 0, calls
+        assert [channel.detector_settings.gain for channel in ome.images[0].pixels.channels] == [2.5, 2.5]
+
+
+def test_instrument_graph_saved_at_once(conn: FakeGateway) -> None:
+    instrument_obj = build_instrument(conn.store, detectors=3, objectives=2, lasers=2, filters=3)
+    image_id = build_image(conn.store, instrument=instrument_obj).getId().getValue()
+
+    ome = OME()
+    export_image_metadata(conn.getObject("Image", image_id), conn, ome, in_place=True)
+    instrument = ome.instruments[0]
+
+    with conn.calls.measure() as calls:
+        created = create_instruments(ome.instruments, conn, single_transaction=True)
+    assert calls["UpdateService.saveAndReturnObject"] == 1, calls
+    assert sum(count for name, count in calls.items() if name.startswith("UpdateService.")) == 1, calls
+
+    # Every component is matched back to its own saved object
+    components = [*instrument.light_source_group, *instrument.detectors, *instrument.objectives, *instrument.filters]
+    assert set(created) == {instrument.id} | {component.id for component in components}
+    assert len({id(created[component.id]) for component in components}) == len(components)
+    for component in components:
+        assert created[component.id].getId() is not None
+        assert unwrap(created[component.id].getSerialNumber()) == component.serial_number
+    lasers = instrument.light_source_group
+    assert [created[laser.id].getWavelength().getValue() for laser in lasers] == [laser.wavelength for laser in lasers]
+
+    assert set(create_instruments(ome.instruments, conn)) == set(created)
+
+
+def test_instrument_index_reuses_instruments(conn: FakeGateway) -> None:
+    image_id = populate(conn.store, images=1)[0]
+
+    ome = OME()
+    export_image_metadata(conn.getObject("Image", image_id), conn, ome, in_place=True)
+    instrument = ome.instruments[0]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        index = InstrumentIndex(os.path.join(tmp, "instruments.json"))
+        created = create_instruments(ome.instruments, conn, index=index)
+        count = conn.store.count("Instrument")
+
+        # Reloaded from its file, the index maps the same instrument to the one just created
+        index = InstrumentIndex(index.path)
+        reused = create_instruments(ome.instruments, conn, index=index)
+        assert len(index) == 1
+        assert conn.store.count("Instrument") == count
+        assert reused[instrument.id].getId().getValue() == created[instrument.id].getId().getValue()
+
+        # A deleted instrument is dropped from the index and created again
+        conn.deleteObjects("Instrument", [created[instrument.id].getId().getValue()])
+        recreated = create_instruments(ome.instruments, conn, index=index)
+        assert conn.store.count("Instrument") == count
+        assert index.get(instrument_fingerprint(instrument)) == recreated[instrument.id].getId().getValue()
+
+        # Bound to the server and group it was created on
+        other = FakeGateway()
+        other.SERVICE_OPTS.setOmeroGroup(5)
+        try:
+            create_instruments(ome.instruments, other, index=InstrumentIndex(index.path))
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("index used with another group")
+
+
+def test_delta_dry_run(conn: FakeGateway) -> None:
+    source_id = build_image(conn.store).getId().getValue()
+    target_id = build_image(conn.store, planes=False).getId().getValue()
+
+    ome = OME()
+    export_image_metadata(conn.getObject("Image", source_id), conn, ome, in_place=True)
+    image = ome.images[0]
+    omero_id_to_object = create_instruments(ome.instruments, conn)
+    attach_image_metadata(image, conn.getObject("Image", target_id), omero_id_to_object, conn, plane_chunk_size=1000)
+    unchanged = attach_image_metadata_delta(image, conn.getObject("Image", target_id), omero_id_to_object, conn)
+
+    image.name = "renamed"
+    image.pixels.planes[0].delta_t += 1.0
+    with conn.calls.measure() as calls:
+        changed = attach_image_metadata_delta(
+            image, conn.getObject("Image", target_id), omero_id_to_object, conn, dry_run=True
+        )
+
+    assert set(changed) - set(unchanged) == {"name", "planes"}, changed
+    assert not [name for name in calls if name.startswith("UpdateService.") or name == "deleteObjects"], calls
+    assert conn.getObject("Image", target_id).getName() == "synthetic"
+
+    attach_image_metadata_delta(image, conn.getObject("Image", target_id), omero_id_to_object, conn)
+    assert conn.getObject("Image", target_id).getName() == "renamed"
+    changed = attach_image_metadata_delta(
+        image, conn.getObject("Image", target_id), omero_id_to_object, conn, dry_run=True
+    )
+    assert "name" not in changed and "planes" not in changed, changed
+
+
+def test_journal_resumes_after_torn_line(conn: FakeGateway) -> None:
+    source_id = populate(conn.store, images=1)[0]
+    target_id = build_image(conn.store, planes=False).getId().getValue()
+
+    ome = OME()
+    export_image_metadata(conn.getObject("Image", source_id), conn, ome, in_place=True)
+
+    def transfer(journal: TransferJournal) -> None:
+        omero_id_to_object = create_instruments(ome.instruments, conn, journal=journal)
+        attach_image_metadata(ome.images[0], conn.getObject("Image", target_id), omero_id_to_object, conn,
+                              journal=journal)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "journal.jsonl")
+        with TransferJournal(path) as journal:
+            transfer(journal)
+        instruments = conn.store.count("Instrument")
+        planes = conn.store.count("PlaneInfo")
+
+        # Simulate a crash after the planes were saved, in the middle of writing the next line
+        with open(path, encoding="utf-8") as f:
+            lines = f.readlines()
+        end = next(i for i, line in enumerate(lines) if json.loads(line)["step"] == "planes") + 1
+        with open(path, "w", encoding="utf-8") as f:
+            f.writelines(lines[:end])
+            f.write(lines[end][:10])
+
+        with TransferJournal(path) as journal:
+            assert journal.done(str(target_id), "planes") and not journal.done(str(target_id), "image")
+            transfer(journal)
+
+        assert conn.store.count("Instrument") == instruments
+        assert conn.store.count("PlaneInfo") == planes
+        with open(path, encoding="utf-8") as f:
+            steps = [json.loads(line)["step"] for line in f]
+        assert steps[-1] == "image" and steps.count("planes") == 1, steps
+
+
+def test_upsert_planes_idempotent(conn: FakeGateway) -> None:
+    source_id = build_image(conn.store).getId().getValue()
+    target_id = build_image(conn.store, planes=False).getId().getValue()
+
+    ome = OME()
+    export_image_metadata(conn.getObject("Image", source_id), conn, ome, in_place=True)
+    pixels = ome.images[0].pixels
+
+    attach_planes_metadata_upsert(pixels, conn.getObject("Image", target_id), conn)
+    count = conn.store.count("PlaneInfo")
+
+    with conn.calls.measure() as calls:
+        attach_planes_metadata_upsert(pixels, conn.getObject("Image", target_id), conn)
+
+    assert conn.store.count("PlaneInfo") == count
+    assert calls["UpdateService.saveArray"] == 0 and calls["deleteObjects"] == 0, calls
+
+
+def test_upsert_planes_updates_and_deletes(conn: FakeGateway) -> None:
+    source_id = build_image(conn.store).getId().getValue()
+    target_id = build_image(conn.store, planes=False).getId().getValue()
+
+    ome = OME()
+    export_image_metadata(conn.getObject("Image", source_id), conn, ome, in_place=True)
+    pixels = ome.images[0].pixels
+    attach_planes_metadata_upsert(pixels, conn.getObject("Image", target_id), conn)
+
+    # Shift the first three planes in time and drop the last two
+    planes = [plane.copy(update={"delta_t": plane.delta_t + 100}) for plane in pixels.planes[:3]]
+    planes += pixels.planes[3:-2]
+    with conn.calls.measure() as calls:
+        attach_planes_metadata_upsert(pixels.copy(update={"planes": planes}), conn.getObject("Image", target_id), conn)
+
+    assert calls["UpdateService.saveArray"] == 1 and calls["deleteObjects"] == 1, calls
+
+    target_pixels_id = conn.getObject("Image", target_id).getPrimaryPixels().getId()
+    plane_objs = conn.store.children("PlaneInfo", "pixels", target_pixels_id)
+    assert len(plane_objs) == len(planes)
+    delta_ts = {
+        (obj.getTheZ().getValue(), obj.getTheC().getValue(), obj.getTheT().getValue()): obj.getDeltaT().getValue()
+        for obj in plane_objs
+    }
+    assert delta_ts == {(plane.the_z, plane.the_c, plane.the_t): plane.delta_t for plane in planes}
+
+
+def test_plane_table_converts_time_units(conn: FakeGateway) -> None:
+    image_obj = build_image(conn.store)
+    pixels_id = image_obj.getPrimaryPixels().getId().getValue()
+
+    query_service, update_service = conn.getQueryService(), conn.getUpdateService()
+    for plane_id in [obj.getId().getValue() for obj in conn.store.children("PlaneInfo", "pixels", pixels_id)][::2]:
+        plane = query_service.get("PlaneInfo", plane_id)
+        plane.setDeltaT(TimeI(plane.getDeltaT().getValue() * 1000 + 0.5, "MILLISECOND"))
+        plane.setExposureTime(TimeI(100.0, "MILLISECOND"))
+        update_service.saveObject(plane)
+
+    table = load_plane_table(pixels_id, conn)
+    assert table is not None
+    assert table.units["delta_t"] == table.units["exposure_time"] == UnitsTime.SECOND
+
+    # The same planes as exported from PlaneInfo objects
+    def key(plane):
+        return plane.the_t, plane.the_c, plane.the_z
+
+    planes = export_pixels_metadata(conn.getObject("Image", image_obj.getId().getValue())).planes
+    assert sorted(table.to_planes(), key=key) == sorted(planes, key=key)
+
+
+def test_tracing_matches_server_calls(conn: FakeGateway) -> None:
+    image_id = build_image(conn.store, rois=2).getId().getValue()
+    trace_connection(conn)
+
+    tracer = Tracer()
+    with tracer.activate(), conn.calls.measure() as calls:
+        export_image_metadata(conn.getObject("Image", image_id), conn, OME())
+
+    stats = tracer.stats
+    assert {name: s.count for name, s in stats.items() if s.category == SERVER} == dict(calls), stats
+    assert stats["image.export_image_metadata"].count == 1
+    assert stats["image.export_image_metadata"].self_seconds <= stats["image.export_image_metadata"].total_seconds
+
+
+def test_plate_layout_labels_wells(conn: FakeGateway) -> None:
+    image_ids = populate(conn.store, images=3, instruments=0)
+    letters_id = build_plate(conn.store, image_ids[:2]).getId().getValue()
+    numbers_id = build_plate(
+        conn.store, image_ids[2:], row_convention="number", column_convention="letter"
+    ).getId().getValue()
+
+    assert resolve_image_ids(conn, "Image", image_ids + image_ids[:1]) == image_ids
+    assert resolve_image_ids(conn, "Plate", [numbers_id, letters_id]) == image_ids
+
+    with conn.calls.measure() as calls:
+        rows = query_layout(conn, "Plate", [letters_id, numbers_id])
+    assert calls["QueryService.projection"] == 1, calls
+    assert [well_position(*row[1:5]) for row in rows] == ["A1", "A2", "1A"]
+    assert [row[5] for row in rows] == image_ids
+
+    # Plates without conventions use letters for rows, past Z as in a spreadsheet
+    assert well_position(26, 27, None, None) == "AA28"
+
+
+def test_tiff_description_patched_in_place() -> None:
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "image.ome.tiff")
+        write_ome_tiff(path)
+        with open(path, "rb") as f:
+            original = f.read()
+
+        description = read_image_description(path).replace('Name="synthetic"', 'Name="patched"')
+        write_image_description(path, description, in_place=True)
+        with open(path, "rb") as f:
+            patched = f.read()
+
+        # Only the count and offset of the IFD0 entry change, the description is appended
+        assert sum(a != b for a, b in zip(original, patched)) <= 8
+        assert patched[len(original):].strip(b"\0") == description.encode()
+        assert read_image_description(path) == description
+        assert tifftools.read_tiff(path)["ifds"][0]["tags"][tifftools.Tag.ImageDescription.value]["data"] == description
+
+
+def test_merge_metadata_tiffs(conn: FakeGateway) -> None:
+    image_ids = populate(conn.store, images=3, instruments=2)
+    missing_id = max(image_ids) + 1000
+
+    with tempfile.TemporaryDirectory() as tmp:
+        items = []
+        for image_id in image_ids:
+            path = os.path.join(tmp, f"{image_id}.tiff")
+            write_ome_tiff(path)
+            items.append((image_id, path))
+        items += [(missing_id, os.path.join(tmp, "missing.tiff")), (image_ids[0], os.path.join(tmp, "absent.tiff"))]
+
+        results = merge_metadata_tiffs(conn, items, workers=2, fetch_workers=2, batch_size=2, join=FakeGateway.join)
+
+        assert [(result.image_id, result.tiff_path) for result in results] == items
+        assert [result.error for result in results[:3]] == [None] * 3
+        assert isinstance(results[3].error, ValueError)
+        assert isinstance(results[4].error, FileNotFoundError)
+
+        ome = from_xml(read_image_description(items[0][1]))
+        assert ome.images[0].instrument_ref.id == ome.instruments[0].id
+        assert len(ome.images[0].pixels.channels) == 2
+        assert ome.images[0].pixels.channels[0].color.as_rgb_tuple() == (0, 255, 0)
+
+
+def test_export_metadata_parallel_keeps_order(conn: FakeGateway) -> None:
+    # Not sorted by ID, and batches of uneven size
+    image_ids = populate(conn.store, images=7, instruments=3, rois=2)[::-1]
+
+    builder = OMEBuilder()
+    builder.add_images(image_ids, conn)
+    expected = builder.build()
+
+    ome = export_metadata_parallel(conn, "Image", image_ids, workers=3, batch_size=2, join=FakeGateway.join)
+    assert [image.id for image in ome.images] == [image.id for image in expected.images]
+    assert ome == expected
+
+    omes = export_metadata_parallel(
+        conn, "Image", image_ids, workers=3, batch_size=2, per_image=True, join=FakeGateway.join
+    )
+    assert list(omes) == image_ids
+    assert [omes[image_id].images[0] for image_id in image_ids] == expected.images
+
+
+def test_attach_images_metadata_parallel_bounds_pending(conn: FakeGateway) -> None:
+    image_ids = populate(conn.store, images=5)
+    ome = OME()
+    export_images_metadata(image_ids, conn, ome)
+
+    target_ids = {image.id: build_image(conn.store, planes=False).getId().getValue() for image in ome.images}
+    missing_id = max(target_ids.values()) + 1000
+    target_ids[ome.images[2].id] = missing_id
+
+    lock = threading.Lock()
+    active = Counter()
+
+    def join(conn: FakeGateway) -> FakeGateway:
+        worker_conn = FakeGateway.join(conn)
+        get_object = worker_conn.getObject
+
+        def getObject(obj_type, oid=None, **kwargs):
+            # Hold each image long enough for the other workers to start theirs
+            with lock:
+                active["now"] += 1
+                active["peak"] = max(active["peak"], active["now"])
+            time.sleep(0.05)
+            with lock:
+                active["now"] -= 1
+            return get_object(obj_type, oid, **kwargs)
+
+        worker_conn.getObject = getObject
+        return worker_conn
+
+    errors = attach_images_metadata_parallel(ome, target_ids, conn, workers=4, max_pending=2, join=join)
+
+    # Four workers, but submission blocks while two images are pending
+    assert active["peak"] == 2, active
+    assert list(errors) == [image.id for image in ome.images]
+    assert isinstance(errors[ome.images[2].id], ValueError)
+    assert all(error is None for image_id, error in errors.items() if image_id != ome.images[2].id), errors
+    for image_id, target_id in target_ids.items():
+        if target_id != missing_id:
+            pixels_id = conn.getObject("Image", target_id).getPrimaryPixels().getId()
+            assert len(conn.store.children("PlaneInfo", "pixels", pixels_id)) == 12
+
+
+def test_streamed_xml_matches_builder(conn: FakeGateway) -> None:
+    image_ids = populate(conn.store, images=5, instruments=2, rois=2)
+
+    builder = OMEBuilder(plane_table=True)
+    builder.add_images(image_ids, conn)
+
+    fh = io.StringIO()
+    with OMEXMLWriter(fh) as writer:
+        writer.add_images(image_ids, conn, batch_size=2)
+
+    assert writer.image_count == 5
+    assert fh.getvalue().strip() == to_xml(builder.build()).strip()
+
+
+def test_streamed_import(conn: FakeGateway) -> None:
+    image_ids = populate(conn.store, images=3, rois=4)
+
+    fh = io.StringIO()
+    with OMEXMLWriter(fh) as writer:
+        writer.add_images(image_ids, conn)
+
+    target_ids = {
+        f"Image:{image_id}": build_image(conn.store, planes=False).getId().getValue() for image_id in image_ids
+    }
+    rois = conn.store.count("Roi")
+    attach_images_metadata_streamed(io.BytesIO(fh.getvalue().encode()), target_ids, conn, prefetch=2, roi_batch_size=3)
+
+    for target_id in target_ids.values():
+        pixels_id = conn.getObject("Image", target_id).getPrimaryPixels().getId()
+        assert len(conn.store.children("PlaneInfo", "pixels", pixels_id)) == 12
+        assert len(conn.store.children("Roi", "image", target_id)) == 4
+    assert conn.store.count("Roi") == rois + 12
+
+
+def test_archive_round_trip(conn: FakeGateway) -> None:
+    image_ids = populate(conn.store, images=3, instruments=2, rois=3)
+
+    builder = OMEBuilder(plane_table=False)
+    builder.add_images(image_ids, conn)
+    # Compared through XML, which drops empty descriptions
+    ome = from_xml(to_xml(builder.build()))
+
+    with tempfile.TemporaryDirectory() as path:
+        with ArchiveWriter(path) as writer:
+            writer.add_images(image_ids, conn, batch_size=2)
+
+        archive = MetadataArchive(path)
+        assert archive.to_ome() == ome
+        image = ome.images[1]
+        assert archive.plane_table(image.id).to_planes() == image.pixels.planes
+        assert len(archive.shape_columns(image.id)["kind"]) == sum(len(roi.union) for roi in archive.rois(image.id))
+
+    # A missing value with a unit other than the default has no column, the planes stay in the XML
+    pixels = ome.images[0].pixels
+    plane = pixels.planes[0].copy(update={"delta_t": None, "delta_t_unit": UnitsTime.MILLISECOND})
+    image = ome.images[0].copy(update={"pixels": pixels.copy(update={"planes": [plane, *pixels.planes[1:]]})})
+    ome = ome.copy(update={"images": [image, *ome.images[1:]]})
+
+    with tempfile.TemporaryDirectory() as path:
+        write_archive(ome, path)
+
+        archive = MetadataArchive(path)
+        assert archive.plane_table(image.id) is None
+        assert archive.to_ome() == ome
+
+
+if __name__ == "__main__":
+    test_prefetch_round_trips(FakeGateway())
+    test_prefetched_channels_keep_colors(FakeGateway())
+    test_projected_rois_chunk_ids(FakeGateway())
+    test_masks_round_trip_through_store(FakeGateway())
+    test_export_attach_image_metadata(FakeGateway())
+    test_index_reused_for_plain_ome(FakeGateway())
+    test_enum_cache_loads_each_type_once(FakeGateway())
+    test_cache_misses_after_detector_settings_change(FakeGateway())
+    test_instrument_graph_saved_at_once(FakeGateway())
+    test_instrument_index_reuses_instruments(FakeGateway())
+    test_delta_dry_run(FakeGateway())
+    test_journal_resumes_after_torn_line(FakeGateway())
+    test_upsert_planes_idempotent(FakeGateway(latency=0.001))
+    test_upsert_planes_updates_and_deletes(FakeGateway())
+    test_plane_table_converts_time_units(FakeGateway())
+    test_tracing_matches_server_calls(FakeGateway())
+    test_plate_layout_labels_wells(FakeGateway())
+    test_tiff_description_patched_in_place()
+    test_merge_metadata_tiffs(FakeGateway())
+    test_export_metadata_parallel_keeps_order(FakeGateway(latency=0.001))
+    test_attach_images_metadata_parallel_bounds_pending(FakeGateway())
+    test_streamed_xml_matches_builder(FakeGateway())
+    test_streamed_import(FakeGateway())
+    test_archive_round_trip(FakeGateway())
@@ -1,9 +1,10 @@
 # Copyright (c) 2023 Qureator, Inc. All rights reserved.
 
 import omero
+from typing import List
 from getpass import getpass
 from omero.gateway import BlitzGateway, ImageWrapper
-from omero_acquisition_transfer import export_image_metadata
+from omero_acquisition_transfer import export_image_metadata, export_images_metadata
 from ome_types import OME
 
 
@@ -17,6 +18,16 @@ def test_export_image_metadata(image: ImageWrapper, conn: BlitzGateway) -> OME:
     return ome
 
 
+def test_export_images_metadata(image_ids: List[int], conn: BlitzGateway) -> OME:
+    ome = OME()
+
+    export_images_metadata(image_ids, conn, ome)
+
+    print(ome.to_xml())
+
+    return ome
+
+
 if __name__ == "__main__":
     client = omero.client(input("Host: "), 4064)
     client.createSession(input("Username: "), getpass("Password: "))
@@ -28,5 +39,6 @@ if __name__ == "__main__":
 
         image = conn.getObject("Image", int(input("Image ID: ")))
         ome = test_export_image_metadata(image, conn)
+        ome = test_export_images_metadata([image.getId()], conn)
     finally:
         client.closeSession()